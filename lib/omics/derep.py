@@ -21,176 +21,1527 @@ Find and remove replicated reads from fastq files.
 
 import argparse
 from binascii import hexlify
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from hashlib import blake2b
 from itertools import zip_longest
+import json
+import mmap
+from multiprocessing import Value
+import os
 from pathlib import Path
+import re
+import resource
+import sys
+import time
+from tempfile import mkstemp, TemporaryDirectory
+
+import numpy
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 from . import get_argparser, DEFAULT_VERBOSITY
+from .fileio import (copy_range, is_regular_file, open_input, open_output,
+                     strip_compression_suffix)
+from .seqio import (BATCH_RECORDS, BLOCK_SIZE, check_batch,
+                    deinterleave_batch, line_bounds, lines, read_batches)
+from .utils import parse_read_coordinates
 
 ST_HEAD = 1
 ST_SEQ = 2
 ST_PLUS = 3
 ST_SCORE = 4
 
+INDEX_DTYPE = numpy.dtype([
+    ('hash', 'u8'),  # read pair hash
+    ('pos', 'i8'),  # offset of forward read header in forward reads file
+    ('rpos', 'i8'),  # offset of reverse read header in reverse reads file
+    ('len', 'u4'),  # length of forward read record in bytes
+    ('rlen', 'u4'),  # length of reverse read record in bytes
+    ('qual', 'f4'),  # mean quality score
+])
+"""
+Record layout of the duplicate index
+
+For single-end reads rpos and rlen are zero.  For interleaved reads rpos is the
+offset of the reverse read in the same file, directly following the forward
+read, so in both cases a read (pair) spans from pos to pos + len + rlen in the
+forward reads file.
+"""
+
+# approximate memory cost per index record while hashing and sorting, this
+# is the columns, the structured array, and sorting temporaries
+_RECORD_COST = 4 * INDEX_DTYPE.itemsize
+
+HASH_ALGORITHMS = ['auto', 'blake2b', 'xxh64', 'xxh3']
+DEFAULT_HASH = 'auto'
+
+PROGRESS_INTERVAL = 10.0  # seconds between progress reports
+# bytes copied at once while writing output, so that progress gets reported
+WRITE_CHUNK_SIZE = 256 * 1024 * 1024
+
+
+def current_rss():
+    """
+    Get the current resident set size of this process in bytes
+
+    Falls back to the peak RSS where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    """
+    Get peak resident set size in bytes
+
+    :param who: resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN, the latter
+                gives the largest peak RSS of any waited-for child process.
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss * 1024
 
-def hash_read_pair(fwd_head, fwd_seq, rev_head='', rev_seq=''):
+
+def _human(num, unit='B'):
+    """
+    Format number with K, M, G, T prefix
+    """
+    for prefix in ['', 'K', 'M', 'G', 'T']:
+        if abs(num) < 1024 or prefix == 'T':
+            break
+        num /= 1024
+    return '{:.1f}{}{}'.format(num, prefix, unit)
+
+
+class Progress():
+    """
+    Periodic progress reports and statistics for one pass over the data
+
+    Progress is tracked as the number of processed bytes, out of a known
+    total, and processed records.  A report is printed every interval seconds
+    if a file is given, otherwise statistics are just collected.
+    """
+    def __init__(self, name, total=None, file=None,
+                 interval=PROGRESS_INTERVAL):
+        """
+        :param str name: Name of the pass, used as prefix of reports
+        :param int total: Total number of bytes to process, for the ETA
+        :param file: Text file to print reports to, None for no reports
+        :param float interval: Seconds between reports
+        """
+        self.name = name
+        self.total = total
+        self.file = file
+        self.interval = interval
+        self.bytes = 0
+        self.records = 0
+        self.table = None
+        self.start = time.monotonic()
+        self.last_report = self.start
+        self.seconds = None
+
+    def add(self, num_bytes, records=0, table=None):
+        """
+        Account for more processed bytes and records
+        """
+        self.update(self.bytes + num_bytes, self.records + records, table)
+
+    def update(self, done, records=None, table=None):
+        """
+        Set processed bytes (and records), report if it's time
+
+        :param int table: Current number of records in the duplicate table.
+        """
+        self.bytes = done
+        if records is not None:
+            self.records = records
+        if table is not None:
+            self.table = table
+        if self.file is not None:
+            now = time.monotonic()
+            if now - self.last_report >= self.interval:
+                self.last_report = now
+                self.report(now)
+
+    def report(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        elapsed = max(now - self.start, 1e-9)
+        rate = self.bytes / elapsed
+        msg = '{}: {} records ({:.0f}/s), {} ({}/s)'.format(
+            self.name, self.records, self.records / elapsed,
+            _human(self.bytes), _human(rate),
+        )
+        if self.table is not None:
+            msg += ', table: {} records'.format(self.table)
+        msg += ', RSS: {}'.format(_human(current_rss()))
+        if self.total and rate > 0:
+            eta = max(self.total - self.bytes, 0) / rate
+            msg += ', {:.0%} done, ETA {:.0f}s'.format(
+                self.bytes / self.total, eta
+            )
+        print(msg, file=self.file, flush=True)
+
+    def finish(self):
+        """
+        Stop the clock and return the statistics as dict
+        """
+        self.seconds = time.monotonic() - self.start
+        return self.stats()
+
+    def stats(self):
+        seconds = self.seconds
+        if seconds is None:
+            seconds = time.monotonic() - self.start
+        ret = {
+            'seconds': round(seconds, 3),
+            'bytes': self.bytes,
+            'records': self.records,
+            'bytes_per_second': round(self.bytes / seconds, 1)
+            if seconds > 0 else None,
+            'records_per_second': round(self.records / seconds, 1)
+            if seconds > 0 else None,
+        }
+        if self.table is not None:
+            ret['table_records'] = self.table
+        return ret
+
+
+class _SharedProgress():
+    """
+    Progress counters shared between worker processes
+
+    Workers add to the counters, the parent process polls them.  Instances
+    are inherited via the executor's initializer.
+    """
+    def __init__(self):
+        self.bytes = Value('q', 0)
+        self.records = Value('q', 0)
+
+    def add(self, num_bytes, records=0, table=None):
+        with self.bytes.get_lock():
+            self.bytes.value += num_bytes
+        with self.records.get_lock():
+            self.records.value += records
+
+
+_worker_progress = None
+
+
+def _init_worker(progress):
+    global _worker_progress
+    _worker_progress = progress
+
+
+def _blake2b_64(data):
+    return int.from_bytes(blake2b(data, digest_size=8).digest(), 'big')
+
+
+def get_hash_function(algorithm=DEFAULT_HASH):
+    """
+    Get a stable 64-bit content hash function
+
+    :param str algorithm: Name of the hash algorithm, one of HASH_ALGORITHMS.
+                          With 'auto' the fast xxh3 hash is used if the xxhash
+                          module is installed and blake2b otherwise.
+
+    :return: Tuple of algorithm name and a function that takes bytes and
+             returns the hash as unsigned 64-bit integer.
+
+    Unlike python's built-in hash() the result does not depend on
+    PYTHONHASHSEED, so hashes can be compared across processes and runs.
+    """
+    if algorithm == 'auto':
+        algorithm = 'blake2b' if xxhash is None else 'xxh3'
+
+    if algorithm == 'blake2b':
+        return algorithm, _blake2b_64
+
+    if algorithm in ['xxh64', 'xxh3']:
+        if xxhash is None:
+            raise RuntimeError('The {} hash requires the xxhash python '
+                               'package to be installed'.format(algorithm))
+        if algorithm == 'xxh64':
+            return algorithm, xxhash.xxh64_intdigest
+        return algorithm, xxhash.xxh3_64_intdigest
+
+    raise ValueError('Unknown hash algorithm: {}'.format(algorithm))
+
+
+def hash_read_pair(fwd_head, fwd_seq, rev_head=b'', rev_seq=b'',
+                   hash_fun=_blake2b_64):
     """
     Hash function for reads, reverse read may be omitted
 
-    Uses built-in hash of flowcell + lane + sequence
+    Uses a stable 64-bit hash of flowcell + lane + sequence
+
+    :param hash_fun: Hash function as returned by get_hash_function()
     """
-    return b':'.join(
+    return hash_fun(b':'.join(
         fwd_head.strip().split(b':')[:4] +
         [fwd_seq.strip()] +
         rev_head.strip().split(b':')[:4] +
         [rev_seq.strip()]
-    ).__hash__()
+    ))
 
 
-def read_groups(fwd, rev):
+def find_duplicates(fwd_in, rev_in=None, *, interleaved=False, check=False,
+                    hash_algorithm=DEFAULT_HASH, threads=1, max_memory=None,
+                    tmpdir=None, progress=None):
     """
-    Iterate over reads
+    Find duplicate reads in given fastq files
 
-    :param fwd: File handle to forward reads
-    :param rev: File handle to reverse reads
+    Calculates hash of concatenation of flowcell + lane part of header with
+    whitespace-trimmed sequence string to detect replicated reads.  For each
+    read pair the hash, the file offsets and lengths of forward and reverse
+    read, and the mean quality score are recorded in a compact index.
 
-    This implements the grouper recipe on a zipped input.  The output
-    iterates over 4-tuples of 2-tuples, i.e. the forward, reverse pairs
-    of the four lines of a read:
+    :param rev_in: The reverse reads file.  If this is None then fwd_in holds
+                   single-end reads or, if interleaved is True, interleaved
+                   paired-end reads.
+    :param bool interleaved: Whether fwd_in holds interleaved read pairs.
+                             Read pairs get the same hash as if the reads
+                             were given in separate files.
+    :param str hash_algorithm: Name of the hash algorithm, see
+                               get_hash_function()
+    :param int threads: Number of worker processes.  With more than one the
+                        work is delegated to find_duplicates_mp(), unless
+                        input is streamed, e.g. from compressed files.
+    :param int max_memory: Memory budget for the index in bytes.  If the index
+                           grows beyond this, sorted runs of the index are
+                           written to temporary files.  By default the index
+                           is kept in memory.
+    :param tmpdir: Directory for temporary files, required if max_memory is
+                   set.
+    :param Progress progress: Progress object to which processed bytes of
+                              both input files and records are added.
 
-      (@fwd_head, @rev_head), (fwd_seq, rev_seq), (+, +), (fwd_qual, rev_qual)
+    :return: Tuple of index and total read pair count.  The index is a numpy
+             structured array of INDEX_DTYPE with one entry per read pair in
+             file order, or, if the memory budget was exceeded, a SortedRuns
+             object.
     """
-    paired = zip_longest(fwd, rev)
-    args = [iter(paired)] * 4
-    return zip_longest(*args)
+    if rev_in is not None and interleaved:
+        raise ValueError('interleaved input requires rev_in to be None')
 
+    if threads > 1 and is_regular_file(fwd_in) \
+            and (rev_in is None or is_regular_file(rev_in)):
+        return find_duplicates_mp(fwd_in, rev_in, interleaved=interleaved,
+                                  check=check, hash_algorithm=hash_algorithm,
+                                  threads=threads, max_memory=max_memory,
+                                  tmpdir=tmpdir, progress=progress)
 
-def find_duplicates(fwd_in, rev_in=None, *, check=False):
-    """
-    Find duplicate reads in given fastq files
+    _, hash_fun = get_hash_function(hash_algorithm)
+    index = _hash_reads(fwd_in, rev_in, interleaved=interleaved, check=check,
+                        hash_fun=hash_fun, max_memory=max_memory,
+                        tmpdir=tmpdir, progress=progress)
+    return index, len(index)
 
-    Calculates hash of concatenation of flowcell + lane part of header with
-    whitespace-trimmed sequence string to detect replicated reads.  The
-    file offsets of each header-@ of forward reads is recorded and semi-ordered
-    such that the first offset listed belongs to the forward read of the
-    highest quality paired duplicate read.
+
+def find_duplicates_mp(fwd_in, rev_in=None, *, interleaved=False,
+                       check=False, hash_algorithm=DEFAULT_HASH, threads=2,
+                       max_memory=None, tmpdir=None, progress=None):
     """
-    if rev_in is None:
-        raise NotImplementedError('Single reads processing not implemented')
+    Find duplicate reads, multi-processing implementation
 
-    data = {}
-    fwd_read_pos = 0
-    total_count = 0
+    The input files are split into chunks at record boundaries such that each
+    chunk of the forward file covers the same reads as the corresponding chunk
+    of the reverse file.  Each chunk is hashed in a worker process.  Since the
+    index records absolute file offsets, the per-chunk indices are just
+    concatenated in file order and the result is identical to that of the
+    single-process implementation.  The memory budget, if any, is split evenly
+    among the workers.  Workers count their progress in shared counters which
+    are polled here.
+    """
+    if max_memory is not None:
+        max_memory //= threads
 
-    for (fh, rh), (fs, rs), (fp, rp), (fq, rq) in read_groups(fwd_in, rev_in):
-        if check:
-            if ord('>') in [fh[0], rh[0]]:
-                raise NotImplementedError('Fasta support not implemented')
-            if fh[0] != ord('@'):
-                raise RuntimeError('Expected fastq header in {}: {}'
-                                   ''.format(fwd_in.name, fh))
-            if rh[0] != ord('@'):
-                raise RuntimeError('Expected fastq header in {}: {}'
-                                   ''.format(rev_in.name, rh))
-            # TODO: check if headers match
-            if not fp.startswith(b'+') or not rp.startswith(b'+'):
+    paths = [fwd_in.name]
+    if rev_in is not None:
+        paths.append(rev_in.name)
+    shared = None if progress is None else _SharedProgress()
+    with ProcessPoolExecutor(max_workers=threads, initializer=_init_worker,
+                             initargs=(shared,)) as pe:
+        chunks = split_records(paths, threads,
+                               lines_per_record=8 if interleaved else 4,
+                               executor=pe)
+        futs = [
+            pe.submit(_hash_chunk, paths, ranges, interleaved, check,
+                      hash_algorithm, max_memory, tmpdir)
+            for ranges in chunks
+        ]
+        if progress is not None:
+            start_bytes, start_records = progress.bytes, progress.records
+            while wait(futs, timeout=1.0).not_done:
+                progress.update(start_bytes + shared.bytes.value,
+                                start_records + shared.records.value,
+                                table=shared.records.value)
+            progress.update(start_bytes + shared.bytes.value,
+                            start_records + shared.records.value,
+                            table=shared.records.value)
+        parts = []
+        for (fwd_range, *_), fut in zip(chunks, futs):
+            try:
+                parts.append(fut.result())
+            except Exception as e:
                 raise RuntimeError(
-                    'Expected two + lines:\n{}{}'
-                    ''.format(fp.decode()[:50], rp.decode()[:50])
-                )
-
-        paired_hash = hash_read_pair(fh, fs, rh, rs)
-
-        # get mean score of concatenated quality with newlines
-        cur_mean = mean_quality_score(fq + rq)
-
-        if paired_hash in data:
-            best_mean, pos_list = data[paired_hash]
-            if cur_mean > best_mean:
-                # new best read goes first
-                data[paired_hash] = (
-                    cur_mean,
-                    [fwd_read_pos] + pos_list
-                )
+                    'Chunk starting at {} failed: {}: {}'
+                    ''.format(fwd_range[0], e.__class__.__name__, e)
+                ) from e
+
+    if any((isinstance(i, SortedRuns) for i in parts)):
+        # some worker exceeded its budget, so we all go out-of-core
+        index = SortedRuns(INDEX_DTYPE, tmpdir, field='hash')
+        for i in parts:
+            if isinstance(i, SortedRuns):
+                index.extend(i)
+            elif len(i):
+                index.add(i)
+    elif parts:
+        index = numpy.concatenate(parts)
+    else:
+        index = numpy.empty(0, dtype=INDEX_DTYPE)
+    return index, len(index)
+
+
+def _hash_chunk(paths, ranges, interleaved, check, hash_algorithm,
+                max_memory, tmpdir):
+    """
+    Hash one chunk of reads, to be run in a worker process
+
+    :param list paths: Path to forward and, if any, reverse reads file
+    :param list ranges: The chunk's (start, end) byte range for each path
+    """
+    _, hash_fun = get_hash_function(hash_algorithm)
+    files = [open(i, 'rb') for i in paths]
+    try:
+        for f, (start, _) in zip(files, ranges):
+            f.seek(start)
+        return _hash_reads(
+            files[0], files[1] if len(files) > 1 else None,
+            ends=[end for _, end in ranges] + [None],
+            interleaved=interleaved, check=check, hash_fun=hash_fun,
+            max_memory=max_memory, tmpdir=tmpdir, progress=_worker_progress,
+        )
+    finally:
+        for f in files:
+            f.close()
+
+
+def _hash_reads(fwd_in, rev_in=None, ends=(None, None), interleaved=False,
+                check=False, hash_fun=_blake2b_64, max_memory=None,
+                tmpdir=None, progress=None):
+    """
+    Make the index for the reads from the current file positions
+
+    :param tuple ends: Stop at these offsets in the forward and reverse reads
+                       files.  By default read to the end of file.
+    :param bool interleaved: Whether the forward reads file holds interleaved
+                             read pairs, rev_in must be None then.
+
+    Returns the index as numpy array or as SortedRuns if the memory budget was
+    exceeded.
+    """
+    if max_memory is None:
+        max_records = None
+    else:
+        max_records = max(max_memory // _RECORD_COST, 1)
+    runs = None
+
+    parts = []
+    count = 0
+    if rev_in is None:
+        batches = read_batches(fwd_in, BATCH_RECORDS,
+                               lines_per_record=8 if interleaved else 4,
+                               end=ends[0])
+    else:
+        batches = zip_longest(
+            read_batches(fwd_in, BATCH_RECORDS, end=ends[0]),
+            read_batches(rev_in, BATCH_RECORDS, end=ends[1]),
+        )
+    for batch in batches:
+        if rev_in is None:
+            if interleaved:
+                fwd_batch, rev_batch, pos = deinterleave_batch(batch)
             else:
-                # read to be deleted, goes at end
-                data[paired_hash] = (
-                    best_mean,
-                    pos_list + [fwd_read_pos]
-                )
+                fwd_batch, rev_batch = batch, None
         else:
-            data[paired_hash] = (
-                cur_mean,
-                [fwd_read_pos]
-            )
+            fwd_batch, rev_batch = batch
+            if fwd_batch is None or rev_batch is None \
+                    or len(fwd_batch[2]) != len(rev_batch[2]):
+                raise RuntimeError('Forward and reverse reads files have '
+                                   'different number of reads: {} {}'
+                                   ''.format(fwd_in.name, rev_in.name))
+        if check:
+            check_batch(fwd_batch, fwd_in.name)
+            if rev_batch is not None:
+                check_batch(rev_batch, fwd_in.name if rev_in is None
+                            else rev_in.name)
+
+        parts.append(index_batch(fwd_batch, rev_batch, hash_fun=hash_fun))
+        if interleaved:
+            # reverse read follows forward read in the same file
+            parts[-1]['pos'] = pos
+            parts[-1]['rpos'] = pos + parts[-1]['len']
+        count += len(parts[-1])
+        if progress is not None:
+            num_bytes = len(batch[1]) if rev_in is None \
+                else len(fwd_batch[1]) + len(rev_batch[1])
+            progress.add(num_bytes, len(parts[-1]),
+                         table=count if runs is None else None)
+
+        if max_records is not None and count >= max_records:
+            # spill to disk
+            if runs is None:
+                runs = SortedRuns(INDEX_DTYPE, tmpdir, field='hash')
+            runs.add(numpy.concatenate(parts))
+            parts = []
+            count = 0
+
+    if parts:
+        index = numpy.concatenate(parts)
+    else:
+        index = numpy.empty(0, dtype=INDEX_DTYPE)
+    del parts
+
+    if runs is None:
+        return index
+    if len(index):
+        runs.add(index)
+    return runs
+
+
+def quality_sums(batch):
+    """
+    Get sums and lengths of the quality score lines of a batch of fastq records
+
+    The trailing newline is included, as it always has been for derep's
+    quality scores.
+
+    :return: Tuple of two numpy arrays, the sums and the lengths
+    """
+    _, data, newlines = batch
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+    starts, ends = line_bounds(newlines)
+    starts = starts[3::4]
+    ends = ends[3::4]
+    # reduceat over [start, end) of each score line, odd results are junk
+    idx = numpy.empty(2 * len(starts), dtype=numpy.int64)
+    idx[0::2] = starts
+    idx[1::2] = ends
+    sums = numpy.add.reduceat(buf, idx, dtype=numpy.uint32)[0::2]
+    lengths = ends - starts
+    # reduceat gives buf[i] for empty ranges
+    sums[lengths == 0] = 0
+    return sums.astype(numpy.int64) + ord('\n'), lengths + 1
+
+
+def index_batch(fwd_batch, rev_batch=None, hash_fun=_blake2b_64):
+    """
+    Get index records for a batch of paired or single fastq records
+
+    For single reads, i.e. if rev_batch is None, rpos and rlen are set to zero.
+    """
+    fwd_nl = fwd_batch[2]
+
+    index = numpy.empty(len(fwd_nl) // 4, dtype=INDEX_DTYPE)
+    parts = [(fwd_batch, 'pos', 'len')]
+    if rev_batch is None:
+        index['rpos'] = 0
+        index['rlen'] = 0
+    else:
+        parts.append((rev_batch, 'rpos', 'rlen'))
+    for (offset, _, nl), pos, length in parts:
+        starts = line_bounds(nl)[0][0::4]
+        index[pos] = starts + offset
+        index[length] = nl[3::4] + 1 - starts
+
+    # mean score of concatenated quality lines with newlines
+    sums, lens = quality_sums(fwd_batch)
+    if rev_batch is not None:
+        rev_sums, rev_lens = quality_sums(rev_batch)
+        sums += rev_sums
+        lens += rev_lens
+    index['qual'] = sums / lens
+
+    fwd_keys = _key_parts(fwd_batch)
+    if rev_batch is None:
+        # empty reverse read, as with hash_read_pair()'s defaults
+        rev_keys = ([b''] * len(index), [b''] * len(index))
+    else:
+        rev_keys = _key_parts(rev_batch)
+    if fwd_keys is None or rev_keys is None:
+        # odd whitespace somewhere, do it the slow way
+        fwd_heads, fwd_seqs = lines(fwd_batch, 0, 1)
+        if rev_batch is None:
+            rev_heads, rev_seqs = rev_keys
+        else:
+            rev_heads, rev_seqs = lines(rev_batch, 0, 1)
+        index['hash'] = [
+            hash_read_pair(fh, fs, rh, rs, hash_fun=hash_fun)
+            for fh, fs, rh, rs
+            in zip(fwd_heads, fwd_seqs, rev_heads, rev_seqs)
+        ]
+    else:
+        # same as hash_read_pair() but with slices prepared in bulk
+        join = b':'.join
+        index['hash'] = [
+            hash_fun(join(i)) for i in zip(*fwd_keys, *rev_keys)
+        ]
+    return index
+
+
+_WHITESPACE = numpy.frombuffer(b' \t\n\r\x0b\x0c', dtype=numpy.uint8)
+
+
+def _key_parts(batch):
+    """
+    Get the header and sequence parts of the read hash keys of a batch
+
+    :return: Tuple of two lists, the headers cut after the fourth field, and
+             the sequences.  Returns None if leading or trailing whitespace
+             is found, in which case the hash keys need to be made by
+             hash_read_pair() which strips them.
+    """
+    _, data, newlines = batch
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+    starts, ends = line_bounds(newlines)
+    head_starts = starts[0::4]
+    head_ends = ends[0::4]
+    seq_starts = starts[1::4]
+    seq_ends = ends[1::4]
+
+    # find fourth colon in headers
+    colons = numpy.flatnonzero(buf == ord(':'))
+    fourth = numpy.searchsorted(colons, head_starts) + 3
+    found = fourth < len(colons)
+    key_ends = head_ends.copy()
+    key_ends[found] = numpy.minimum(colons[fourth[found]], head_ends[found])
+
+    # check for whitespace that would need stripping
+    edges = []
+    for s, e in [(head_starts, key_ends), (seq_starts, seq_ends)]:
+        nonempty = e > s
+        edges.append(buf[s[nonempty]])
+        edges.append(buf[e[nonempty] - 1])
+    if numpy.isin(numpy.concatenate(edges), _WHITESPACE).any():
+        return None
+
+    return (
+        [data[s:e] for s, e in zip(head_starts.tolist(), key_ends.tolist())],
+        [data[s:e] for s, e in zip(seq_starts.tolist(), seq_ends.tolist())],
+    )
+
+
+class SortedRuns():
+    """
+    Sorted runs of records stored in temporary files
+
+    This is used for external sorting when data does not fit into the memory
+    budget.  Each run is a sorted numpy array of records written raw to a file.
+    The runs are merged by batches() or sorted_batches(), which yield the
+    records in batches in order of the key.
+    """
+    def __init__(self, dtype, tmpdir, field=None):
+        """
+        :param dtype: numpy dtype of the records
+        :param tmpdir: Directory in which to store the runs
+        :param str field: Name of the field by which to sort, for structured
+                          dtypes.  If None, the records themselves are the
+                          sort key.
+        """
+        if tmpdir is None:
+            raise ValueError('A directory for temporary files is required')
+        self.dtype = numpy.dtype(dtype)
+        self.tmpdir = str(tmpdir)
+        self.field = field
+        self.paths = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def key(self, records):
+        if self.field is None:
+            return records
+        return records[self.field]
+
+    def add(self, records):
+        """
+        Sort records and write them as a new run
+        """
+        if self.field is None:
+            records = numpy.sort(records)
+        else:
+            records = records[numpy.argsort(records[self.field])]
+        fd, path = mkstemp(suffix='.run', dir=self.tmpdir)
+        with open(fd, 'wb') as f:
+            records.tofile(f)
+        self.paths.append(path)
+        self.count += len(records)
+
+    def extend(self, other):
+        """
+        Take over the runs of other SortedRuns object
+        """
+        if other.dtype != self.dtype:
+            raise ValueError('Can not combine runs of different dtype')
+        self.paths += other.paths
+        self.count += other.count
+
+    def remove(self):
+        """
+        Delete the run files
+        """
+        for i in self.paths:
+            os.remove(i)
+        self.paths = []
+        self.count = 0
+
+    def batches(self, max_memory=None):
+        """
+        Merge the runs, yielding batches of records
+
+        :param int max_memory: Approximate memory budget in bytes for the
+                               buffered records.
+
+        The batches are yielded in sorted order but each batch itself is not
+        sorted.  Records with equal keys always go into the same batch.  A
+        batch holds all buffered records with a key smaller than the smallest
+        last key of the buffers of not-yet-exhausted runs.
+        """
+        if not self.paths:
+            return
+        if max_memory is None:
+            max_memory = 64 * 1024 * 1024
+        block = max(max_memory // (2 * len(self.paths) * self.dtype.itemsize),
+                    1024)
+
+        files = [open(i, 'rb') for i in self.paths]
+        try:
+            bufs = [numpy.empty(0, dtype=self.dtype) for _ in files]
+            eof = [False for _ in files]
+
+            def read(i):
+                data = numpy.fromfile(files[i], dtype=self.dtype, count=block)
+                if len(data) < block:
+                    eof[i] = True
+                bufs[i] = numpy.concatenate([bufs[i], data])
+
+            while True:
+                for i in range(len(files)):
+                    if not eof[i] and len(bufs[i]) == 0:
+                        read(i)
+
+                lasts = [
+                    self.key(bufs[i])[-1]
+                    for i in range(len(files))
+                    if not eof[i]
+                ]
+                if lasts:
+                    bound = min(lasts)
+                    cuts = [
+                        numpy.searchsorted(self.key(i), bound) for i in bufs
+                    ]
+                else:
+                    # all runs exhausted, take all
+                    cuts = [len(i) for i in bufs]
+
+                if sum(cuts) == 0:
+                    if not lasts:
+                        # all done
+                        break
+                    # buffers full of the bound key, need more data
+                    for i in range(len(files)):
+                        if not eof[i] and self.key(bufs[i])[-1] == bound:
+                            read(i)
+                    continue
+
+                yield numpy.concatenate([
+                    buf[:cut] for buf, cut in zip(bufs, cuts)
+                ])
+                bufs = [buf[cut:] for buf, cut in zip(bufs, cuts)]
+        finally:
+            for i in files:
+                i.close()
+
+    def sorted_batches(self, max_memory=None):
+        """
+        Merge the runs, yielding sorted batches of records
+        """
+        for batch in self.batches(max_memory):
+            yield batch[numpy.argsort(self.key(batch))]
+
+
+def count_lines(path, start, end):
+    """
+    Count the newlines in the given byte range of a file
+    """
+    count = 0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            buf = f.read(min(BLOCK_SIZE, remaining))
+            if not buf:
+                break
+            count += buf.count(b'\n')
+            remaining -= len(buf)
+    return count
+
+
+def find_line(path, start, n):
+    """
+    Get the offset just past the n-th newline counted from start
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while True:
+            buf = f.read(BLOCK_SIZE)
+            if not buf:
+                raise RuntimeError('Unexpected end of file: {}'.format(path))
+            count = buf.count(b'\n')
+            if count < n:
+                n -= count
+                pos += len(buf)
+                continue
+            i = -1
+            for _ in range(n):
+                i = buf.find(b'\n', i + 1)
+            return pos + i + 1
+
+
+def _run_all(fn, arg_list, executor=None):
+    """
+    Helper to call function for each args tuple, optionally via executor
+
+    Returns list of results in order of the given arguments.
+    """
+    if executor is None:
+        return [fn(*i) for i in arg_list]
+    futs = [executor.submit(fn, *i) for i in arg_list]
+    return [i.result() for i in futs]
+
+
+def split_records(paths, num_chunks, lines_per_record=4, executor=None):
+    """
+    Split files of corresponding records into chunks
+
+    :param list paths: Paths to files with the same number of records, e.g.
+                       forward and reverse reads.
+    :param int num_chunks: The wanted number of chunks.  Fewer chunks are
+                           returned for files with few records.
+    :param int lines_per_record: Number of lines per record.
+    :param executor: A concurrent.futures.Executor object to do the IO work.
+
+    :return: List of chunks, each a tuple of (start, end) byte ranges, one
+             range for each input file.
+
+    Chunk boundaries are found by counting lines, not by looking at the data,
+    so a quality score line starting with @ can't confuse the split.
+    """
+    sizes = [os.path.getsize(i) for i in paths]
 
-        # set positions for next read
-        fwd_read_pos = fwd_in.tell()
-        total_count += 1
+    # count lines in equally-sized pieces of each file
+    breaks = [
+        numpy.linspace(0, size, num=num_chunks + 1, dtype=int).tolist()
+        for size in sizes
+    ]
+    counts = _run_all(
+        count_lines,
+        [
+            (path, brks[i], brks[i + 1])
+            for path, brks in zip(paths, breaks)
+            for i in range(num_chunks)
+        ],
+        executor,
+    )
+    cum_lines = [
+        numpy.cumsum([0] + counts[k * num_chunks:(k + 1) * num_chunks])
+        for k in range(len(paths))
+    ]
+
+    totals = [i[-1] for i in cum_lines]
+    if len(set(totals)) > 1:
+        raise RuntimeError('Files have different number of lines: {}'
+                           ''.format(', '.join(map(str, paths))))
+    num_records = totals[0] // lines_per_record
+
+    # record boundaries as line numbers, then get their offsets in each file
+    lines = sorted(set(
+        (k * num_records // num_chunks) * lines_per_record
+        for k in range(1, num_chunks)
+    ) - {0})
+    find_args = []
+    for path, brks, cum in zip(paths, breaks, cum_lines):
+        for line in lines:
+            # i is the piece containing the line-th newline
+            i = numpy.searchsorted(cum, line) - 1
+            find_args.append((path, brks[i], int(line - cum[i])))
+    offsets = _run_all(find_line, find_args, executor)
+
+    ranges = []
+    for k, size in enumerate(sizes):
+        offs = [0] + offsets[k * len(lines):(k + 1) * len(lines)] + [size]
+        ranges.append(list(zip(offs[:-1], offs[1:])))
+    return list(zip(*ranges))
+
+
+def build_filter(index, threads=1, max_memory=None, tmpdir=None,
+                 update=None):
+    """
+    Get sorted file offsets of the reads to be removed
+
+    :param index: Duplicate index as returned by find_duplicates()
+    :param int threads: Number of threads to use.  With more than one thread
+                        the index is partitioned by hash prefix and the
+                        partitions are processed in parallel.  Reads with
+                        equal hashes always end up in the same partition.
+    :param int max_memory: Memory budget in bytes, used if the index is
+                           stored out-of-core.
+    :param tmpdir: Directory for temporary files, required for out-of-core
+                   indices.
+    :param update: An IndexUpdate object.  If given, reads are also checked
+                   against the saved index of earlier runs and the saved index
+                   is updated.
+
+    :return: The index records of the replicated reads, sorted by forward
+             read offset, as numpy array, or, for out-of-core indices, as
+             SortedRuns object.
+    """
+    if isinstance(index, SortedRuns):
+        refuse = _build_filter_ext(index, max_memory, tmpdir, update)
+    elif threads > 1:
+        # number of hash prefix bits to get about 4 partitions per thread
+        bits = (4 * threads).bit_length()
+        prefix = index['hash'] >> numpy.uint64(64 - bits)
+        order = numpy.argsort(prefix, kind='stable')
+        bounds = numpy.searchsorted(prefix[order], numpy.arange(2 ** bits + 1))
+        del prefix
+        with ThreadPoolExecutor(max_workers=threads) as te:
+            parts = list(te.map(
+                lambda i: _resolve(index[order[bounds[i]:bounds[i + 1]]],
+                                   update),
+                range(2 ** bits),
+            ))
+        del order
+        refuse = []
+        # partitions are in hash order, as required to update the index
+        for part_refuse, additions, superseded in parts:
+            refuse.append(part_refuse)
+            if update is not None:
+                update.feed(additions, superseded)
+        refuse = numpy.concatenate(refuse)
+    else:
+        refuse, additions, superseded = _resolve(index, update)
+        if update is not None:
+            update.feed(additions, superseded)
 
-    return data, total_count
+    if update is not None:
+        update.finish()
 
+    if isinstance(refuse, SortedRuns):
+        return refuse
+    return refuse[numpy.argsort(refuse['pos'])]
 
-def mean_quality_score(score):
+
+def _build_filter_ext(index, max_memory, tmpdir, update=None):
+    """
+    Get offsets of reads to be removed, out-of-core implementation
+
+    The runs of the index are merged by hash and the records of replicated
+    reads are collected.  If those don't fit into the memory budget then they
+    are in turn written out as runs sorted by offset.  The index runs are
+    removed.
+    """
+    if max_memory is None:
+        max_records = None
+    else:
+        max_records = max(max_memory // _RECORD_COST, 1)
+    refuse = SortedRuns(INDEX_DTYPE, tmpdir, field='pos')
+    buf = []
+    count = 0
+    for batch in index.batches(max_memory):
+        dupes, additions, superseded = _resolve(batch, update)
+        if update is not None:
+            update.feed(additions, superseded)
+        buf.append(dupes)
+        count += len(dupes)
+        if max_records is not None and count >= max_records:
+            refuse.add(numpy.concatenate(buf))
+            buf = []
+            count = 0
+    index.remove()
+
+    if buf:
+        buf = numpy.concatenate(buf)
+    else:
+        buf = numpy.empty(0, dtype=INDEX_DTYPE)
+
+    if refuse.paths:
+        if len(buf):
+            refuse.add(buf)
+        return refuse
+    else:
+        return buf
+
+
+def _resolve(index, update=None):
     """
-    :param bytes score: Byte string encoding the score
+    Find the replicated reads in (part of) the index
+
+    The index is sorted by hash, then by descending quality and offset, so that
+    the first read of each group of equal hashes is the one with the highest
+    quality score, or, in case of a tie, the earliest in the file.  The
+    remaining reads of a group are duplicates.  If an IndexUpdate is given,
+    the best reads are further checked against the saved index.
+
+    :return: Tuple of the unsorted records of replicated reads, and the
+             additions to and superseded records of the saved index, see
+             IndexUpdate.resolve().  The latter two are None if no update is
+             given.
+    """
+    order = numpy.lexsort((index['pos'], -index['qual'], index['hash']))
+    hashes = index['hash'][order]
+    dupe = numpy.zeros(len(order), dtype=bool)
+    numpy.equal(hashes[1:], hashes[:-1], out=dupe[1:])
+    del hashes
+    if update is None:
+        return index[order[dupe]], None, None
+
+    bests = index[order[~dupe]]
+    dropped, additions, superseded = update.resolve(bests)
+    refuse = numpy.concatenate([index[order[dupe]], bests[dropped]])
+    return refuse, additions, superseded
+
+
+SAVED_INDEX_MAGIC = b'omics derep index\n'
+SAVED_INDEX_VERSION = 1
+SAVED_INDEX_COLUMNS = [('hash', 'u8'), ('qual', 'f4'), ('src', 'u2')]
+SAVED_DTYPE = numpy.dtype(SAVED_INDEX_COLUMNS)
+""" Record layout of saved indices, the file itself is column-oriented """
+
+
+class SavedIndex():
+    """
+    Persistent index of the read pairs of earlier derep runs
+
+    For each distinct read pair hash the index stores the best quality score
+    seen and the source, i.e. the run, in which it was seen.
+
+    The file starts with a magic line and a JSON header line, followed by the
+    hash, quality, and source columns, each stored contiguously and sorted by
+    hash.  The columns are memory-mapped, so loading is nearly instant and
+    look-ups only touch the pages a binary search needs.
+    """
+    def __init__(self, hash_algorithm, sources=(), columns=None):
+        """
+        Create a new, empty index, use load() to get a saved index
+        """
+        self.hash_algorithm = hash_algorithm
+        self.sources = list(sources)
+        if columns is None:
+            columns = {
+                name: numpy.empty(0, dtype=dt)
+                for name, dt in SAVED_INDEX_COLUMNS
+            }
+        self.hash = columns['hash']
+        self.qual = columns['qual']
+        self.src = columns['src']
+
+    def __len__(self):
+        return len(self.hash)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load (memory-map) a saved index file
+        """
+        with open(path, 'rb') as f:
+            if f.readline() != SAVED_INDEX_MAGIC:
+                raise RuntimeError('Not a derep index file: {}'.format(path))
+            try:
+                header = json.loads(f.readline().decode())
+            except ValueError as e:
+                raise RuntimeError('Failed to parse index file header: {}: '
+                                   '{}'.format(path, e))
+        if header.get('version') != SAVED_INDEX_VERSION:
+            raise RuntimeError('Unsupported derep index version: {}: {}'
+                               ''.format(path, header.get('version')))
+
+        count = header['count']
+        offset = header['offset']
+        columns = {}
+        for name, dt in SAVED_INDEX_COLUMNS:
+            if count:
+                columns[name] = numpy.memmap(path, dtype=dt, mode='r',
+                                             offset=offset, shape=(count,))
+            else:
+                # can't mmap zero bytes
+                columns[name] = numpy.empty(0, dtype=dt)
+            offset += count * numpy.dtype(dt).itemsize
+        return cls(header['hash'], header['sources'], columns)
+
+    def records(self, start=0, stop=None):
+        """
+        Get slice of the index as SAVED_DTYPE array
+        """
+        if stop is None:
+            stop = len(self)
+        ret = numpy.empty(stop - start, dtype=SAVED_DTYPE)
+        ret['hash'] = self.hash[start:stop]
+        ret['qual'] = self.qual[start:stop]
+        ret['src'] = self.src[start:stop]
+        return ret
+
+
+class SavedIndexWriter():
+    """
+    Write a saved index from records fed in hash order
+
+    The columns are collected in temporary files and the new index is
+    assembled next to the index file when closing.  It only replaces the
+    index file on commit(), atomically, so a saved index that is still mapped
+    stays valid.  A left-over new index of a failed run gets overwritten by
+    the next one.
     """
-    return sum(score) / len(score)
+    def __init__(self, path, hash_algorithm, sources, tmpdir):
+        self.path = Path(path)
+        self.hash_algorithm = hash_algorithm
+        self.sources = list(sources)
+        self.count = 0
+        self.tmp_path = self.path.with_name(self.path.name + '.tmp')
+        self.columns = {}
+        for name, _ in SAVED_INDEX_COLUMNS:
+            fd, colpath = mkstemp(suffix='.' + name, dir=str(tmpdir))
+            self.columns[name] = (colpath, open(fd, 'w+b'))
+
+    def write(self, records):
+        for name, _ in SAVED_INDEX_COLUMNS:
+            records[name].tofile(self.columns[name][1])
+        self.count += len(records)
+
+    def close(self):
+        header = {
+            'version': SAVED_INDEX_VERSION,
+            'hash': self.hash_algorithm,
+            'sources': self.sources,
+            'count': self.count,
+        }
+        # data offset, aligned to 64 bytes, depends on header line length
+        offset = 0
+        while True:
+            header['offset'] = offset
+            head = SAVED_INDEX_MAGIC + json.dumps(header).encode() + b'\n'
+            if len(head) <= offset:
+                break
+            offset = (len(head) // 64 + 1) * 64
+
+        with self.tmp_path.open('wb') as f:
+            f.write(head.ljust(offset, b' '))
+            for name, _ in SAVED_INDEX_COLUMNS:
+                colpath, colfile = self.columns[name]
+                colfile.flush()
+                copy_range(colfile, f, 0)
+                colfile.close()
+                os.remove(colpath)
+
+    def commit(self):
+        """
+        Replace the index file with the new index written by close()
+        """
+        self.tmp_path.replace(self.path)
+
+
+class IndexUpdate():
+    """
+    Check reads against a saved index and write the updated index
+
+    Reads whose hash is in the saved index are replicates of reads from an
+    earlier run.  They are removed unless their quality score is higher, in
+    which case they supersede the earlier read in the saved index.  The
+    superseded records of earlier reads are collected in the superseded
+    attribute.
+    """
+    def __init__(self, saved, writer, source):
+        """
+        :param SavedIndex saved: The index of earlier runs
+        :param SavedIndexWriter writer: Writer for the updated index
+        :param int source: Source id for the current reads
+        """
+        self.saved = saved
+        self.writer = writer
+        self.source = source
+        self.superseded = []
+        self._pos = 0  # first saved record not yet written
+
+    def resolve(self, bests):
+        """
+        Check best reads of each group against the saved index
+
+        :param bests: Index records of the best read of each hash group,
+                      sorted by hash.
+
+        :return: Tuple of boolean mask of reads to be removed, records to be
+                 added to the saved index, and saved records that are
+                 superseded.
+        """
+        saved_hash = self.saved.hash
+        pos = numpy.searchsorted(saved_hash, bests['hash'])
+        hit = numpy.zeros(len(bests), dtype=bool)
+        inside = pos < len(saved_hash)
+        hit[inside] = saved_hash[pos[inside]] == bests['hash'][inside]
+        better = numpy.zeros(len(bests), dtype=bool)
+        better[hit] = bests['qual'][hit] > self.saved.qual[pos[hit]]
+        dropped = hit & ~better
+
+        keep = bests[~dropped]
+        additions = numpy.empty(len(keep), dtype=SAVED_DTYPE)
+        additions['hash'] = keep['hash']
+        additions['qual'] = keep['qual']
+        additions['src'] = self.source
+
+        superseded = numpy.empty(better.sum(), dtype=SAVED_DTYPE)
+        superseded['hash'] = self.saved.hash[pos[better]]
+        superseded['qual'] = self.saved.qual[pos[better]]
+        superseded['src'] = self.saved.src[pos[better]]
+
+        return dropped, additions, superseded
+
+    def feed(self, additions, superseded):
+        """
+        Write additions merged with the saved records up to the same hash
+
+        Additions must be fed in hash order.
+        """
+        if len(superseded):
+            self.superseded.append(superseded)
+        if not len(additions):
+            return
+        stop = numpy.searchsorted(self.saved.hash, additions['hash'][-1],
+                                  side='right')
+        self._write_merged(stop, additions)
+
+    def finish(self):
+        """
+        Write remaining saved records and close the writer
+        """
+        self._write_merged(len(self.saved))
+        self.writer.close()
+
+    def _write_merged(self, stop, additions=None):
+        """
+        Write saved records up to stop, merged with given additions
+        """
+        for start in range(self._pos, stop, BATCH_RECORDS):
+            saved = self.saved.records(start, min(start + BATCH_RECORDS, stop))
+            if additions is not None and len(additions):
+                if start + BATCH_RECORDS >= stop:
+                    cut = len(additions)
+                else:
+                    cut = numpy.searchsorted(additions['hash'],
+                                             saved['hash'][-1], side='right')
+                part = additions[:cut]
+                additions = additions[cut:]
+                # superseded saved records get replaced
+                saved = saved[~numpy.isin(saved['hash'], part['hash'])]
+                saved = numpy.concatenate([saved, part])
+                saved = saved[numpy.argsort(saved['hash'], kind='stable')]
+            self.writer.write(saved)
+        if additions is not None and len(additions):
+            self.writer.write(additions)
+        self._pos = max(self._pos, stop)
+
+
+def find_optical(index, fwd_in, distance, max_memory=None):
+    """
+    Find optical duplicates among the replicated reads
+
+    Within each group of replicated reads, reads on the same tile whose x and
+    y coordinates both differ by at most the given distance are considered
+    optical (or clustering) duplicates of each other.  Of each such cluster
+    one read counts as the replicated read, which is the kept read if it is in
+    the cluster, and the others are optical duplicates.  Only the headers of
+    replicated reads are parsed.  Reads are put into a per-tile grid of cells
+    the size of the distance, so neighbours are searched only in adjacent
+    cells.
+
+    :param index: The duplicate index, as returned by find_duplicates()
+    :param fwd_in: The forward reads file, which must have Illumina headers
+    :param int distance: Maximum pixel distance in x and y direction
+    :param int max_memory: Memory budget, used for out-of-core indices
+
+    :return: Tuple of the index records of the optical duplicates, sorted by
+             forward read offset, and the list of their headers.
+    """
+    if distance < 1:
+        raise ValueError('distance must be a positive integer')
+    if isinstance(index, SortedRuns):
+        batches = index.batches(max_memory)
+    else:
+        batches = [index]
+
+    if not is_regular_file(fwd_in):
+        raise ValueError('Regular, uncompressed input file required')
+    if os.fstat(fwd_in.fileno()).st_size == 0:
+        return numpy.empty(0, dtype=INDEX_DTYPE), []
+
+    parts = [numpy.empty(0, dtype=INDEX_DTYPE)]
+    with mmap.mmap(fwd_in.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for batch in batches:
+            parts.append(_optical_batch(batch, mm, distance))
+        optical = numpy.concatenate(parts)
+        optical = optical[numpy.argsort(optical['pos'])]
+        headers = [_header(mm, pos) for pos in optical['pos'].tolist()]
+    return optical, headers
+
+
+def _header(mm, pos):
+    """
+    Get the header line of the record at pos
+    """
+    end = mm.find(b'\n', pos)
+    return mm[pos:end if end >= 0 else len(mm)].rstrip()
+
+
+def _optical_batch(index, mm, distance):
+    """
+    Find optical duplicates in a batch of index records with complete groups
+    """
+    # best read first in each group, as for _resolve()
+    order = numpy.lexsort((index['pos'], -index['qual'], index['hash']))
+    hashes = index['hash'][order]
+    starts = numpy.flatnonzero(numpy.diff(hashes)) + 1
+    starts = numpy.concatenate([[0], starts])
+    sizes = numpy.diff(numpy.append(starts, len(order)))
+    del hashes
+
+    # coordinates of reads in groups with replicates
+    multi = numpy.repeat(sizes > 1, sizes)
+    members = order[multi]
+    coords = numpy.array(
+        [parse_read_coordinates(_header(mm, pos))
+         for pos in index['pos'][members].tolist()],
+        dtype=numpy.int64,
+    ).reshape(-1, 3)
+    sizes = sizes[sizes > 1]
+    starts = numpy.cumsum(sizes) - sizes
+
+    optical = numpy.zeros(len(members), dtype=bool)
 
+    # pairs, the common case, done in bulk
+    pairs = starts[sizes == 2]
+    near = (
+        (coords[pairs, 0] == coords[pairs + 1, 0])
+        & (numpy.abs(coords[pairs, 1:] - coords[pairs + 1, 1:])
+           <= distance).all(axis=1)
+    )
+    optical[pairs[near] + 1] = True
+
+    for start, size in zip(starts[sizes > 2].tolist(),
+                           sizes[sizes > 2].tolist()):
+        optical[start:start + size] = \
+            _optical_group(coords[start:start + size].tolist(), distance)
+
+    return index[members[optical]]
 
-def build_filter(data):
+
+def _optical_group(coords, distance):
     """
-    Transform data from hash-indexed to set of read positions
+    Mark optical duplicates in a group of reads, best read first
+
+    :param list coords: List of (tile, x, y) tuples
+
+    :return: List of bool, True for optical duplicates
+
+    Clusters are grown from the reads in given order, the first read of each
+    cluster is not an optical duplicate.
     """
-    refuse = set()
-    for _, pos_list in data.values():
-        for i in pos_list[1:]:
-            refuse.add(i)
-    return refuse
+    grid = {}
+    for i, (tile, x, y) in enumerate(coords):
+        grid.setdefault((tile, x // distance, y // distance), []).append(i)
+
+    ret = [False] * len(coords)
+    seen = [False] * len(coords)
+    for first in range(len(coords)):
+        if seen[first]:
+            continue
+        seen[first] = True
+        todo = [first]
+        while todo:
+            i = todo.pop()
+            tile, x, y = coords[i]
+            cx, cy = x // distance, y // distance
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for j in grid.get((tile, cx + dx, cy + dy), ()):
+                        if seen[j]:
+                            continue
+                        if abs(coords[j][1] - x) <= distance \
+                                and abs(coords[j][2] - y) <= distance:
+                            seen[j] = True
+                            ret[j] = True
+                            todo.append(j)
+    return ret
 
 
 def filter_write(refuse, fwd_in, rev_in, fwd_out, rev_out, check=False,
-                 dupe_file=None):
+                 dupe_file=None, progress=None, total_records=None):
     """
     Write out filtered data
 
-    :param set refuse: Set of file offset positions of the read headers @ of
-                       duplicated reads in the forward reads file.
+    :param refuse: Index records of the replicated reads sorted by forward
+                   read offset, as returned by build_filter().
+    :param dupe_file: Binary file-like object to which to write the header and
+                      hash of each replicated read.
+    :param Progress progress: Progress object, which is updated with the
+                              processed bytes of the forward reads file and
+                              the number of processed records.
+    :param int total_records: Number of records in the input.  Records that
+                              are kept are not parsed, so with progress the
+                              number of processed records is estimated from
+                              the processed bytes, if the total size is known.
+
+    The records to be kept are copied as byte ranges between the replicated
+    reads, see copy_range(), without parsing them.
     """
-    if rev_in is None or rev_out is None:
-        raise NotImplementedError('Single reads processing not implemented')
+    if (rev_in is None) != (rev_out is None):
+        raise ValueError('rev_in and rev_out must both be given or be None')
+
+    if isinstance(refuse, SortedRuns):
+        batches = refuse.sorted_batches()
+    else:
+        batches = [refuse]
+
+    def advance(done):
+        records = None
+        if total_records is not None and progress.total:
+            records = min(total_records * done // progress.total,
+                          total_records)
+        progress.update(done, records)
+
+    def copy_fwd(start, end=None):
+        if progress is None or not is_regular_file(fwd_in):
+            copy_range(fwd_in, fwd_out, start, end)
+            return
+        if end is None:
+            end = os.fstat(fwd_in.fileno()).st_size
+        for i in range(start, end, WRITE_CHUNK_SIZE):
+            copy_range(fwd_in, fwd_out, i, min(i + WRITE_CHUNK_SIZE, end))
+            advance(min(i + WRITE_CHUNK_SIZE, end))
+
+    fwd_pos = fwd_in.tell()
+    if rev_in is None:
+        # single-end or interleaved: a record spans both lengths
+        rev_pos = None
+    else:
+        rev_pos = rev_in.tell()
+    for batch in batches:
+        for pos, length, rpos, rlen, hash_ in zip(
+                batch['pos'].tolist(), batch['len'].tolist(),
+                batch['rpos'].tolist(), batch['rlen'].tolist(),
+                batch['hash'].tolist()):
+            copy_fwd(fwd_pos, pos)
+            if rev_in is None:
+                fwd_pos = pos + length + rlen
+            else:
+                copy_range(rev_in, rev_out, rev_pos, rpos)
+                fwd_pos = pos + length
+                rev_pos = rpos + rlen
+            if progress is not None:
+                advance(fwd_pos)
+
+            if check or dupe_file is not None:
+                fh = _pread(fwd_in, min(length, 4096), pos)
+                fh = fh.partition(b'\n')[0]
+                if rlen:
+                    rh = _pread(fwd_in if rev_in is None else rev_in, 1, rpos)
+                else:
+                    rh = b'@'
+                if not fh[:1] == rh == b'@':
+                    raise RuntimeError('Fastq header expected but found:\n{}'
+                                       '\n{}'.format(fh, rh))
 
-    pos = fwd_in.tell()
-    for (fh, rh), (fs, rs), (fp, rp), (fq, rq) in read_groups(fwd_in, rev_in):
-        if pos in refuse:
             if dupe_file is not None:
-                hash_ = hash_read_pair(fh, fs, rh, rs)
-                hash_ = hash_.to_bytes(length=8, byteorder='big', signed=True)
-                hash_ = hexlify(hash_)
+                hash_ = hexlify(hash_.to_bytes(length=8, byteorder='big'))
                 dupe_file.write(fh.rstrip() + b'\t' + hash_ + b'\n')
+
+    copy_fwd(fwd_pos)
+    if rev_in is not None:
+        copy_range(rev_in, rev_out, rev_pos)
+    if progress is not None:
+        if is_regular_file(fwd_in):
+            progress.update(os.fstat(fwd_in.fileno()).st_size, total_records)
         else:
-            fwd_out.write(fh + fs + fp + fq)
-            rev_out.write(rh + rs + rp + rq)
+            progress.update(fwd_in.tell(), total_records)
 
-        if check:
-            if not fh[0] == rh[0] == ord('@'):
-                raise RuntimeError('Fastq header expected but found:\n{}\n{}'
-                                   ''.format(fh, rh))
 
-            if not fp == rp == b'+\n':
-                raise RuntimeError('Plus separator expected but found:\n{}\n{}'
-                                   ''.format(fp, rp))
+def _pread(file, size, pos):
+    """
+    Read size bytes at pos, for streams pos must not be behind the current
+    position
+    """
+    if is_regular_file(file):
+        return os.pread(file.fileno(), size, pos)
+    cur = file.tell()
+    if pos < cur:
+        raise ValueError('Can not go back in input stream {} from {} to {}'
+                         ''.format(file.name, cur, pos))
+    while cur < pos:
+        skipped = len(file.read(min(pos - cur, BLOCK_SIZE)))
+        if not skipped:
+            return b''
+        cur += skipped
+    return file.read(size)
 
-        pos = fwd_in.tell()
+
+def _output_path(path, out_dir, infix):
+    """
+    Get output file path, keeping any compression suffix last
+
+    E.g. reads.fastq.gz gives <out_dir>/reads<infix>.fastq.gz
+    """
+    path, comp_suffix = strip_compression_suffix(path)
+    return out_dir / (path.stem + infix + path.suffix + comp_suffix)
+
+
+def parse_size(text):
+    """
+    Parse memory size string with optional K, M, G, or T suffix into bytes
+    """
+    m = re.fullmatch(r'\s*(\d+(\.\d*)?)\s*([kmgt]?)i?b?\s*', text, re.I)
+    if m is None:
+        raise argparse.ArgumentTypeError('invalid size: {}'.format(text))
+    num, _, unit = m.groups()
+    return int(float(num) * 1024 ** ' kmgt'.index(unit.lower() or ' '))
 
 
 def main(argv=None, namespace=None):
     argp = get_argparser(
         prog=__loader__.name.replace('.', ' '),
         description=__doc__,
-        threads=False,
     )
     argp.add_argument('forward_reads', type=argparse.FileType())
-    argp.add_argument('reverse_reads', type=argparse.FileType())
+    argp.add_argument(
+        'reverse_reads',
+        nargs='?',
+        type=argparse.FileType(),
+        help='The reverse reads file.  Without it the forward reads file is '
+             'processed as single-end reads or, with --interleaved, as '
+             'interleaved paired-end reads.',
+    )
+    argp.add_argument(
+        '--interleaved',
+        action='store_true',
+        help='The forward reads file holds interleaved read pairs.  Read '
+             'pairs are hashed the same way as when given in separate files.',
+    )
     argp.add_argument(
         '-c', '--check',
         action='store_true',
@@ -215,48 +1566,290 @@ def main(argv=None, namespace=None):
         help='If provided, the list of replicated reads is written to the '
              'given file.',
     )
+    argp.add_argument(
+        '--hash',
+        choices=HASH_ALGORITHMS,
+        default=DEFAULT_HASH,
+        help='The hash algorithm used to identify replicated reads.  By '
+             'default the fast xxh3 hash is used if the xxhash package is '
+             'installed and blake2b otherwise.  The hashes are stable across '
+             'runs and are written to the replicates list.',
+    )
+    argp.add_argument(
+        '--max-memory',
+        metavar='SIZE',
+        type=parse_size,
+        default=None,
+        help='Approximate memory budget for the duplicate index, e.g. 500M or '
+             '8G.  If the index grows beyond this size, sorted parts of the '
+             'index are written to temporary files and merged later.  By '
+             'default the whole index is kept in memory.',
+    )
+    argp.add_argument(
+        '--temp-dir',
+        metavar='PATH',
+        default=None,
+        help='Directory for temporary files.  The system default is used '
+             'unless this option is given.',
+    )
+    argp.add_argument(
+        '--index',
+        metavar='PATH',
+        default=None,
+        help='Dereplicate incrementally against a persistent index of the '
+             'reads of earlier runs.  Reads replicating a read of an earlier '
+             'run are removed unless they are of better quality.  The index '
+             'is created if it does not exist and is updated with the reads '
+             'of this run.',
+    )
+    argp.add_argument(
+        '--superseded-list',
+        default=None,
+        metavar='FILE',
+        type=argparse.FileType('w'),
+        help='With --index, write the hash, source, and quality score of '
+             'reads of earlier runs that were superseded by better reads of '
+             'this run to the given file.',
+    )
+    argp.add_argument(
+        '--optical-distance',
+        metavar='PIXELS',
+        type=int,
+        default=None,
+        help='Find optical duplicates, i.e. replicated reads on the same tile '
+             'within the given distance in both x and y direction of each '
+             'other.  Needs Illumina read headers with tile and coordinates.  '
+             'Optical duplicates are counted and listed separately, they are '
+             'removed as any other replicated read.  A typical distance is '
+             '100 for non-patterned and 2500 for patterned flowcells.',
+    )
+    argp.add_argument(
+        '--optical-list',
+        default=None,
+        metavar='FILE',
+        type=argparse.FileType('wb'),
+        help='With --optical-distance, write the header and hash of each '
+             'optical duplicate to the given file.',
+    )
+    argp.add_argument(
+        '--stats',
+        default=None,
+        metavar='FILE',
+        type=argparse.FileType('w'),
+        help='Write statistics, including per-phase timings, throughput, '
+             'and peak memory usage, in JSON format to the given file.',
+    )
     args = argp.parse_args(args=argv, namespace=namespace)
 
+    if args.optical_distance is not None and args.optical_distance < 1:
+        argp.error('The optical distance must be a positive integer')
+    if args.optical_list is not None and args.optical_distance is None:
+        argp.error('The --optical-list option requires --optical-distance')
+
+    if args.interleaved and args.reverse_reads is not None:
+        argp.error('Reverse reads file given but input is interleaved')
+
     out_dir = Path(args.out_dir)
     if not out_dir.is_dir():
         argp.error('Directory does not exist: {}'.out_dir)
 
-    args.forward_reads.close()
-    args.reverse_reads.close()
+    saved = None
+    if args.index is not None:
+        args.index = Path(args.index)
+        if args.index.exists():
+            try:
+                saved = SavedIndex.load(args.index)
+            except (OSError, RuntimeError) as e:
+                argp.error(str(e))
+            if args.hash == DEFAULT_HASH:
+                args.hash = saved.hash_algorithm
+            elif args.hash != saved.hash_algorithm:
+                argp.error('The --hash option conflicts with the hash '
+                           'algorithm of the index: {}'
+                           ''.format(saved.hash_algorithm))
+    elif args.superseded_list is not None:
+        argp.error('The --superseded-list option requires --index')
 
+    try:
+        args.hash, _ = get_hash_function(args.hash)
+    except RuntimeError as e:
+        argp.error(str(e))
+
+    if args.index is not None:
+        if saved is None:
+            saved = SavedIndex(args.hash)
+        # different runs often have the same file name, e.g. fwd.fastq as
+        # made by omics prep
+        source = str(Path(args.forward_reads.name).resolve())
+        if source in saved.sources:
+            argp.error('Reads from {} are already in the index'
+                       ''.format(source))
+
+    args.forward_reads.close()
     fwd_path = Path(args.forward_reads.name)
-    rev_path = Path(args.reverse_reads.name)
+    fwd_in = open_input(fwd_path, threads=args.threads)
+    fwd_out_path = _output_path(fwd_path, out_dir, args.infix)
+    out_paths = [fwd_out_path]
 
-    fwd_in = fwd_path.open('rb')
-    rev_in = rev_path.open('rb')
+    if args.reverse_reads is None:
+        rev_in = None
+        if args.interleaved:
+            kind = 'paired-read'
+        else:
+            kind = 'read'
+    else:
+        args.reverse_reads.close()
+        rev_path = Path(args.reverse_reads.name)
+        rev_in = open_input(rev_path, threads=args.threads)
+        rev_out_path = _output_path(rev_path, out_dir, args.infix)
+        out_paths.append(rev_out_path)
+        kind = 'paired-read'
 
-    data, total_reads = find_duplicates(fwd_in, rev_in, check=args.check)
+    streamed = [
+        i.name for i in [fwd_in, rev_in]
+        if i is not None and not is_regular_file(i)
+    ]
+    if streamed and args.optical_distance is not None:
+        argp.error('The --optical-distance option does not work with '
+                   'compressed input: {}'.format(', '.join(streamed)))
 
     if args.verbosity > DEFAULT_VERBOSITY:
-        print('total paired-read count: {}'.format(total_reads))
+        print('using hash algorithm: {}'.format(args.hash))
+        report_file = sys.stdout
+    else:
+        report_file = None
 
-    refuse = build_filter(data)
+    input_size = sum((os.path.getsize(i.name)
+                      for i in [fwd_in, rev_in] if i is not None))
+    stats = {
+        'input': [str(fwd_path)] + ([] if rev_in is None else [str(rev_path)]),
+        'input_bytes': input_size,
+        'hash_algorithm': args.hash,
+        'threads': args.threads,
+        'max_memory': args.max_memory,
+        'phases': {},
+    }
+    start_time = time.monotonic()
 
-    if args.verbosity > DEFAULT_VERBOSITY:
-        print('replicated paired-reads:', len(refuse))
+    with TemporaryDirectory(prefix='derep.', dir=args.temp_dir) as tmpdir:
+        # no ETA for compressed input, progress counts uncompressed bytes
+        progress = Progress('hashing', total=None if streamed else input_size,
+                            file=report_file)
+        index, total_reads = find_duplicates(
+            fwd_in, rev_in,
+            interleaved=args.interleaved,
+            check=args.check,
+            hash_algorithm=args.hash,
+            threads=args.threads,
+            max_memory=args.max_memory,
+            tmpdir=tmpdir,
+            progress=progress,
+        )
+        stats['phases']['hash'] = progress.finish()
+        stats['reads'] = total_reads
+        stats['spilled'] = isinstance(index, SortedRuns)
 
-    fwd_in.seek(0)
-    rev_in.seek(0)
+        if args.verbosity > DEFAULT_VERBOSITY:
+            print('total {} count: {}'.format(kind, total_reads))
 
-    fwd_out_path = out_dir / (fwd_path.stem + args.infix + fwd_path.suffix)
-    rev_out_path = out_dir / (rev_path.stem + args.infix + rev_path.suffix)
+        if args.optical_distance is not None:
+            progress = Progress('optical')
+            optical, headers = find_optical(index, fwd_in,
+                                            args.optical_distance,
+                                            max_memory=args.max_memory)
+            progress.update(0, len(optical))
+            stats['phases']['optical'] = progress.finish()
+            stats['optical_duplicates'] = len(optical)
+            if args.verbosity > DEFAULT_VERBOSITY:
+                print('optical duplicates:', len(optical))
+            if args.optical_list is not None:
+                for head, hash_ in zip(headers, optical['hash'].tolist()):
+                    args.optical_list.write(head + b'\t' + hexlify(
+                        hash_.to_bytes(length=8, byteorder='big')
+                    ) + b'\n')
+                args.optical_list.close()
+            del optical, headers
 
-    fwd_out = fwd_out_path.open('wb')
-    rev_out = rev_out_path.open('wb')
+        if args.index is None:
+            writer = update = None
+        else:
+            writer = SavedIndexWriter(args.index, args.hash,
+                                      saved.sources + [source], tmpdir)
+            update = IndexUpdate(saved, writer, len(saved.sources))
 
-    if args.verbosity > DEFAULT_VERBOSITY:
-        print('writing dereplicated output to {} and {} ...'
-              ''.format(fwd_out_path, rev_out_path), end='', flush=True)
+        progress = Progress('filter')
+        refuse = build_filter(index, threads=args.threads,
+                              max_memory=args.max_memory, tmpdir=tmpdir,
+                              update=update)
+        del index
+        # the filter goes over the index records of all of the input
+        progress.update(input_size, total_reads)
+        stats['phases']['filter'] = progress.finish()
+        stats['replicated'] = len(refuse)
+
+        if args.verbosity > DEFAULT_VERBOSITY:
+            print('replicated {}s:'.format(kind), len(refuse))
+
+        if update is not None:
+            superseded = update.superseded
+            if superseded:
+                superseded = numpy.concatenate(superseded)
+            stats['superseded'] = len(superseded)
+            if args.verbosity > DEFAULT_VERBOSITY:
+                print('index: {} reads from {} earlier runs, {} superseded'
+                      ''.format(len(saved), len(saved.sources),
+                                len(superseded)))
+            if args.superseded_list is not None:
+                for rec in superseded:
+                    args.superseded_list.write('{:016x}\t{}\t{}\n'.format(
+                        int(rec['hash']),
+                        saved.sources[rec['src']],
+                        rec['qual'],
+                    ))
+                args.superseded_list.close()
+            del update, saved
+
+        # re-open, as compressed input can't seek
+        fwd_in.close()
+        fwd_in = open_input(fwd_path, threads=args.threads)
+        fwd_out = open_output(fwd_out_path, threads=args.threads)
+        if rev_in is None:
+            rev_out = None
+        else:
+            rev_in.close()
+            rev_in = open_input(rev_path, threads=args.threads)
+            rev_out = open_output(rev_out_path, threads=args.threads)
+
+        if args.verbosity > DEFAULT_VERBOSITY:
+            print('writing dereplicated output to {} ...'
+                  ''.format(' and '.join(map(str, out_paths))), flush=True)
+
+        progress = Progress(
+            'writing',
+            total=None if streamed else os.path.getsize(fwd_in.name),
+            file=report_file,
+        )
+        filter_write(refuse, fwd_in, rev_in, fwd_out, rev_out,
+                     dupe_file=args.replicates_list, progress=progress,
+                     total_records=total_reads)
+        fwd_out.close()
+        fwd_in.close()
+        if rev_out is not None:
+            rev_out.close()
+            rev_in.close()
+        stats['phases']['write'] = progress.finish()
+
+        if writer is not None:
+            # add this run to the index only once its output is complete
+            writer.commit()
 
-    filter_write(refuse, fwd_in, rev_in, fwd_out, rev_out,
-                 dupe_file=args.replicates_list)
-    fwd_out.close()
-    rev_out.close()
+    stats['seconds'] = round(time.monotonic() - start_time, 3)
+    stats['peak_rss'] = peak_rss()
+    stats['peak_rss_workers'] = peak_rss(resource.RUSAGE_CHILDREN)
+    if args.stats is not None:
+        json.dump(stats, args.stats, indent=4)
+        args.stats.write('\n')
+        args.stats.close()
 
     if args.verbosity > DEFAULT_VERBOSITY:
         print('done')
@@ -23,6 +23,8 @@ import argparse
 import sys
 
 from . import OmicsArgParser
+from .fileio import open_input, open_output
+from .seqio import FASTQ, check_batch, read_batches, record_bounds
 
 
 def convert(data, output, check=True):
@@ -31,28 +33,29 @@ def convert(data, output, check=True):
 
     :param data: File-like object with input data
     :param output: File-like object for output
+
+    Text mode files are accessed via their underlying binary buffer.
     """
-    state = 0
-    for line in data:
+    if hasattr(data, 'buffer'):
+        data = data.buffer
+    if hasattr(output, 'buffer'):
+        output.flush()
+        output = output.buffer
+    name = getattr(data, 'name', 'input')
+
+    for batch in read_batches(data, lines_per_record=4):
         if check:
-            if state == 0 and not line.startswith('@'):
-                raise RuntimeError('Input not in FASTQ format? Expected line '
-                                   'to start with @: {}'.format(line))
-            elif state == 2 and not line == '+\n':
-                raise RuntimeError('Input not in FASTQ format? Expected + '
-                                   'separator line: {}'.format(line))
-
-        if state == 0:
-            output.write('>' + line[1:])
-        elif state == 1:
-            output.write(line)
-
-        state = (state + 1) % 4
-
-    if state != 0:
-        raise RuntimeError('Input not in FASTQ format? Expected total number '
-                           'of lines to be multiple of 4, last line: {}'
-                           ''.format(line))
+            check_batch(batch, name, FASTQ)
+        view = memoryview(batch[1])
+        starts, _ = record_bounds(batch)
+        # header without the @ plus sequence line
+        seq_ends = batch[2][1::4] + 1
+        chunks = []
+        for start, end in zip((starts + 1).tolist(), seq_ends.tolist()):
+            chunks.append(b'>')
+            chunks.append(view[start:end])
+        output.writelines(chunks)
+    output.flush()
 
 
 def main(argv=None, namespace=None):
@@ -66,17 +69,18 @@ def main(argv=None, namespace=None):
         'inputfile',
         metavar='FILE',
         nargs='?',
-        type=argparse.FileType('r'),
-        default=sys.stdin,
+        type=argparse.FileType('rb'),
+        default=sys.stdin.buffer,
         help='Fastq file to be converted, by default data is read from stdin.'
+             '  Compressed input is detected and decompressed.'
     )
     argp.add_argument(
         '-o', '--output',
         metavar='FILE',
         nargs='?',
-        type=argparse.FileType('w'),
-        default=sys.stdout,
-        help='Name of output filie.  Write to stdout by default.'
+        default=None,
+        help='Name of output filie.  Write to stdout by default.  Output is '
+             'compressed according to the file suffix, e.g. .gz or .xz'
     )
     argp.add_argument(
         '--force', '-f',
@@ -91,7 +95,12 @@ def main(argv=None, namespace=None):
              'the input is indeed in fastq format.',
     )
     args = argp.parse_args(args=argv, namespace=namespace)
-    convert(args.inputfile, args.output, check=args.check)
+    if args.output is None:
+        output = sys.stdout.buffer
+    else:
+        output = open_output(args.output)
+    convert(open_input(args.inputfile), output, check=args.check)
+    output.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,1366 @@
+# Copyright 2026 Regents of The University of Michigan.
+
+# This file is part of geo-omics-scripts.
+
+# Geo-omics-scripts is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+
+# Geo-omics-scripts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+File input/output helpers
+
+Compressed files are detected by their magic bytes and (de-)compressed in a
+helper thread, so that compression overlaps with processing the data.  The
+zlib, bz2, and lzma modules release the GIL while working on large buffers.
+
+Gzip output is written in the blocked BGZF format, see BGZFWriter, with the
+blocks compressed in parallel by a thread pool.  Multi-member gzip files, e.g.
+BGZF, can be decompressed in parallel by a process pool, see gunzip_parallel().
+
+ZstdFrameWriter similarly writes zstd output as independent frames.  Both
+writers can record the offsets of the blocks in a BlockIndex, saved as a
+sidecar file.  Indexed files are decompressed by a pool of threads when opened
+with open_input() and more than one thread.
+
+Run as script, ``python -m omics.fileio FILE``, to benchmark the methods
+copy_range() can use for copying a file.
+"""
+
+import argparse
+import bz2
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import gzip
+import hashlib
+import io
+import lzma
+import mmap
+import os
+from pathlib import Path
+import queue
+import stat
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    # not on Windows
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+IO_CHUNK_SIZE = 1024 * 1024
+QUEUE_CHUNKS = 16  # number of chunks buffered between threads
+
+GZIP = 'gzip'
+BZIP2 = 'bzip2'
+XZ = 'xz'
+ZSTD = 'zstd'
+
+MAGIC = {
+    GZIP: b'\x1f\x8b',
+    BZIP2: b'BZh',
+    XZ: b'\xfd7zXZ\x00',
+    ZSTD: b'\x28\xb5\x2f\xfd',
+}
+
+SUFFIXES = {
+    '.gz': GZIP,
+    '.bgz': GZIP,
+    '.bz2': BZIP2,
+    '.xz': XZ,
+    '.zst': ZSTD,
+}
+
+DEFAULT_LEVEL = {GZIP: 6, BZIP2: 9, XZ: 6, ZSTD: 3}
+
+# BGZF: max. uncompressed data per block, as used by htslib, so that even
+# incompressible data fits the 64k block size limit
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_MAX_BLOCK = 0x10000
+# gzip header with FEXTRA flag and BC subfield holding the block size - 1
+BGZF_HEADER = struct.Struct('<4BI2BH2BHH')
+BGZF_TRAILER = struct.Struct('<II')
+BGZF_EOF = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000'
+)
+
+# parallel decompression: compressed size of chunks handed to workers, and
+# the amount of data to test-inflate at a candidate member start
+GUNZIP_CHUNK_SIZE = 8 * 1024 * 1024
+GZIP_PROBE_SIZE = 16 * 1024
+
+# uncompressed size of the frames written by ZstdFrameWriter
+ZSTD_FRAME_SIZE = 4 * 1024 * 1024
+
+# block index sidecar files, and the compressed size of the chunks of
+# indexed files decompressed in parallel
+INDEX_SUFFIX = {GZIP: '.gzi', ZSTD: '.zsi'}
+INDEXED_CHUNK_SIZE = 1024 * 1024
+
+# Linux ioctl to share data blocks between files, from linux/fs.h
+FICLONERANGE = 0x4020940d
+_FILE_CLONE_RANGE = struct.Struct('qQQQ')
+
+# errors indicating that a system call is not supported for the given files
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL,
+                errno.EBADF, errno.ENOTSUP, errno.ENOTTY)
+
+
+def copy_range(infile, outfile, start, end=None):
+    """
+    Copy a byte range of a file to the current position of another file
+
+    :param infile: Input file object, must be a regular file.
+    :param outfile: Output file object.
+    :param int start: Offset of first byte to copy.
+    :param int end: Offset past the last byte to copy.  By default copy to the
+                    end of the input file.
+
+    :return: Number of bytes copied
+
+    On filesystems supporting reflinks, e.g. btrfs or XFS, the data blocks are
+    shared between the files if the range is aligned to the filesystem's
+    blocks.  Otherwise the data is copied inside the kernel with
+    os.copy_file_range() if possible, or else with os.sendfile().  If neither
+    works, large buffered reads are used.  Any buffered data of outfile is
+    flushed first.  The kernel methods don't work with outfile opened in
+    append mode, see open_append().
+
+    If either file is not a regular file, e.g. a pipe or a compressed stream,
+    then data is copied via read() and write().  In this case an input stream
+    must not be positioned past start, the data up to start is skipped.
+    """
+    if not is_regular_file(infile) or not is_regular_file(outfile):
+        return _copy_stream(infile, outfile, start, end)
+
+    if end is None:
+        end = os.fstat(infile.fileno()).st_size
+    if end <= start:
+        return 0
+
+    outfile.flush()
+    fd_in = infile.fileno()
+    fd_out = outfile.fileno()
+
+    for fn in _copy_funs:
+        try:
+            return fn(fd_in, fd_out, start, end)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+    raise RuntimeError('(internal error) no copy method worked')
+
+
+def _copy_stream(infile, outfile, start, end):
+    """
+    Copy range via read() and write(), for streams
+    """
+    if is_regular_file(infile):
+        fd_in = infile.fileno()
+        offset = start
+        while end is None or offset < end:
+            size = COPY_BUFFER_SIZE
+            if end is not None:
+                size = min(size, end - offset)
+            data = os.pread(fd_in, size, offset)
+            if not data:
+                if end is not None:
+                    raise EOFError('Unexpected end of input file at offset {}'
+                                   ''.format(offset))
+                break
+            outfile.write(data)
+            offset += len(data)
+        return offset - start
+
+    pos = infile.tell()
+    if pos > start:
+        raise ValueError('Can not go back in input stream {} from {} to {}'
+                         ''.format(getattr(infile, 'name', ''), pos, start))
+    while pos < start:
+        skipped = len(infile.read(min(start - pos, COPY_BUFFER_SIZE)))
+        if not skipped:
+            if end is None:
+                # nothing to copy to the end
+                return 0
+            raise EOFError('Unexpected end of input at offset {}'.format(pos))
+        pos += skipped
+
+    done = 0
+    while end is None or start + done < end:
+        size = COPY_BUFFER_SIZE
+        if end is not None:
+            size = min(size, end - start - done)
+        data = infile.read(size)
+        if not data:
+            if end is not None:
+                raise EOFError('Unexpected end of input at offset {}'
+                               ''.format(start + done))
+            break
+        outfile.write(data)
+        done += len(data)
+    return done
+
+
+def _clone_range(fd_in, fd_out, start, end):
+    """
+    Make a reflink of the range at the current position of fd_out
+
+    This is all-or-nothing, there is no partial cloning.
+    """
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, 'fcntl not available')
+    dest = os.lseek(fd_out, 0, os.SEEK_CUR)
+    fcntl.ioctl(fd_out, FICLONERANGE,
+                _FILE_CLONE_RANGE.pack(fd_in, start, end - start, dest))
+    os.lseek(fd_out, dest + end - start, os.SEEK_SET)
+    return end - start
+
+
+def _copy_file_range(fd_in, fd_out, start, end):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'os.copy_file_range not available')
+    return _copy_loop(
+        lambda offset, count: os.copy_file_range(fd_in, fd_out, count, offset),
+        start, end,
+    )
+
+
+def _sendfile(fd_in, fd_out, start, end):
+    return _copy_loop(
+        lambda offset, count: os.sendfile(fd_out, fd_in, offset, count),
+        start, end,
+    )
+
+
+def _read_write(fd_in, fd_out, start, end):
+    def copy(offset, count):
+        data = os.pread(fd_in, min(count, COPY_BUFFER_SIZE), offset)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd_out, view):]
+        return len(data)
+
+    return _copy_loop(copy, start, end)
+
+
+def _copy_loop(copy, start, end):
+    """
+    Call copy(offset, count) until the range is done
+
+    Raises OSError for unsupported methods only if nothing was copied yet, so
+    that the caller can try another method.
+    """
+    offset = start
+    while offset < end:
+        try:
+            done = copy(offset, end - offset)
+        except OSError as e:
+            if offset > start and e.errno in _UNSUPPORTED:
+                # can't fall back after partially copying
+                raise RuntimeError(
+                    'Copying failed after {} bytes: {}'.format(offset - start,
+                                                               e)
+                ) from e
+            raise
+        if done == 0:
+            raise EOFError('Unexpected end of input file at offset {}'
+                           ''.format(offset))
+        offset += done
+    return offset - start
+
+
+_copy_funs = [_clone_range, _copy_file_range, _sendfile, _read_write]
+
+
+def open_append(path):
+    """
+    Open a file for appending without using append mode
+
+    The file is created if needed and positioned at its end.  Unlike files
+    opened with mode 'ab', the returned file object can be the target of
+    copy_range()'s kernel-side copy methods, and it can be truncated.  The
+    underlying file descriptor is opened for reading, too, so that written
+    data can be read back with os.pread().
+    """
+    def opener(name, flags):
+        flags &= ~(os.O_TRUNC | os.O_WRONLY)
+        return os.open(name, flags | os.O_RDWR, 0o666)
+
+    f = open(str(path), 'wb', opener=opener)
+    f.seek(0, os.SEEK_END)
+    return f
+
+
+def is_regular_file(file):
+    """
+    Tell if file object is backed directly by a regular file
+
+    Returns False for pipes and for the (de-)compressing file objects made by
+    open_input() and open_output(), which don't support positioned I/O.
+    """
+    raw = getattr(file, 'raw', file)
+    if not isinstance(raw, io.FileIO):
+        return False
+    try:
+        return stat.S_ISREG(os.fstat(raw.fileno()).st_mode)
+    except (OSError, ValueError):
+        return False
+
+
+def detect_compression(file):
+    """
+    Detect compression format from magic bytes
+
+    :param file: Path or binary file object supporting peek()
+
+    :return: One of GZIP, BZIP2, XZ, ZSTD, or None for uncompressed data
+    """
+    if isinstance(file, (str, Path)):
+        with open(str(file), 'rb') as f:
+            head = f.read(8)
+    else:
+        head = file.peek(8)[:8]
+    for name, magic in MAGIC.items():
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def compression_from_suffix(path):
+    """
+    Get compression format from file name suffix, None if uncompressed
+    """
+    return SUFFIXES.get(Path(path).suffix.lower())
+
+
+def strip_compression_suffix(path):
+    """
+    Split path into path without compression suffix and that suffix
+
+    E.g. 'reads.fastq.gz' gives ('reads.fastq', '.gz')
+    """
+    path = Path(path)
+    if path.suffix.lower() in SUFFIXES:
+        return path.with_suffix(''), path.suffix
+    return path, ''
+
+
+def _lib_open(fileobj, compression, mode, level=None):
+    """
+    Get the compression library's file object wrapping a binary file object
+    """
+    if level is None:
+        level = DEFAULT_LEVEL[compression]
+    write = 'w' in mode
+    if compression == GZIP:
+        if write:
+            return gzip.GzipFile(fileobj=fileobj, mode='wb',
+                                 compresslevel=level)
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if compression == BZIP2:
+        if write:
+            return bz2.BZ2File(fileobj, mode='wb', compresslevel=level)
+        return bz2.BZ2File(fileobj, mode='rb')
+    if compression == XZ:
+        if write:
+            return lzma.LZMAFile(fileobj, mode='wb', preset=level)
+        return lzma.LZMAFile(fileobj, mode='rb')
+    if compression == ZSTD:
+        if zstandard is None:
+            raise RuntimeError('Support for zstd compressed files requires '
+                               'the zstandard python package to be installed')
+        if write:
+            return zstandard.ZstdCompressor(level=level).stream_writer(
+                fileobj, closefd=False,
+            )
+        return zstandard.ZstdDecompressor().stream_reader(
+            fileobj, read_across_frames=True, closefd=False,
+        )
+    raise ValueError('Unknown compression: {}'.format(compression))
+
+
+class _ThreadReader(io.RawIOBase):
+    """
+    Raw reader getting data from a file object read in a helper thread
+    """
+    def __init__(self, source, name, closefds=()):
+        """
+        :param source: File-like object read by the helper thread
+        :param name: Name for the name attribute
+        :param closefds: More file objects to close when done
+        """
+        super().__init__()
+        self.name = name
+        self._source = source
+        self._closefds = closefds
+        self._queue = queue.Queue(maxsize=QUEUE_CHUNKS)
+        self._stop = threading.Event()
+        self._chunk = memoryview(b'')
+        self._pos = 0
+        self._eof = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                chunk = self._source.read(IO_CHUNK_SIZE)
+                self._put(chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._chunk:
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            if not item:
+                self._eof = True
+                return 0
+            self._chunk = memoryview(item)
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        self._pos += n
+        return n
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._source.close()
+            for i in self._closefds:
+                i.close()
+        super().close()
+
+
+class _ThreadWriter(io.RawIOBase):
+    """
+    Raw writer passing data to a file object written in a helper thread
+    """
+    def __init__(self, sink, name, closefds=()):
+        """
+        :param sink: File-like object written by the helper thread
+        :param name: Name for the name attribute
+        :param closefds: More file objects to close after the sink
+        """
+        super().__init__()
+        self.name = name
+        self._sink = sink
+        self._closefds = closefds
+        self._queue = queue.Queue(maxsize=QUEUE_CHUNKS)
+        self._error = None
+        self._pos = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            if self._error is not None:
+                # drain the queue after an error
+                continue
+            try:
+                self._sink.write(chunk)
+            except Exception as e:
+                self._error = e
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self._error is not None:
+            raise self._error
+        data = bytes(b)
+        self._queue.put(data)
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self._queue.put(None)
+            self._thread.join()
+            try:
+                if self._error is None:
+                    self._sink.close()
+            finally:
+                for i in self._closefds:
+                    i.close()
+            if self._error is not None:
+                raise self._error
+        super().close()
+
+
+def bgzf_block(data, level=DEFAULT_LEVEL[GZIP]):
+    """
+    Compress data into a single BGZF block
+
+    :param bytes data: At most BGZF_BLOCK_SIZE bytes of uncompressed data
+    :param int level: Compression level
+
+    :return bytes: The complete block, a gzip member
+    """
+    comp = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = comp.compress(data) + comp.flush()
+    size = BGZF_HEADER.size + len(cdata) + BGZF_TRAILER.size
+    if size > BGZF_MAX_BLOCK:
+        # incompressible, store
+        comp = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = comp.compress(data) + comp.flush()
+        size = BGZF_HEADER.size + len(cdata) + BGZF_TRAILER.size
+    header = BGZF_HEADER.pack(
+        0x1f, 0x8b, 8, 4,  # magic, deflate, FEXTRA
+        0,  # mtime
+        0, 0xff,  # extra flags, OS unknown
+        6,  # length of extra field
+        ord('B'), ord('C'), 2, size - 1,
+    )
+    trailer = BGZF_TRAILER.pack(zlib.crc32(data), len(data))
+    return b''.join((header, cdata, trailer))
+
+
+def zstd_frame(data, level=DEFAULT_LEVEL[ZSTD]):
+    """
+    Compress data into a single zstd frame
+
+    The frame header records the uncompressed size.
+    """
+    if zstandard is None:
+        raise RuntimeError('Support for zstd compressed files requires '
+                           'the zstandard python package to be installed')
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+class BlockIndex:
+    """
+    Offsets of the independently compressed blocks of a file
+
+    An index lists the compressed and uncompressed offsets at which the
+    blocks of a BGZF file, or the frames of a zstd file written by
+    ZstdFrameWriter, start.  Blocks without data, like the BGZF EOF block,
+    are not listed.  The end attribute holds the offsets past the last block.
+
+    Indices are saved next to the compressed file, see index_path(), in the
+    .gzi format of htslib's bgzip: the number of entries followed by pairs of
+    compressed and uncompressed offset, all as little-endian 64-bit integers,
+    and leaving out the first block which starts at offsets 0, 0.
+    """
+    _count = struct.Struct('<Q')
+    _entry = struct.Struct('<QQ')
+
+    def __init__(self, offset=0, data_offset=0):
+        """
+        :param int offset: Compressed offset of the first block
+        :param int data_offset: Uncompressed offset of the first block
+        """
+        self.entries = []
+        self.end = (offset, data_offset)
+
+    def add(self, size, data_size):
+        """
+        Add a block at the end
+
+        :param int size: Compressed size of the block
+        :param int data_size: Uncompressed size of the block
+        """
+        offset, data_offset = self.end
+        if data_size:
+            self.entries.append(self.end)
+        self.end = (offset + size, data_offset + data_size)
+
+    def truncate(self, offset, data_offset):
+        """
+        Drop the blocks at or after the given offset
+
+        :param int offset: Compressed offset, the new end
+        :param int data_offset: Uncompressed offset corresponding to offset
+        """
+        self.entries = [i for i in self.entries if i[0] < offset]
+        self.end = (offset, data_offset)
+
+    def ranges(self, size, chunk_size=INDEXED_CHUNK_SIZE):
+        """
+        Split the compressed file into ranges of whole blocks
+
+        :param int size: Size of the compressed file
+        :param int chunk_size: Approximate compressed size of the ranges
+
+        :return: List of (start, end) tuples covering the whole file
+        """
+        bounds = [0]
+        for offset, _ in self.entries:
+            if offset - bounds[-1] >= chunk_size:
+                bounds.append(offset)
+        if bounds[-1] < size:
+            bounds.append(size)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def save(self, path):
+        """
+        Write the index to a file, atomically
+        """
+        entries = [i for i in self.entries if i != (0, 0)]
+        tmp = '{}.tmp'.format(path)
+        with open(tmp, 'wb') as f:
+            f.write(self._count.pack(len(entries)))
+            f.write(b''.join([self._entry.pack(*i) for i in entries]))
+        os.replace(tmp, str(path))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read an index file
+
+        The end attribute is unknown and set to None.  Raises RuntimeError if
+        the file is malformed.
+        """
+        with open(str(path), 'rb') as f:
+            data = f.read()
+        if len(data) < cls._count.size:
+            raise RuntimeError('Index file too short: {}'.format(path))
+        count, = cls._count.unpack_from(data)
+        if len(data) != cls._count.size + count * cls._entry.size:
+            raise RuntimeError('Index file has wrong size: {}'.format(path))
+        index = cls()
+        index.entries = [(0, 0)] + [
+            i for i in cls._entry.iter_unpack(data[cls._count.size:])
+        ]
+        index.end = None
+        return index
+
+
+def index_path(path, compression=GZIP):
+    """
+    Get the path of the block index sidecar of a compressed file
+
+    This is the file name with INDEX_SUFFIX[compression] appended, e.g.
+    reads.fastq.gz.gzi
+    """
+    return Path('{}{}'.format(path, INDEX_SUFFIX[compression]))
+
+
+def load_index(path, compression):
+    """
+    Load the block index of a compressed file if there is a usable one
+
+    :return: A BlockIndex or None.  An index is not used if it is older than
+             the compressed file or does not fit its size.
+    """
+    idx_path = index_path(path, compression)
+    try:
+        idx_stat = idx_path.stat()
+        stat = os.stat(str(path))
+        if idx_stat.st_mtime_ns < stat.st_mtime_ns:
+            return None
+        index = BlockIndex.load(idx_path)
+    except (OSError, RuntimeError):
+        return None
+    if index.entries[-1][0] >= stat.st_size:
+        return None
+    return index
+
+
+class _BlockWriter(io.RawIOBase):
+    """
+    Raw writer compressing fixed-size blocks of data with a thread pool
+
+    The blocks are compressed independently and in parallel and are written
+    out in order.  Subclasses set the block size, the function compressing a
+    block, and optionally an EOF marker written last.
+    """
+    block_size = None
+    eof = b''
+
+    def __init__(self, fileobj, level=None, threads=1, name=None,
+                 closefd=True, index=None):
+        """
+        :param fileobj: Binary file object to write the compressed data to,
+                        writing starts at its current position, which allows
+                        appending to existing compressed data.
+        :param int level: Compression level, by default the format's default
+        :param int threads: Number of compressing threads
+        :param name: Name for the name attribute
+        :param bool closefd: Whether to close fileobj when closing the writer
+        :param BlockIndex index: Optional index to add the written blocks to
+        """
+        super().__init__()
+        self.name = getattr(fileobj, 'name', None) if name is None else name
+        self.index = index
+        self._fileobj = fileobj
+        self._closefd = closefd
+        self._level = level
+        self._buf = bytearray()
+        self._pos = 0
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._pending = deque()
+        # bound memory use, keep a few blocks per thread in flight
+        self._max_pending = 4 * threads
+
+    @staticmethod
+    def compress(data, level):
+        raise NotImplementedError
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        n = memoryview(b).nbytes
+        self._buf += b
+        self._pos += n
+        if len(self._buf) >= self.block_size:
+            full = len(self._buf) - len(self._buf) % self.block_size
+            for i in range(0, full, self.block_size):
+                self._submit(bytes(self._buf[i:i + self.block_size]))
+            del self._buf[:full]
+        return n
+
+    def _submit(self, data):
+        future = self._pool.submit(self.compress, data, self._level)
+        self._pending.append((future, len(data)))
+        # write out what is done at the front, wait if too much is in flight
+        while self._pending and (len(self._pending) > self._max_pending
+                                 or self._pending[0][0].done()):
+            self._write_block()
+
+    def _write_block(self):
+        future, data_size = self._pending.popleft()
+        block = future.result()
+        self._fileobj.write(block)
+        if self.index is not None:
+            self.index.add(len(block), data_size)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buf:
+                self._submit(bytes(self._buf))
+                self._buf = bytearray()
+            while self._pending:
+                self._write_block()
+            if self.eof:
+                self._fileobj.write(self.eof)
+                if self.index is not None:
+                    self.index.add(len(self.eof), 0)
+        finally:
+            for future, _ in self._pending:
+                future.cancel()
+            self._pool.shutdown()
+            try:
+                if self._closefd:
+                    self._fileobj.close()
+                else:
+                    self._fileobj.flush()
+            finally:
+                super().close()
+
+
+class BGZFWriter(_BlockWriter):
+    """
+    Raw writer compressing data to the BGZF format with a thread pool
+
+    BGZF, as used by samtools/htslib, is a series of gzip members of at most
+    64k each, so the output is valid gzip which can be decompressed by any
+    gzip tool.  As the blocks are independent they are compressed in parallel
+    and written out in order.  The file ends with the empty BGZF EOF block.
+    """
+    block_size = BGZF_BLOCK_SIZE
+    eof = BGZF_EOF
+
+    def __init__(self, fileobj, level=None, threads=1, name=None,
+                 closefd=True, index=None):
+        if level is None:
+            level = DEFAULT_LEVEL[GZIP]
+        super().__init__(fileobj, level=level, threads=threads, name=name,
+                         closefd=closefd, index=index)
+
+    compress = staticmethod(bgzf_block)
+
+
+class ZstdFrameWriter(_BlockWriter):
+    """
+    Raw writer compressing data to independent zstd frames with a thread pool
+
+    Each ZSTD_FRAME_SIZE bytes of data make a separate frame, which, with an
+    index, allows to decompress the file in parallel.  The output can be
+    decompressed by any zstd tool.  Compared to a single frame the
+    compression ratio is slightly worse.
+    """
+    block_size = ZSTD_FRAME_SIZE
+
+    def __init__(self, fileobj, level=None, threads=1, name=None,
+                 closefd=True, index=None):
+        if level is None:
+            level = DEFAULT_LEVEL[ZSTD]
+        super().__init__(fileobj, level=level, threads=threads, name=name,
+                         closefd=closefd, index=index)
+
+    compress = staticmethod(zstd_frame)
+
+
+def gzip_chunks(path, chunk_size=GUNZIP_CHUNK_SIZE):
+    """
+    Split a gzip file into byte ranges starting at member boundaries
+
+    :param path: Path to gzip file
+    :param int chunk_size: Approximate compressed size of the ranges
+
+    :return: List of (start, end) tuples covering the whole file.  A file
+             with a single member (or a single member per chunk_size) gives a
+             single range.
+
+    Member starts are found by searching for the gzip magic bytes after each
+    multiple of chunk_size and test-inflating some data from there.  This is
+    fast but not certain, the ranges are verified when decompressing them,
+    see _gunzip_range().
+    """
+    with open(str(path), 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= chunk_size:
+            return [(0, size)]
+        bounds = [0]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = chunk_size
+            while pos < size:
+                pos = _next_member(mm, pos)
+                if pos is None:
+                    break
+                bounds.append(pos)
+                pos += chunk_size
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _next_member(buf, pos):
+    """
+    Find the next plausible gzip member start at or after pos
+
+    Returns None if there is none.
+    """
+    magic = MAGIC[GZIP] + b'\x08'  # with deflate method
+    while True:
+        pos = buf.find(magic, pos)
+        if pos == -1:
+            return None
+        try:
+            zlib.decompressobj(31).decompress(
+                buf[pos:pos + GZIP_PROBE_SIZE], GZIP_PROBE_SIZE
+            )
+        except zlib.error:
+            pos += 1
+        else:
+            return pos
+
+
+def _gunzip_range(path, start, end):
+    """
+    Decompress the gzip members found exactly in the given byte range
+
+    Raises ValueError or zlib.error if the range does not start at a member or
+    the last member does not end at the range's end.  Run in a worker
+    process.
+    """
+    with open(str(path), 'rb') as f:
+        f.seek(start)
+        data = memoryview(f.read(end - start))
+    ret = []
+    offset = 0
+    while offset < len(data):
+        inflate = zlib.decompressobj(31)
+        # feed small pieces, the unused rest of the input gets copied
+        while not inflate.eof:
+            if offset >= len(data):
+                raise ValueError('gzip member extends past range end: {} '
+                                 '{}-{}'.format(path, start, end))
+            piece = data[offset:offset + BGZF_MAX_BLOCK]
+            ret.append(inflate.decompress(piece))
+            offset += len(piece)
+        offset -= len(inflate.unused_data)
+    return b''.join(ret)
+
+
+def gunzip_parallel(path, outfile, executor, workers,
+                    chunk_size=GUNZIP_CHUNK_SIZE, stats=None):
+    """
+    Decompress a gzip file using a process pool
+
+    :param path: Path to gzip file
+    :param outfile: Binary file object to append the decompressed data to
+    :param executor: A concurrent.futures.ProcessPoolExecutor
+    :param int workers: Number of the executor's workers, this limits the
+                        number of chunks in flight to keep memory in check.
+    :param int chunk_size: Approximate compressed size of chunks.
+    :param stats: Optional object with update(data) and reset() methods, e.g.
+                  a seqio.RecordCounter, which gets passed all the data
+                  written.
+
+    :return: Number of bytes written
+
+    Multi-member gzip files, as written by BGZFWriter, bgzip, or by
+    concatenating gzip files, are split at member boundaries and the chunks
+    are decompressed by the executor's processes and written out in order.
+    Files that can't be split, or if outfile is not a regular file, are
+    decompressed in a single stream.  If a chunk turns out to be bad the
+    output written so far is truncated and the file is decompressed again,
+    single-streamed, so that errors in the data are reported as usual.
+    """
+    chunks = None
+    if executor is not None and is_regular_file(outfile):
+        chunks = gzip_chunks(path, chunk_size)
+    if chunks is None or len(chunks) < 2:
+        return _gunzip_stream(path, outfile, stats)
+
+    outfile.flush()
+    outpos = outfile.seek(0, os.SEEK_END)
+    done = 0
+    pending = deque()
+    chunks = iter(chunks)
+    try:
+        while True:
+            while len(pending) < 2 * workers:
+                try:
+                    start, end = next(chunks)
+                except StopIteration:
+                    break
+                pending.append(
+                    executor.submit(_gunzip_range, path, start, end)
+                )
+            if not pending:
+                break
+            data = pending.popleft().result()
+            outfile.write(data)
+            if stats is not None:
+                stats.update(data)
+            done += len(data)
+    except (ValueError, zlib.error):
+        for i in pending:
+            i.cancel()
+        outfile.flush()
+        outfile.truncate(outpos)
+        outfile.seek(outpos)
+        if stats is not None:
+            stats.reset()
+        return _gunzip_stream(path, outfile, stats)
+    return done
+
+
+def _gunzip_stream(path, outfile, stats=None):
+    """
+    Decompress gzip file single-streamed
+    """
+    with open_input(path) as infile:
+        if stats is None:
+            return _copy_stream(infile, outfile, 0, None)
+        return copy_stats(infile, outfile, stats)
+
+
+def copy_stats(infile, outfile, stats):
+    """
+    Copy the rest of a file, passing all data to stats.update()
+
+    :return: Number of bytes copied
+    """
+    done = 0
+    while True:
+        data = infile.read(COPY_BUFFER_SIZE)
+        if not data:
+            break
+        outfile.write(data)
+        stats.update(data)
+        done += len(data)
+    return done
+
+
+def _unzstd_range(path, start, end):
+    """
+    Decompress the zstd frames found exactly in the given byte range
+    """
+    with open(str(path), 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    reader = zstandard.ZstdDecompressor().stream_reader(
+        data, read_across_frames=True,
+    )
+    return reader.readall()
+
+
+class _IndexedReader(io.RawIOBase):
+    """
+    Raw reader decompressing ranges of an indexed file with a thread pool
+
+    The ranges are decompressed in parallel, zlib and zstd release the GIL
+    while doing so, and handed out in order.
+    """
+    def __init__(self, path, compression, ranges, threads):
+        """
+        :param path: Path to a BGZF or zstd compressed file
+        :param ranges: List of (start, end) byte ranges made of whole
+                       blocks, see BlockIndex.ranges()
+        :param int threads: Number of decompressing threads
+        """
+        super().__init__()
+        self.name = str(path)
+        if compression == GZIP:
+            self._decompress = _gunzip_range
+        else:
+            self._decompress = _unzstd_range
+        self._ranges = iter(ranges)
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._pending = deque()
+        self._max_pending = 2 * threads
+        self._chunk = memoryview(b'')
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._chunk:
+            for start, end in self._ranges:
+                self._pending.append(self._pool.submit(
+                    self._decompress, self.name, start, end
+                ))
+                if len(self._pending) >= self._max_pending:
+                    break
+            if not self._pending:
+                return 0
+            self._chunk = memoryview(self._pending.popleft().result())
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        self._pos += n
+        return n
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            for i in self._pending:
+                i.cancel()
+            self._pool.shutdown()
+        super().close()
+
+
+class HashThread:
+    """
+    Compute a hashlib digest in a helper thread
+
+    Data passed to update() is hashed in the background, hashlib releases
+    the GIL for larger data, so that hashing overlaps with I/O.
+    """
+    def __init__(self, algorithm):
+        """
+        :param str algorithm: Name of a hashlib algorithm, e.g. 'md5'
+        """
+        self.algorithm = algorithm
+        self._hash = hashlib.new(algorithm)
+        self._queue = queue.Queue(maxsize=QUEUE_CHUNKS)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                # drain the queue after an error
+                continue
+            try:
+                if isinstance(item, Path):
+                    with item.open('rb') as f:
+                        for block in iter(lambda: f.read(COPY_BUFFER_SIZE),
+                                          b''):
+                            self._hash.update(block)
+                else:
+                    self._hash.update(item)
+            except Exception as e:
+                self._error = e
+
+    def update(self, data):
+        """
+        Add data to the hash
+        """
+        self._queue.put(bytes(data))
+
+    def update_file(self, path):
+        """
+        Add a whole file's content to the hash, read by the helper thread
+        """
+        self._queue.put(Path(path))
+
+    def hexdigest(self):
+        """
+        Wait for the helper thread and get the digest
+
+        No more data can be added after this.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._hash.hexdigest()
+
+    def close(self):
+        """
+        Wait for the helper thread to finish, without getting the digest
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+
+class HashingReader(io.RawIOBase):
+    """
+    Raw reader passing all data read from a file to a hasher
+
+    Wrap a file with this before handing it to open_input() to hash the
+    (compressed) file content while reading the decompressed data.
+    """
+    def __init__(self, raw, hasher):
+        """
+        :param raw: Unbuffered binary file object
+        :param hasher: A HashThread or other object with an update() method
+        """
+        super().__init__()
+        self.name = getattr(raw, 'name', None)
+        self._raw = raw
+        self._hasher = hasher
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._raw.readinto(b)
+        if n:
+            self._hasher.update(memoryview(b)[:n])
+        return n
+
+    def finish(self):
+        """
+        Hash the rest of the file
+
+        Use this after the decompressor is done, in case it did not read up
+        to the end of the file.
+        """
+        for data in iter(lambda: self._raw.read(COPY_BUFFER_SIZE), b''):
+            self._hasher.update(data)
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+        super().close()
+
+
+def open_input(file, threads=1):
+    """
+    Open a possibly compressed file for reading
+
+    :param file: Path or binary file object.  Compression is detected from the
+                 magic bytes.
+    :param int threads: Number of threads decompressing BGZF or zstd files
+                        given by path that have a block index, see
+                        load_index().  Other compressed data is decompressed
+                        by a single helper thread.
+
+    :return: A binary, buffered file object.  For uncompressed files given by
+             path this is a plain file object, supporting seek() and
+             fileno().  For compressed data the returned object streams the
+             decompressed data, which is made in a helper thread, and supports
+             peek() and tell() but no seeking.
+    """
+    if isinstance(file, (str, Path)):
+        name = str(file)
+        fileobj = open(name, 'rb')
+    else:
+        name = getattr(file, 'name', '<input>')
+        fileobj = file
+        if not hasattr(fileobj, 'peek'):
+            fileobj = io.BufferedReader(fileobj)
+
+    try:
+        compression = detect_compression(fileobj)
+    except Exception:
+        fileobj.close()
+        raise
+    if compression is None:
+        return fileobj
+
+    if threads > 1 and fileobj is not file \
+            and compression in INDEX_SUFFIX:
+        index = load_index(name, compression)
+        if index is not None and (compression == GZIP or zstandard):
+            size = os.fstat(fileobj.fileno()).st_size
+            fileobj.close()
+            return io.BufferedReader(
+                _IndexedReader(name, compression, index.ranges(size),
+                               threads),
+                buffer_size=IO_CHUNK_SIZE,
+            )
+
+    source = _lib_open(fileobj, compression, 'rb')
+    return io.BufferedReader(
+        _ThreadReader(source, name, closefds=(fileobj,)),
+        buffer_size=IO_CHUNK_SIZE,
+    )
+
+
+def open_output(path, compression='auto', level=None, threads=1):
+    """
+    Open file for writing, possibly with compression
+
+    :param path: Output file path
+    :param compression: With 'auto', the default, compression is selected by
+                        file name suffix, see SUFFIXES.  Otherwise one of
+                        GZIP, BZIP2, XZ, ZSTD, or None for no compression.
+    :param int level: Compression level, by default a format-specific medium
+                      level.
+    :param int threads: Number of threads compressing gzip output
+
+    :return: A binary, buffered file object.  Compression is done in a helper
+             thread, gzip output is BGZF compressed by a pool of threads.
+    """
+    if compression == 'auto':
+        compression = compression_from_suffix(path)
+    if compression is None:
+        return open(str(path), 'wb')
+
+    fileobj = open(str(path), 'wb')
+    if compression == GZIP:
+        return io.BufferedWriter(
+            BGZFWriter(fileobj, level=level, threads=threads, name=str(path)),
+            buffer_size=IO_CHUNK_SIZE,
+        )
+    try:
+        sink = _lib_open(fileobj, compression, 'wb', level)
+    except Exception:
+        fileobj.close()
+        raise
+    return io.BufferedWriter(
+        _ThreadWriter(sink, str(path), closefds=(fileobj,)),
+        buffer_size=IO_CHUNK_SIZE,
+    )
+
+
+def benchmark_copy(path, dest_dir=None, file=None):
+    """
+    Time the available methods to copy a file
+
+    :param path: The file to copy
+    :param dest_dir: Directory for the copies, by default the file's
+                     directory, as reflinks only work within a filesystem.
+    :param file: File object to print to, by default stdout
+
+    Each method copies the whole file, including a final fsync, then the copy
+    is removed again.  Unsupported methods are reported as such.
+    """
+    path = Path(path)
+    dest = Path(dest_dir or path.parent) / (path.name + '.copy-benchmark')
+    size = path.stat().st_size
+
+    def copyfileobj(infile, outfile):
+        while True:
+            data = infile.read(COPY_BUFFER_SIZE)
+            if not data:
+                break
+            outfile.write(data)
+
+    methods = [(i.__name__.lstrip('_'), i) for i in _copy_funs]
+    methods.append(('copyfileobj', None))
+
+    with path.open('rb') as infile:
+        # warm up page cache
+        with open(os.devnull, 'wb') as null:
+            copyfileobj(infile, null)
+        for name, fn in methods:
+            infile.seek(0)
+            try:
+                with dest.open('wb') as outfile:
+                    start = time.monotonic()
+                    try:
+                        if fn is None:
+                            copyfileobj(infile, outfile)
+                        else:
+                            fn(infile.fileno(), outfile.fileno(), 0, size)
+                        outfile.flush()
+                        os.fsync(outfile.fileno())
+                    except OSError as e:
+                        print('{:>16}: not supported: {}'.format(name, e),
+                              file=file)
+                        continue
+                    secs = time.monotonic() - start
+                print('{:>16}: {:8.3f}s {:10.1f} MB/s'
+                      ''.format(name, secs, size / 1e6 / max(secs, 1e-9)),
+                      file=file)
+            finally:
+                if dest.exists():
+                    dest.unlink()
+
+
+def main(argv=None):
+    argp = argparse.ArgumentParser(
+        prog=__loader__.name.replace('.', ' '),
+        description='Benchmark file copy methods',
+    )
+    argp.add_argument('file', help='File to copy, should be several GB')
+    argp.add_argument(
+        '-d', '--dest-dir',
+        default=None,
+        help='Directory to write copies to, by default the directory of the '
+             'file.  Use a different filesystem to see cross-filesystem '
+             'performance.',
+    )
+    args = argp.parse_args(argv)
+    benchmark_copy(args.file, args.dest_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,74 +16,46 @@
 # with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
-from enum import Enum
+from itertools import zip_longest
 from pathlib import Path
 import sys
 
 from . import get_argparser
-
-
-FileFormat = Enum('FileFormat', 'fasta fastq')
-
-format_info = {
-    FileFormat.fasta: {'lines': 2, 'headchar': '>'},
-    FileFormat.fastq: {'lines': 4, 'headchar': '@'},
-}
-
-
-def record(file, fmt=FileFormat.fastq):
-    """
-    Given a fasta or fastq file return iterator over sequences
-
-    Implements the grouper recipe from collections doc
-    """
-    args = [iter(file)] * format_info[fmt]['lines']
-    return zip(*args)
+from .fileio import open_input, open_output
+from .seqio import (LINES_PER_RECORD, check_batch, detect_format,
+                    interleave_batches, read_batches)
 
 
 def interleave(fwd_in, rev_in, check=False):
     """
     Interleave reads from two files
+
+    :param fwd_in: Forward reads, binary file object
+    :param rev_in: Reverse reads, binary file object
+
+    Returns an iterator over bytes-like chunks of the interleaved data.
     """
-    fmt = None
-    for file in [fwd_in, rev_in]:
-        try:
-            fmt_indicator = file.peek(1)[0]
-        except IndexError:
-            raise RuntimeError('File empty?: {}'.format(file.name))
-
-        for _fmt, info in format_info.items():
-            if fmt_indicator == ord(info['headchar']):
-                if fmt is None:
-                    fmt = _fmt
-                else:
-                    if fmt != _fmt:
-                        raise RuntimeError(
-                            'Fileformat mismatch: {} is {} but {} is {}.'
-                            ''.format(fwd_in.name, fmt.name, rev_in.name,
-                                      _fmt.name))
-                break
-        if fmt is None:
-            raise RuntimeError('Bad file format: {}: expected'
-                               ' > or @ as first character but got {}'
-                               ''.format(file.name, chr(fmt_indicator)))
-
-    for fwd_rec, rev_rec in zip(record(fwd_in, fmt=fmt),
-                                record(rev_in, fmt=fmt)):
+    fmt = detect_format(fwd_in)
+    rev_fmt = detect_format(rev_in)
+    if fmt != rev_fmt:
+        raise RuntimeError('Fileformat mismatch: {} is {} but {} is {}.'
+                           ''.format(fwd_in.name, fmt, rev_in.name, rev_fmt))
+    lines = LINES_PER_RECORD[fmt]
+
+    batches = zip_longest(
+        read_batches(fwd_in, lines_per_record=lines),
+        read_batches(rev_in, lines_per_record=lines),
+    )
+    for fwd_batch, rev_batch in batches:
+        if fwd_batch is None or rev_batch is None \
+                or len(fwd_batch[2]) != len(rev_batch[2]):
+            raise RuntimeError('Forward and reverse reads files have '
+                               'different number of reads: {} {}'
+                               ''.format(fwd_in.name, rev_in.name))
         if check:
-            fwd_rec = list(fwd_rec)
-            rev_rec = list(rev_rec)
-            for rec in [fwd_rec, rev_rec]:
-                if rec[0][0] != ord(format_info[fmt]['headchar']):
-                    raise RuntimeError('Expected header: {}'.format(rec[0]))
-            if fmt is FileFormat.fastq:
-                for rec in [fwd_rec, rev_rec]:
-                    if rec[2] != b'+\n':
-                        raise RuntimeError('Expected + separator line: {}'
-                                           ''.format(rec[2]))
-        for rec in [fwd_rec, rev_rec]:
-            for line in rec:
-                yield line
+            check_batch(fwd_batch, fwd_in.name, fmt)
+            check_batch(rev_batch, rev_in.name, fmt)
+        yield from interleave_batches(fwd_batch, rev_batch, lines)
 
 
 def main(argv=None, namespace=None):
@@ -91,7 +63,6 @@ def main(argv=None, namespace=None):
         prog=__loader__.name.replace('.', ' '),
         description=__doc__,
         project_home=False,
-        threads=False,
     )
     argp.add_argument('forward_reads', type=argparse.FileType())
     argp.add_argument('reverse_reads', type=argparse.FileType())
@@ -105,7 +76,9 @@ def main(argv=None, namespace=None):
         nargs='?',
         default=None,
         help='Path to output file.  If not provided output is written to '
-             'stdout.',
+             'stdout.  Output is compressed according to the file suffix, '
+             'e.g. .gz or .xz.  Gzip output is compressed in blocks by '
+             'the given number of threads.',
     )
     args = argp.parse_args(args=argv, namespace=namespace)
 
@@ -115,20 +88,20 @@ def main(argv=None, namespace=None):
     fwd_path = Path(args.forward_reads.name)
     rev_path = Path(args.reverse_reads.name)
 
-    fwd_in = fwd_path.open('rb')
-    rev_in = rev_path.open('rb')
+    fwd_in = open_input(fwd_path, threads=args.threads)
+    rev_in = open_input(rev_path, threads=args.threads)
 
     if args.output is None:
         out = sys.stdout.buffer
     else:
         try:
-            out = Path(args.output).open('wb')
+            out = open_output(args.output, threads=args.threads)
         except Exception as e:
             argp.error('Failed to open file for writing: {}: {}: {}'
                        ''.format(args.output, e.__class__.__name__, e))
 
-    for i in interleave(fwd_in, rev_in, check=args.check):
-        out.write(i)
+    out.writelines(interleave(fwd_in, rev_in, check=args.check))
+    out.close()
 
 
 if __name__ == '__main__':
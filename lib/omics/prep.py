@@ -22,19 +22,63 @@ prep copies, renames, and (optionally) decompresses your (gzipped) fastq
 files to ensure a standardized setup for further processing.
 """
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import gzip
-from itertools import groupby, zip_longest
+from collections import namedtuple
+from contextlib import ExitStack
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+import hashlib
+from heapq import heappop, heappush
+from itertools import chain, groupby
+import json
+import os
 from pathlib import Path
 import re
 import shutil
 import sys
+import threading
+import zlib
 
-from . import get_argparser, DEFAULT_VERBOSITY
+from . import get_argparser, DEFAULT_VERBOSITY, OMICS_DIR
 from omics.read_counts import make_output as write_read_counts
+from .fileio import (BZIP2, COPY_BUFFER_SIZE, GZIP, INDEX_SUFFIX, XZ, ZSTD,
+                     BGZFWriter, BlockIndex, HashingReader, HashThread,
+                     ZstdFrameWriter, copy_range, copy_stats,
+                     detect_compression, gunzip_parallel, index_path,
+                     open_append, open_input)
+from .seqio import BLOCK_SIZE, RecordCounter, count_records
 
 READ_COUNT_FILE_NAME = 'read_count.tsv'
 
+DEFAULT_MAX_COPY = 2
+
+# rough single-thread throughput in input bytes per second, for job
+# scheduling, and the typical compression ratio of fastq data
+COPY_RATE = 500e6
+DECOMPRESS_RATE = {GZIP: 60e6, BZIP2: 10e6, XZ: 20e6, ZSTD: 250e6}
+COMPRESS_RATE = {GZIP: 25e6, ZSTD: 150e6}
+COMPRESSION_RATIO = 4
+
+PrepJob = namedtuple(
+    'PrepJob',
+    ['sample', 'direction', 'outfile', 'series', 'kind', 'size', 'seconds',
+     'io_rate', 'done', 'recompress'],
+)
+""" A job of copying a series of input files into an output file """
+
+MANIFEST_DIR = 'prep'
+MANIFEST_VERSION = 1
+CHECKSUMS_FILE = 'checksums.json'
+
+# formats for --recompress: compression, output file suffix, writer
+BGZF = 'bgzf'
+RECOMPRESS = {
+    BGZF: (GZIP, '.gz', BGZFWriter),
+    ZSTD: (ZSTD, '.zst', ZstdFrameWriter),
+}
+
+# serializes updates to the per-sample checksum manifests
+_checksums_lock = threading.Lock()
+
 FORWARD_READS_FILE = 'fwd.fastq'
 REVERSE_READS_FILE = 'rev.fastq'
 
@@ -93,13 +137,14 @@ def group(files, keep_lanes=False, multi_run=False, verbosity=1):
         Primary key is sample name.
         If keep_lanes then lanes come before direction, otherwise they're last.
         In multi_run mode the run id is treated as (the primary) part of the
-        lane.
+        lane.  The file number comes last, so each series of files is in a
+        fixed order.
 
         Degrade to identity if filename can't be parsed.
         """
         m = re.match(pattern, x.name)
         if m is None:
-            key = (x.name, 0, '')
+            key = (x.name, 0, '', 0, x.name)
         else:
             m = m.groupdict()
             key = (m['sampleid'],)
@@ -113,6 +158,7 @@ def group(files, keep_lanes=False, multi_run=False, verbosity=1):
                 key += (runid, int(m['lane']), m['dir'])
             else:
                 key += (m['dir'], runid, int(m['lane']))
+            key += (int(m['fnum']), x.name)
 
         if verbosity >= DEFAULT_VERBOSITY + 2:
             print('parsed: {} -> {}'.format(x, key))
@@ -188,7 +234,9 @@ def sample_direction(filename):
 
 
 def prep(sample, files, dest=Path.cwd(), force=False, verbosity=1,
-         keep_compression=False, skip_existing=False, executor=None):
+         keep_compression=False, skip_existing=False, executor=None,
+         compress_threads=1, process_pool=None, count_reads=False,
+         checksum=None, recompress=None):
     """
     Decompress and copy files into sample directory
 
@@ -199,50 +247,89 @@ def prep(sample, files, dest=Path.cwd(), force=False, verbosity=1,
     :param Path dest: Project directory, destination / output directory
     :param bool force: If true, skip any safety check and overwrite existing
                        files.  Has no effect if skip_existing is True..
-    :param bool keep_compression: Do not decompress compressed data.
+    :param bool keep_compression: Do not decompress gzipped data.  Other input
+                                  of the sample is (re-)compressed.
     :param bool skip_existing: Do nothing if a destination file exists.
     :param executor: A concurrent.futures.Executor object.  If executor is None
                      then all will be done single-threaded.
+    :param int compress_threads: Number of threads compressing each output
+                                 file, and of processes of process_pool.
+    :param process_pool: A concurrent.futures.ProcessPoolExecutor used to
+                         decompress multi-member gzip files in parallel.
+    :param bool count_reads: Count the forward reads while copying them.
+    :param str checksum: Name of a hashlib algorithm, e.g. md5.  If given,
+                         checksums of input and output files are computed and
+                         saved, see checksums_path().
+    :param str recompress: Decompress all input and compress the output with
+                           BGZF or ZSTD, writing a block index next to it,
+                           see fileio.BlockIndex.  This can not be combined
+                           with keep_compression.
 
     :return: Dictionary of futures
 
     :raise: May raise OSError and relatives, in particular when destination
             files exist already or can not be written.
 
+    Progress is recorded in a manifest per output file, see
+    manifest_path().  An existing output file with a manifest listing the
+    same input files is resumed, or left alone if complete, instead of being
+    considered an existing file.  With force, existing output is started
+    over.
     """
     futures = {}
+    jobs = setup_sample(sample, files, dest=dest, force=force,
+                        verbosity=verbosity,
+                        keep_compression=keep_compression,
+                        skip_existing=skip_existing, recompress=recompress)
+    for job in jobs:
+        args = _job_args(job, dest, verbosity, compress_threads,
+                         process_pool, count_reads, checksum)
+        if executor is None:
+            _do_extract_and_copy(*args)
+        else:
+            futures[
+                executor.submit(_do_extract_and_copy, *args)
+            ] = (sample, job.direction)
+
+    return futures
+
 
+def setup_sample(sample, files, dest=Path.cwd(), force=False, verbosity=1,
+                 keep_compression=False, skip_existing=False, dry_run=False,
+                 recompress=None):
+    """
+    Check and prepare the destination of a sample and plan its jobs
+
+    Parameters are as for prep().  With dry_run nothing is changed on disk.
+
+    :return: List of PrepJob, one per output file, empty if the sample is
+             skipped.
+    """
     destdir = dest / sample
-    destdir.mkdir(exist_ok=True, parents=True)
+    if not dry_run:
+        destdir.mkdir(exist_ok=True, parents=True)
 
     fwd_outfile = destdir / FORWARD_READS_FILE
     rev_outfile = destdir / REVERSE_READS_FILE
 
-    if keep_compression:
-        if all([i.suffix == '.gz' for i in files]):
-            # keep output compressed only if *ALL* files of sample are gzipped
+    if keep_compression and recompress is not None:
+        raise ValueError('keep_compression and recompress are mutually '
+                         'exclusive')
+
+    if recompress is not None:
+        suffix = RECOMPRESS[recompress][1]
+        fwd_outfile = fwd_outfile.with_name(fwd_outfile.name + suffix)
+        rev_outfile = rev_outfile.with_name(rev_outfile.name + suffix)
+    elif keep_compression:
+        if any([detect_compression(i) == GZIP for i in files]):
+            # gzipped data is copied as-is, everything else gets compressed
             fwd_outfile = fwd_outfile.with_name(fwd_outfile.name + '.gz')
             rev_outfile = rev_outfile.with_name(rev_outfile.name + '.gz')
         else:
-            print('Note: some or all input files of sample {} are uncompressed'
-                  ' so all sample data will be uncompressed.'
-                  ''.format(sample), file=sys.stderr)
-
-    for i in [fwd_outfile, rev_outfile]:
-        if i.is_file():
-            if skip_existing:
-                if verbosity > 0:
-                    print('Skip sample {}: File exists: {}'.format(sample, i),
-                          file=sys.stderr)
-                return {}
-
-            if force:
-                with i.open('wb'):
-                    # truncating
-                    pass
-            else:
-                raise FileExistsError(i)
+            print('Note: no input file of sample {} is gzipped so all sample '
+                  'data will be uncompressed.'.format(sample), file=sys.stderr)
 
+    outputs = []
     for direction, series in groupby(files, key=sample_direction):
         # a 'series' is a bunch of files that got split up, and that we need
         # to put back together in a consistent order
@@ -253,41 +340,604 @@ def prep(sample, files, dest=Path.cwd(), force=False, verbosity=1,
         else:
             raise ValueError('Illegal value for direction: {}'
                              ''.format(direction))
-        series = list(series)
+        outputs.append((direction, outfile, list(series)))
+
+    jobs = []
+    for direction, outfile, series in outputs:
+        manifest_file = manifest_path(dest, outfile)
+        num_done = 0
+        if outfile.is_file():
+            manifest = None
+            if not force:
+                manifest = _load_manifest(manifest_file, series)
+            if manifest is not None:
+                # to be resumed, estimate cost for what is left
+                num_done = len(manifest['done'])
+            elif skip_existing:
+                if verbosity > 0:
+                    print('Skip sample {}: File exists: {}'
+                          ''.format(sample, outfile), file=sys.stderr)
+                return []
+            elif not force:
+                raise FileExistsError(outfile)
+            elif not dry_run:
+                with outfile.open('wb'):
+                    # truncating
+                    pass
+        if num_done == 0 and manifest_file.is_file() and not dry_run:
+            # stale or forced
+            manifest_file.unlink()
 
-        args = (sample, outfile, series, verbosity)
-        if executor is None:
-            _do_extract_and_copy(*args)
+        kind, size, seconds, io_rate = _estimate(outfile, series[num_done:],
+                                                 recompress)
+        jobs.append(PrepJob(sample, direction, outfile, series, kind, size,
+                            seconds, io_rate, num_done, recompress))
+    return jobs
+
+
+def _action(compression, outfile, recompress=None):
+    """
+    Tell how input with given compression gets into the output file
+
+    :return: 'copy' for copying as-is, 'extr' for decompressing, or 'comp'
+             for compressing, after decompressing if needed.
+    """
+    if recompress is not None:
+        return 'comp'
+    if outfile.suffix == '.gz':
+        return 'copy' if compression == GZIP else 'comp'
+    return 'copy' if compression is None else 'extr'
+
+
+def _estimate(outfile, series, recompress=None):
+    """
+    Estimate the cost of a job from input sizes and compression
+
+    :return: Tuple of job kind, total input size, the estimated run time in
+             seconds, and the I/O rate in bytes per second.  The job kind is
+             'decompress' if any input needs to be (de-)compressed, otherwise
+             'copy'.
+    """
+    kind = 'copy'
+    size = seconds = io_bytes = 0
+    for i in series:
+        compression = detect_compression(i)
+        action = _action(compression, outfile, recompress)
+        in_size = i.stat().st_size
+        size += in_size
+        if action == 'copy':
+            seconds += in_size / COPY_RATE
+            io_bytes += 2 * in_size
+        elif action == 'extr':
+            kind = 'decompress'
+            seconds += in_size / DECOMPRESS_RATE[compression]
+            io_bytes += in_size * (1 + COMPRESSION_RATIO)
         else:
-            futures[
-                executor.submit(_do_extract_and_copy, *args)
-            ] = (sample, direction)
+            kind = 'decompress'
+            if compression is not None:
+                seconds += in_size / DECOMPRESS_RATE[compression]
+                in_size *= COMPRESSION_RATIO
+            out_compression = GZIP
+            if recompress is not None:
+                out_compression = RECOMPRESS[recompress][0]
+            seconds += in_size / COMPRESS_RATE[out_compression]
+            io_bytes += in_size * (1 + 1 / COMPRESSION_RATIO)
+    io_rate = io_bytes / seconds if seconds else 0
+    return kind, size, seconds, io_rate
+
+
+def _job_args(job, dest, verbosity, compress_threads, process_pool,
+              count_reads, checksum):
+    """
+    Get the arguments for _do_extract_and_copy() to run a job
+    """
+    return (job.sample, job.outfile, job.series, verbosity, compress_threads,
+            process_pool, count_reads and job.direction == 1,
+            manifest_path(dest, job.outfile), checksum,
+            checksums_path(dest, job.sample), job.recompress)
+
+
+class Scheduler:
+    """
+    Decide which prep jobs to run when
+
+    Jobs are started largest first, by estimated run time (longest processing
+    time first, LPT), so that big samples don't end up as stragglers.  The
+    number of concurrently running jobs is limited overall and per job kind,
+    and optionally by their combined estimated I/O rate.  A job that does not
+    fit now is passed over for a smaller one that does.
+    """
+    def __init__(self, jobs, max_jobs, slots, io_budget=None):
+        """
+        :param list jobs: List of PrepJob
+        :param int max_jobs: Maximum number of jobs running at once
+        :param dict slots: Maximum number of running jobs by kind
+        :param float io_budget: I/O bandwidth budget in bytes per second.  A
+                                job exceeding the budget alone may still run
+                                if nothing else is running.
+        """
+        self.pending = sorted(jobs, key=lambda x: x.seconds, reverse=True)
+        self.running = []
+        self.max_jobs = max_jobs
+        self.slots = slots
+        self.io_budget = io_budget
+
+    def __bool__(self):
+        return bool(self.pending or self.running)
+
+    def _fits(self, job):
+        if len(self.running) >= self.max_jobs:
+            return False
+        same_kind = [i for i in self.running if i.kind == job.kind]
+        if len(same_kind) >= self.slots[job.kind]:
+            return False
+        if self.io_budget is not None and self.running:
+            io_rate = sum([i.io_rate for i in self.running]) + job.io_rate
+            if io_rate > self.io_budget:
+                return False
+        return True
+
+    def start(self):
+        """
+        Get the jobs to start now, these are then considered running
+        """
+        ret = []
+        for job in list(self.pending):
+            if self._fits(job):
+                self.pending.remove(job)
+                self.running.append(job)
+                ret.append(job)
+        return ret
+
+    def finish(self, job):
+        """
+        Mark a job as done
+        """
+        self.running.remove(job)
+
+    def thread_share(self, threads):
+        """
+        Get the number of threads for each running job needing compute
+
+        The threads are divided among the running jobs that (de-)compress,
+        plain copies do not use extra threads.
+        """
+        busy = len([i for i in self.running if i.kind == 'decompress'])
+        return max(1, threads // max(1, busy))
+
+    def simulate(self):
+        """
+        Simulate running all jobs with the estimated run times
+
+        :return: List of (start time, job) tuples in order of start
+        """
+        plan = []
+        now = 0
+        ends = []  # heap of (end time, index in plan)
+        while self:
+            for job in self.start():
+                heappush(ends, (now + job.seconds, len(plan)))
+                plan.append((now, job))
+            now, i = heappop(ends)
+            self.finish(plan[i][1])
+        return plan
+
+
+def print_plan(plan, file=None):
+    """
+    Print the plan of a simulated schedule
+
+    :param plan: List of (start time, job) tuples, see Scheduler.simulate()
+    """
+    makespan = max([start + job.seconds for start, job in plan] or [0])
+    print('Plan: {} jobs, {:.1f} GB input, estimated makespan {}'
+          ''.format(len(plan), sum([job.size for _, job in plan]) / 1e9,
+                    _hms(makespan)), file=file)
+    print('{:>9} {:>9} {:<10} {:>9}  output'
+          ''.format('start', 'est.time', 'kind', 'input'), file=file)
+    for start, job in plan:
+        note = ''
+        if job.done == len(job.series):
+            note = '  (complete)'
+        elif job.done:
+            note = '  (resume after {} of {} inputs)' \
+                   ''.format(job.done, len(job.series))
+        print('{:>9} {:>9} {:<10} {:>8.2f}G  {}{}'
+              ''.format(_hms(start), _hms(job.seconds), job.kind,
+                        job.size / 1e9, job.outfile, note), file=file)
+
+
+def _hms(seconds):
+    """
+    Format seconds as h:mm:ss
+    """
+    seconds = int(round(seconds))
+    return '{}:{:02}:{:02}'.format(seconds // 3600, seconds // 60 % 60,
+                                   seconds % 60)
+
+
+def manifest_path(dest, outfile):
+    """
+    Get path to the manifest file for an output file
+
+    Manifests are kept in the prep directory inside the destination's .omics
+    directory, by sample.
+    """
+    return (dest / OMICS_DIR / MANIFEST_DIR / outfile.parent.name
+            / (outfile.name + '.json'))
+
+
+def checksums_path(dest, sample):
+    """
+    Get path to the checksum manifest of a sample
+
+    This JSON file has the checksums of the sample's input and output files,
+    together with their sizes and modification times, see find_stale().
+    """
+    return dest / OMICS_DIR / MANIFEST_DIR / sample / CHECKSUMS_FILE
+
+
+def _record_checksums(path, algorithm, inputs, output):
+    """
+    Add checksums of an output and its inputs to the checksum manifest
+
+    :param dict inputs: Dict mapping input file path to its digest
+    :param tuple output: Output file path and its digest
+    """
+    with _checksums_lock:
+        try:
+            with path.open() as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        if data.get('algorithm') != algorithm:
+            data = {'algorithm': algorithm, 'inputs': {}, 'outputs': {}}
+
+        outpath, digest = output
+        outpath = Path(outpath)
+        data['outputs'][str(outpath.resolve())] = dict(
+            digest=digest,
+            inputs=[str(i.resolve()) for i in inputs],
+            **_file_info(outpath),
+        )
+        for i, digest in inputs.items():
+            data['inputs'][str(i.resolve())] = dict(
+                digest=digest,
+                **_file_info(i),
+            )
+        _save_manifest(path, data)
 
-    return futures
+
+def find_stale(checksums_file):
+    """
+    Find files that changed since their checksums were recorded
+
+    :param checksums_file: Path to a sample's checksum manifest, see
+                           checksums_path()
+
+    :return: List of paths of input or output files that are missing or
+             whose size or modification time differ from what was recorded.
+
+    This only looks at file metadata, the data is not read.
+    """
+    with open(str(checksums_file)) as f:
+        data = json.load(f)
+    stale = []
+    for path, info in chain(data['inputs'].items(), data['outputs'].items()):
+        try:
+            current = _file_info(Path(path))
+        except FileNotFoundError:
+            stale.append(path)
+            continue
+        if current['size'] != info['size'] \
+                or current['mtime_ns'] != info['mtime_ns']:
+            stale.append(path)
+    return stale
+
+
+def _stale_files(checksums_file):
+    """
+    Get the set of stale files of a checksum manifest, see find_stale()
+
+    If the checksum manifest is missing or can not be read then the result is
+    empty, as there are no recorded checksums that could be stale.
+    """
+    try:
+        return set(find_stale(checksums_file))
+    except (OSError, ValueError, KeyError):
+        return set()
+
+
+def _file_info(path):
+    """
+    Get size and modification time of a file
+    """
+    stat = path.stat()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _input_info(path):
+    """
+    Get what identifies an input file for the manifest
+    """
+    return dict(path=str(path.resolve()), **_file_info(path))
+
+
+def _load_manifest(path, series):
+    """
+    Load manifest if it exists and belongs to the given input series
+
+    Returns None if there is no usable manifest.
+    """
+    try:
+        with path.open() as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    if manifest.get('series') != [_input_info(i) for i in series]:
+        return None
+    return manifest
+
+
+def _save_manifest(path, manifest):
+    """
+    Write manifest atomically
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    with tmp.open('w') as f:
+        json.dump(manifest, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(str(tmp), str(path))
+
+
+def _checksum(file, start, end, running, hashers=()):
+    """
+    Get crc32 of a range of a file and update a running crc32 with it
+
+    :param file: Regular file object
+    :param int running: Running checksum up to start
+    :param hashers: HashThread objects to pass the data to
+
+    :return: Tuple of the range's checksum and the updated running checksum
+    """
+    crc = 0
+    pos = start
+    while pos < end:
+        data = os.pread(file.fileno(), min(COPY_BUFFER_SIZE, end - pos), pos)
+        if not data:
+            raise EOFError('Unexpected end of file: {}'.format(file.name))
+        crc = zlib.crc32(data, crc)
+        running = zlib.crc32(data, running)
+        for i in hashers:
+            i.update(data)
+        pos += len(data)
+    return crc, running
+
+
+def _resume(outf, manifest, sample, verbosity):
+    """
+    Go to the end of the verified data of a partially written output
+
+    Entries of the manifest are dropped from the end until one is found
+    whose data checks out, then the file is truncated after that.  Returns
+    the number of inputs that are done.
+    """
+    done = manifest['done']
+    size = os.fstat(outf.fileno()).st_size
+    while done:
+        entry = done[-1]
+        if entry['end'] <= size:
+            start = done[-2]['end'] if len(done) > 1 else 0
+            crc, _ = _checksum(outf, start, entry['end'], 0)
+            if crc == entry['crc32']:
+                break
+        if verbosity > 0:
+            print('{}: data of {} in {} is missing or corrupt, redoing it'
+                  ''.format(sample, entry['path'], outf.name),
+                  file=sys.stderr)
+        done.pop()
+
+    offset = done[-1]['end'] if done else 0
+    if offset < size:
+        outf.truncate(offset)
+    outf.seek(offset)
+    if done and verbosity > DEFAULT_VERBOSITY:
+        if len(done) == len(manifest['series']):
+            print('{}: {} is complete'.format(sample, outf.name))
+        else:
+            print('{}: resuming {} at input {} of {}'
+                  ''.format(sample, outf.name, len(done) + 1,
+                            len(manifest['series'])))
+    return len(done)
 
 
-def _do_extract_and_copy(sample, outfile, series, verbosity):
+def _resume_index(path, manifest):
+    """
+    Load the block index of an output to be resumed
+
+    The index is truncated to the data of the inputs that are done.  Returns
+    None if there is no usable index.
+    """
+    entry = manifest['done'][-1]
+    if entry.get('data_end') is None:
+        return None
+    try:
+        index = BlockIndex.load(path)
+    except (OSError, RuntimeError):
+        return None
+    index.truncate(entry['end'], entry['data_end'])
+    return index
+
+
+def _count_input(path):
+    """
+    Count reads and uncompressed bytes of an input file
+
+    :return: A RecordCounter
+    """
+    counter = RecordCounter(4, str(path))
+    with open_input(path) as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            counter.update(block)
+    return counter
+
+
+def _do_extract_and_copy(sample, outfile, series, verbosity,
+                         compress_threads=1, process_pool=None, count=False,
+                         manifest_file=None, checksum=None,
+                         checksums_file=None, recompress=None):
     """
     Helper function doing all the parallelizable IO work
 
-    Input files with .gz suffix will be de-compressed unless the output
-    also has the .gz suffix.  If the output file suffix is .gz and the input
-    is mixed gzipped and uncompressed then the output will be a corrupted mix
-    of plain and compressed data.
+    Compressed input files, detected by their magic bytes, will be
+    de-compressed unless the output has the .gz suffix.  For .gz output,
+    gzipped input is copied as-is and any other input is BGZF-compressed and
+    appended, as gzip allows concatenating compressed members.  Multi-member
+    gzip input, e.g. BGZF, is decompressed in parallel if a process pool is
+    given.  Plain copies are done by the kernel, see fileio.copy_range().
+    With recompress everything is decompressed and compressed again.
 
     :param Path outfile: Output file
     :param series: List of input files
-
-    Returns name of output file
+    :param int compress_threads: Number of threads for compressing, and the
+                                 number of processes of process_pool
+    :param process_pool: Optional ProcessPoolExecutor for decompressing
+    :param bool count: Count reads and (uncompressed) bytes of the data as it
+                       is copied.  Kernel-side copying is not used then, and
+                       gzipped input copied as-is is decompressed for
+                       counting.
+    :param Path manifest_file: Manifest to record progress in.  If it exists
+                               and matches the series then work is resumed
+                               after the last completed input.
+    :param str checksum: Name of hashlib algorithm to compute checksums of
+                         input files and the output with.  This requires a
+                         manifest_file.
+    :param Path checksums_file: Checksum manifest to add the checksums to.
+                                When resuming, digests of files that
+                                changed since they were recorded there are
+                                computed again, see find_stale().
+    :param str recompress: BGZF or ZSTD to decompress all input and compress
+                           it in that format, with a block index saved next
+                           to the output file after each input.
+
+    Returns tuple of name of output file, and numbers of reads and bytes,
+    which are None if not counting.
+
+    After each input file the output is synced to disk and the manifest is
+    updated with the input's output range and checksums.  This reads back
+    the written data, which usually is still in the page cache.  Checksums
+    are computed in helper threads, from the read-back data for the output
+    and for plainly copied input, and from the input data as it is read
+    otherwise.
     """
-    with outfile.open('ab') as outf:
-        for i in series:
-            if i.suffix == '.gz' and outfile.suffix != '.gz':
-                infile = gzip.open(str(i), 'r')
-                action = 'extr'
-            else:
+    reads = num_bytes = None
+    if count:
+        reads = num_bytes = 0
+
+    manifest = None
+    if manifest_file is not None:
+        manifest = _load_manifest(manifest_file, series)
+        if manifest is None:
+            manifest = {
+                'version': MANIFEST_VERSION,
+                'output': str(outfile),
+                'series': [_input_info(i) for i in series],
+                'done': [],
+                'crc32': 0,
+                'complete': False,
+            }
+
+    out_hash = None
+    with ExitStack() as cleanup, open_append(outfile) as outf:
+        num_done = 0
+        index = None
+        if recompress is not None:
+            out_compression, _, writer = RECOMPRESS[recompress]
+            idx_path = index_path(outfile, out_compression)
+        else:
+            writer = BGZFWriter
+
+        if manifest is not None:
+            num_done = _resume(outf, manifest, sample, verbosity)
+            if recompress is not None and num_done:
+                index = _resume_index(idx_path, manifest)
+                if index is None:
+                    if verbosity > 0:
+                        print('{}: block index of {} is missing or corrupt, '
+                              'starting over'.format(sample, outfile),
+                              file=sys.stderr)
+                    del manifest['done'][:]
+                    outf.truncate(0)
+                    outf.seek(0)
+                    num_done = 0
+            manifest['crc32'] = manifest['done'][-1]['running_crc32'] \
+                if num_done else 0
+            manifest['complete'] = manifest['complete'] \
+                and num_done == len(series)
+            if checksum is not None:
+                if manifest.get('checksum') != checksum:
+                    for entry in manifest['done']:
+                        entry['digest'] = None
+                    manifest['output_digest'] = None
+                if num_done < len(series):
+                    manifest['output_digest'] = None
+                manifest['checksum'] = checksum
+                if num_done and checksums_file is not None:
+                    # recorded digests of since changed files are void
+                    stale = _stale_files(checksums_file)
+                    if str(outfile.resolve()) in stale:
+                        manifest['output_digest'] = None
+                    for entry, i in zip(manifest['done'], series):
+                        if str(i.resolve()) in stale:
+                            entry['digest'] = None
+                if manifest['output_digest'] is None:
+                    out_hash = HashThread(checksum)
+                    cleanup.callback(out_hash.close)
+                    if num_done:
+                        # get output checksum up to here
+                        _checksum(outf, 0, manifest['done'][-1]['end'], 0,
+                                  (out_hash, ))
+                for entry, i in zip(manifest['done'], series):
+                    if entry['digest'] is None:
+                        in_hash = HashThread(checksum)
+                        in_hash.update_file(i)
+                        entry['digest'] = in_hash.hexdigest()
+            if count:
+                for entry, i in zip(manifest['done'], series):
+                    if entry['reads'] is None:
+                        counter = _count_input(i)
+                        entry['reads'] = counter.count()
+                        entry['data_bytes'] = counter.bytes
+                    reads += entry['reads']
+                    num_bytes += entry['data_bytes']
+
+        if recompress is not None and index is None:
+            index = BlockIndex(outf.tell())
+
+        for i in series[num_done:]:
+            compression = detect_compression(i)
+            in_hash = hashing = None
+            if checksum is not None:
+                in_hash = HashThread(checksum)
+            out = outf
+            action = _action(compression, outfile, recompress)
+            if action == 'copy':
                 infile = i.open('rb')
-                action = 'copy'
+            elif action == 'extr' and compression == GZIP \
+                    and process_pool is not None:
+                # gunzip_parallel() opens the file itself
+                infile = None
+            else:
+                if in_hash is not None:
+                    hashing = HashingReader(i.open('rb', buffering=0), in_hash)
+                infile = open_input(hashing or i)
+                if action == 'comp':
+                    out = writer(outf, threads=compress_threads,
+                                 closefd=False, index=index)
 
             if verbosity > DEFAULT_VERBOSITY:
                 try:
@@ -297,32 +947,95 @@ def _do_extract_and_copy(sample, outfile, series, verbosity):
                 print('{}: {} {} >> {}'.format(sample, action, i,
                       dest))
 
-            try:
-                shutil.copyfileobj(infile, outf, 4 * 1024 * 1024)
+            counter = RecordCounter(4, str(i)) if count else None
+            start = outf.tell()
 
-            finally:
-                infile.close()
+            if infile is None:
+                if in_hash is not None:
+                    in_hash.update_file(i)
+                gunzip_parallel(i, outf, process_pool, compress_threads,
+                                stats=counter)
+            else:
+                try:
+                    if counter is None and action == 'copy':
+                        copy_range(infile, outf, 0)
+                    elif counter is None:
+                        shutil.copyfileobj(infile, out, 4 * 1024 * 1024)
+                    elif compression == GZIP and action == 'copy':
+                        # copy compressed data, count decompressed
+                        copy_range(infile, outf, 0)
+                        counter = _count_input(i)
+                    else:
+                        copy_stats(infile, out, counter)
+                    if out is not outf:
+                        out.close()
+                    if hashing is not None:
+                        hashing.finish()
+
+                finally:
+                    infile.close()
+            if hashing is not None:
+                hashing.close()
+
+            if counter is not None:
+                reads += counter.count()
+                num_bytes += counter.bytes
+
+            if index is not None:
+                index.save(idx_path)
+
+            if manifest is not None:
+                outf.flush()
+                end = outf.tell()
+                os.fsync(outf.fileno())
+                hashers = []
+                if checksum is not None:
+                    hashers.append(out_hash)
+                    if action == 'copy':
+                        # input data is what was written
+                        hashers.append(in_hash)
+                crc, manifest['crc32'] = _checksum(outf, start, end,
+                                                   manifest['crc32'], hashers)
+                manifest['done'].append({
+                    'path': str(i),
+                    'action': action,
+                    'end': end,
+                    'bytes': end - start,
+                    'crc32': crc,
+                    'running_crc32': manifest['crc32'],
+                    'reads': None if counter is None else counter.count(),
+                    'data_bytes': None if counter is None else counter.bytes,
+                    'data_end': None if index is None else index.end[1],
+                    'digest': None if in_hash is None else in_hash.hexdigest(),
+                })
+                _save_manifest(manifest_file, manifest)
+
+        if manifest is not None and not manifest['complete']:
+            manifest['complete'] = True
+            _save_manifest(manifest_file, manifest)
+
+        if checksum is not None:
+            if out_hash is not None:
+                manifest['output_digest'] = out_hash.hexdigest()
+                _save_manifest(manifest_file, manifest)
+            if checksums_file is not None:
+                _record_checksums(
+                    checksums_file,
+                    checksum,
+                    {i: e['digest'] for i, e in zip(series, manifest['done'])},
+                    (outfile, manifest['output_digest']),
+                )
 
-    return outf.name
+    return outf.name, reads, num_bytes
 
 
 def count_fastq_reads(path, verbose=False):
     """
     Count number of reads in fastq file
     """
-    count = 0
-    args = [iter(path.open('rb'))] * 4
     if verbose:
         print('Start counting reads for {}...'.format(path))
-    for read in zip_longest(*args):
-        if read[-1] is None:
-            raise RuntimeError(
-                'Line count is not a multiple of 4: {}, read count at {}\n'
-                'Last lines are:\n{}'
-                ''.format(path, count, '\n'.join([str(i) for i in read]))
-            )
-        count += 1
-    return count
+    return count_records(path, 4)
 
 
 def main(argv=None):
@@ -351,23 +1064,80 @@ def main(argv=None):
     argp.add_argument(
         '--count-reads',
         action='store_true',
-        help='Make simple read-count statistics',
+        help='Make simple read-count statistics.  Reads and bytes of the '
+             'forward reads are counted while copying.',
+    )
+    argp.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Print the job plan with estimated run times, but do not copy '
+             'anything',
+    )
+    argp.add_argument(
+        '--max-decompress',
+        type=int,
+        metavar='N',
+        default=None,
+        help='Maximum number of jobs that decompress or compress data to run '
+             'at once.  By default this is the number of threads.',
+    )
+    argp.add_argument(
+        '--max-copy',
+        type=int,
+        metavar='N',
+        default=None,
+        help='Maximum number of plain copy jobs to run at once, by default {}'
+             ''.format(DEFAULT_MAX_COPY),
+    )
+    argp.add_argument(
+        '--io-budget',
+        type=float,
+        metavar='MB/S',
+        default=None,
+        help='Do not start more jobs than fit in this I/O bandwidth according '
+             'to their estimated rates of reading and writing.  By default '
+             'there is no limit.',
+    )
+    argp.add_argument(
+        '--checksum',
+        metavar='ALGORITHM',
+        choices=sorted(i for i in hashlib.algorithms_guaranteed
+                       if not i.startswith('shake')),
+        default=None,
+        help='Compute checksums of input and output files with the given '
+             'algorithm, e.g. md5, while copying.  They are saved per sample '
+             'in {}/{}/<sample>/{} in the destination directory.'
+             ''.format(OMICS_DIR, MANIFEST_DIR, CHECKSUMS_FILE),
     )
     argp.add_argument(
         '--force', '-f',
         action='store_true',
         help='Overwrite existing files.  This has no effect is used together '
-             'with --skip-existing',
+             'with --skip-existing.  Interrupted work is started over.',
     )
     argp.add_argument(
         '--skip-existing',
         action='store_true',
-        help='Skip sample when a destination file exists',
+        help='Skip sample when a destination file exists.  Files left '
+             'incomplete by an earlier, interrupted, run are still resumed.',
     )
     argp.add_argument(
         '--keep-compression',
         action='store_true',
-        help='Keep files in compressed format.  The default is to decompress.',
+        help='Keep files in gzip-compressed format.  The default is to '
+             'decompress.  If some of a sample\'s files are gzipped then '
+             'any other files of the sample are re-compressed.',
+    )
+    argp.add_argument(
+        '--recompress',
+        choices=sorted(RECOMPRESS),
+        default=None,
+        help='Decompress all input once and write the output compressed, '
+             'either in BGZF format, which is gzip compatible, or in zstd '
+             'format, using the given number of threads.  A block index is '
+             'written next to each output file, with {} or {} suffix, which '
+             'allows other tools to decompress the data in parallel.'
+             ''.format(INDEX_SUFFIX[GZIP], INDEX_SUFFIX[ZSTD]),
     )
     argp.add_argument(
         '--keep-lanes-separate',
@@ -389,14 +1159,22 @@ def main(argv=None):
     argp.add_argument(
         '--suffix',
         metavar='LIST',
-        default='fastq,fastq.gz',
+        default='fastq,fastq.gz,fastq.bz2,fastq.xz,fastq.zst',
         help='Comma-separated list of valid file suffices used for raw reads.'
              ' This is used to find files when a directory is given as '
-             'positional argument.  By default .fastq and .fastq.gz files '
-             'are considered.',
+             'positional argument.  By default .fastq files and gzip, bzip2, '
+             'xz, or zstd compressed .fastq files are considered.',
     )
     args = argp.parse_args(argv)
 
+    if args.keep_compression and args.recompress is not None:
+        argp.error('The --keep-compression and --recompress options are '
+                   'mutually exclusive')
+    for opt in ('max_copy', 'max_decompress'):
+        if getattr(args, opt) is not None and getattr(args, opt) < 1:
+            argp.error('The --{} option must be at least 1'
+                       ''.format(opt.replace('_', '-')))
+
     dest = Path(args.dest)
     if not dest.is_dir():
         argp.exit('Not a directory: {}'.format(args.dest))
@@ -430,85 +1208,99 @@ def main(argv=None):
     if very_verbose:
         print('Using {} threads.'.format(args.threads))
 
-    files = list(set(files))
+    files = sorted(set(files))
     samp_count = 0
     read_counts = {}
+    byte_counts = {}
+    process_pool = None
 
     try:
+        jobs = []
+        file_groupings = group(files, keep_lanes=args.keep_lanes,
+                               multi_run=args.multi_run,
+                               verbosity=verbosity)
+        for samp_key, samp_grp in file_groupings:
+            samp_count += 1
+
+            samp_key = list(samp_key)
+            if len(samp_key) > 1:
+                try:
+                    # remove leading zeros
+                    samp_key[1] = str(int(samp_key[1]))
+                except Exception:
+                    pass
+
+            jobs += setup_sample(
+                '_'.join(samp_key),
+                list(samp_grp),
+                dest=dest,
+                force=args.force,
+                verbosity=verbosity,
+                keep_compression=args.keep_compression,
+                skip_existing=args.skip_existing,
+                dry_run=args.dry_run,
+                recompress=args.recompress,
+            )
+
+        slots = {
+            'copy': min(args.threads, DEFAULT_MAX_COPY),
+            'decompress': args.threads,
+        }
+        if args.max_copy is not None:
+            slots['copy'] = args.max_copy
+        if args.max_decompress is not None:
+            slots['decompress'] = args.max_decompress
+        io_budget = None if args.io_budget is None else args.io_budget * 1e6
+        scheduler = Scheduler(jobs, args.threads, slots, io_budget)
+
+        if args.dry_run:
+            print_plan(scheduler.simulate())
+            return
+
+        if args.threads > 1:
+            # for parallel gunzip; the first job makes the pool fork all its
+            # workers now, before any threads are running
+            process_pool = ProcessPoolExecutor(max_workers=args.threads)
+            process_pool.submit(int).result()
+
         with ThreadPoolExecutor(max_workers=args.threads) as e:
             futures = {}
-            file_groupings = group(files, keep_lanes=args.keep_lanes,
-                                   multi_run=args.multi_run,
-                                   verbosity=verbosity)
-            for samp_key, samp_grp in file_groupings:
-                samp_count += 1
-
-                samp_key = list(samp_key)
-                if len(samp_key) > 1:
-                    try:
-                        # remove leading zeros
-                        samp_key[1] = str(int(samp_key[1]))
-                    except Exception:
-                        pass
-
-                futures.update(
-                    prep(
-                        '_'.join(samp_key),
-                        list(samp_grp),
-                        dest=dest,
-                        force=args.force,
-                        verbosity=verbosity,
-                        keep_compression=args.keep_compression,
-                        skip_existing=args.skip_existing,
-                        executor=e,
-                    )
-                )
-
-            while futures:
-                for fut in as_completed(futures.keys()):
-                    job_meta = futures[fut]
-                    if len(job_meta) == 1:
-                        # read counting job, job_meta is 1-tuple
-                        sample = futures[fut][0]
-                        count = fut.result()
+            while scheduler:
+                started = scheduler.start()
+                compress_threads = scheduler.thread_share(args.threads)
+                for job in started:
+                    if very_verbose:
+                        print('Start: {} ({}, est. {})'.format(
+                            job.outfile, job.kind, _hms(job.seconds)
+                        ))
+                    job_args = _job_args(job, dest, verbosity,
+                                         compress_threads, process_pool,
+                                         args.count_reads, args.checksum)
+                    futures[e.submit(_do_extract_and_copy, *job_args)] = job
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    job = futures.pop(fut)
+                    scheduler.finish(job)
+                    sample, direction = job.sample, job.direction
+                    outfile, reads, num_bytes = fut.result()
+                    if very_verbose:
+                        print(
+                            'Done: {} {}'.format(
+                                sample,
+                                'fwd' if direction == 1 else 'rev'
+                            ),
+                        )
+                    if reads is not None:
                         if sample in read_counts:
                             raise RuntimeError(
                                 'Already counted reads for {} (internal error)'
                                 ''.format(sample)
                             )
-                        else:
-                            read_counts[sample] = count
-                            if verbose:
-                                print('{}: {} reads'.format(sample, count))
-                    elif len(job_meta) == 2:
-                        # was an extract/copy job, job_meta is 2-tuple
-                        sample, direction = futures[fut]
-                        outfile = Path(fut.result())
-                        if very_verbose:
-                            print(
-                                'Done: {} {}'.format(
-                                    sample,
-                                    'fwd' if direction == 1 else 'rev'
-                                ),
-                                end=''
-                            )
-                        if args.count_reads and direction == 1:
-                            futures[e.submit(
-                                count_fastq_reads,
-                                outfile,
-                                verbose=verbose,
-                            )] = (sample, )
-                        if fut.exception() is not None:
-                            print('Failed to write: {}: {}: {}'
-                                  ''.format(sample, direction, outfile),
-                                  file=sys.stderr)
-                    else:
-                        raise RuntimeError(
-                            '(internal error) invalid futures structure: '
-                            '{}: {}: {}'
-                            ''.format(e.__class__.__name__, e, job_meta)
-                        )
-                    del futures[fut]
+                        read_counts[sample] = reads
+                        byte_counts[sample] = num_bytes
+                        if verbose:
+                            print('{}: {} reads'.format(sample, reads))
 
     except FileNameDoesNotMatch as e:
         print('The name of file {} does not follow the supported pattern:\n'
@@ -526,9 +1318,14 @@ def main(argv=None):
             print('{}: {}'.format(e.__class__.__name__, e), file=sys.stderr)
             sys.exit(1)
 
+    finally:
+        if process_pool is not None:
+            process_pool.shutdown(cancel_futures=True)
+
     if args.count_reads:
         with open(READ_COUNT_FILE_NAME, 'w') as f:
-            write_read_counts(read_counts, f, 'read_counts.pdf')
+            write_read_counts(read_counts, f, 'read_counts.pdf',
+                              byte_counts=byte_counts)
 
         if verbose:
             print('read counts written to', READ_COUNT_FILE_NAME)
@@ -16,7 +16,6 @@
 # with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
-from itertools import zip_longest
 from operator import itemgetter
 from pathlib import Path
 import sys
@@ -24,6 +23,7 @@ import sys
 import matplotlib
 
 from . import get_argparser
+from .seqio import count_records
 
 
 def main(argv=None):
@@ -95,34 +95,10 @@ def count_fastaq_reads(path):
     """
     Count number of reads in fasta/q file
     """
-    file = path.open('rb')
-    marker = file.peek()[:1]
-    if marker == b'@':
-        # FASTQ
-        read_lines = 4
-    elif marker == b'>':
-        # FASTA
-        read_lines = 2
-    else:
-        raise RuntimeError(
-            'Failed to detect fileformat: {} is neither valid FASTA nor FASTQ:'
-            ' file starts: "{}"'.format(path, file.peek()[:10].decode())
-        )
-
-    count = 0
-    args = [iter(file)] * read_lines
-    for read in zip_longest(*args):
-        if read[-1] is None:
-            raise RuntimeError(
-                'Line count is not a multiple of {}: {}, read count at {}\n'
-                'Last lines are:\n{}'
-                ''.format(path, count, '\n'.join([str(i) for i in read]))
-            )
-        count += 1
-    return count
-
-
-def make_output(read_counts, outfile, pdfout=None):
+    return count_records(path)
+
+
+def make_output(read_counts, outfile, pdfout=None, byte_counts=None):
     """
     Write counts to file(s)
 
@@ -130,10 +106,16 @@ def make_output(read_counts, outfile, pdfout=None):
     :param file outfile: file-like object
     :param pdfout: String of PDF file or file-like object to save
                    PDF figure or None to disable PDF output
+    :param dict byte_counts: Optional dict mapping sample id to the size of
+                             the (uncompressed) data, written as a third
+                             column, followed by the mean bytes per read.
     """
     for sample, count in sorted(read_counts.items()):
-        out = '{}\t{}\n'.format(sample, count)
-        outfile.write(out)
+        out = '{}\t{}'.format(sample, count)
+        if byte_counts is not None:
+            size = byte_counts[sample]
+            out += '\t{}\t{:.1f}'.format(size, size / count if count else 0)
+        outfile.write(out + '\n')
 
     if pdfout is not None:
         plot(read_counts, pdfout)
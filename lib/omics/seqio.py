@@ -0,0 +1,345 @@
+# Copyright 2026 Regents of The University of Michigan.
+
+# This file is part of geo-omics-scripts.
+
+# Geo-omics-scripts is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+
+# Geo-omics-scripts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with Geo-omics-scripts.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Block-wise FASTA/FASTQ parsing
+
+Sequence files are read in large blocks and lines and records are located via
+the positions of newline characters, found with numpy, instead of iterating
+over lines in python.  Data is handed out in batches of complete records as
+tuples (offset, data, newlines):
+
+    offset:   file position of the first byte of the batch
+    data:     bytes holding the batch's records
+    newlines: numpy array with positions of the newline characters in data
+
+Records must have the sequence (and quality scores) on a single line, i.e.
+FASTA records have two lines and FASTQ records have four.
+"""
+
+from pathlib import Path
+
+import numpy
+
+from .fileio import open_input
+
+FASTA = 'fasta'
+FASTQ = 'fastq'
+
+LINES_PER_RECORD = {FASTA: 2, FASTQ: 4}
+HEADER_CHAR = {FASTA: ord('>'), FASTQ: ord('@')}
+
+BLOCK_SIZE = 4 * 1024 * 1024
+BATCH_RECORDS = 65536
+
+
+def detect_format(file):
+    """
+    Detect FASTA or FASTQ format from the first character of a file
+
+    :param file: Binary file object that supports peek()
+
+    :return: FASTA or FASTQ
+    """
+    head = file.peek(1)[:1]
+    if not head:
+        raise RuntimeError('File empty?: {}'.format(file.name))
+    for fmt, char in HEADER_CHAR.items():
+        if head[0] == char:
+            return fmt
+    raise RuntimeError('Bad file format: {}: expected > or @ as first '
+                       'character but got {}'.format(file.name, head))
+
+
+def read_batches(file, num_records=BATCH_RECORDS, lines_per_record=4,
+                 end=None):
+    """
+    Read file in batches of complete records
+
+    :param file: File-like object opened in binary mode, reading starts at the
+                 current position.
+    :param int num_records: Number of records per batch, the last batch may
+                            have fewer.
+    :param int lines_per_record: Number of lines per record, e.g. 4 for fastq
+    :param int end: Stop reading at this file offset.  By default read to end
+                    of file.
+
+    :return: Iterator over tuples (offset, data, newlines) where offset is the
+             file position of the batch's first byte, data is a bytes-like
+             object holding the batch's records, and newlines is a numpy array
+             of the positions of the newline characters in data.
+
+    Data is read in large blocks and record boundaries are found by locating
+    newlines via numpy, without splitting the data into per-line objects.  A
+    missing newline at the end of file is added.  For unseekable input, like
+    pipes, offsets count from the first byte read.
+    """
+    want = num_records * lines_per_record
+    try:
+        offset = file.tell()
+    except OSError:
+        offset = 0
+    buf = bytearray()
+    newlines = numpy.empty(0, dtype=numpy.int64)
+    eof = False
+    while True:
+        while len(newlines) < want and not eof:
+            size = BLOCK_SIZE
+            if end is not None:
+                size = min(size, end - offset - len(buf))
+            block = file.read(size) if size > 0 else b''
+            if not block:
+                eof = True
+                if buf and buf[-1] != ord('\n'):
+                    block = b'\n'
+                else:
+                    break
+            nl = numpy.flatnonzero(
+                numpy.frombuffer(block, dtype=numpy.uint8) == ord('\n')
+            )
+            newlines = numpy.concatenate([newlines, nl + len(buf)])
+            buf += block
+
+        num_lines = min(len(newlines), want)
+        num_lines -= num_lines % lines_per_record
+        if num_lines == 0:
+            if buf:
+                raise RuntimeError(
+                    'Line count is not a multiple of {}: {}, last lines '
+                    'are:\n{}'.format(lines_per_record, file.name,
+                                      bytes(buf[:500]).decode())
+                )
+            return
+
+        cut = int(newlines[num_lines - 1]) + 1
+        yield offset, bytes(buf[:cut]), newlines[:num_lines]
+        del buf[:cut]
+        newlines = newlines[num_lines:] - cut
+        offset += cut
+
+
+def line_bounds(newlines):
+    """
+    Get start (inclusive) and end (exclusive, at the newline) of each line
+    """
+    starts = numpy.empty_like(newlines)
+    starts[:1] = 0
+    starts[1:] = newlines[:-1] + 1
+    return starts, newlines
+
+
+def record_bounds(batch, lines_per_record=4):
+    """
+    Get start (inclusive) and end (exclusive, past the newline) of records
+
+    :return: Tuple of two numpy arrays with positions in the batch's data
+    """
+    newlines = batch[2]
+    ends = newlines[lines_per_record - 1::lines_per_record] + 1
+    starts = numpy.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1]
+    return starts, ends
+
+
+def records(batch, lines_per_record=4):
+    """
+    Get the records of a batch
+
+    :return: List of memoryview slices of the batch's data, one per record,
+             including the final newline.
+    """
+    data = memoryview(batch[1])
+    starts, ends = record_bounds(batch, lines_per_record)
+    return [data[s:e] for s, e in zip(starts.tolist(), ends.tolist())]
+
+
+def lines(batch, *which, lines_per_record=4):
+    """
+    Get lists of lines (without newline) of a batch of records
+
+    :param which: Line numbers within the record, e.g. 0 for the header
+
+    Returns a list of bytes for each requested line number.
+    """
+    _, data, newlines = batch
+    starts, ends = line_bounds(newlines)
+    ret = []
+    for i in which:
+        ret.append([
+            data[s:e] for s, e
+            in zip(starts[i::lines_per_record].tolist(),
+                   ends[i::lines_per_record].tolist())
+        ])
+    return ret
+
+
+def check_batch(batch, name, fmt=FASTQ):
+    """
+    Sanity checks for a batch of fasta or fastq records
+
+    Checks that headers start with > or @ and, for fastq, that the third line
+    of each record starts with +.  This works for interleaved records, too.
+    """
+    _, data, newlines = batch
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+    starts, _ = line_bounds(newlines)
+    num_lines = LINES_PER_RECORD[fmt]
+    bad = numpy.flatnonzero(buf[starts[0::num_lines]] != HEADER_CHAR[fmt])
+    if len(bad):
+        i = num_lines * bad[0]
+        raise RuntimeError('Expected {} header in {}: {}'
+                           ''.format(fmt, name, data[starts[i]:newlines[i]]))
+    if fmt == FASTQ:
+        bad = numpy.flatnonzero(buf[starts[2::4]] != ord('+'))
+        if len(bad):
+            i = starts[4 * bad[0] + 2]
+            raise RuntimeError('Expected + line in {}: {}'
+                               ''.format(name, data[i:i + 50]))
+
+
+def deinterleave_batch(batch, lines_per_record=4):
+    """
+    Split a batch of interleaved paired records
+
+    :param batch: A batch of records of 2 * lines_per_record lines, as made
+                  by read_batches()
+    :param int lines_per_record: Number of lines of a single read
+
+    :return: Tuple of forward batch, reverse batch, and the file offsets of
+             the read pairs.  The batches hold the data of the respective
+             reads, their offsets are meaningless.
+    """
+    offset, data, newlines = batch
+    n = lines_per_record
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+    pair_starts, pair_ends = record_bounds(batch, 2 * n)
+    nl = newlines.reshape(-1, 2 * n)
+    # mark bytes of forward reads: from line 0 to past line n - 1 of each pair
+    mark = numpy.zeros(len(buf) + 1, dtype=numpy.int8)
+    mark[pair_starts] = 1
+    mark[nl[:, n - 1] + 1] = -1
+    fwd = numpy.cumsum(mark[:-1], dtype=numpy.int8).view(bool)
+    fwd_data = buf[fwd].tobytes()
+    rev_data = buf[~fwd].tobytes()
+    del mark, fwd
+
+    # newline positions in the compacted data
+    fwd_lens = nl[:, n - 1] + 1 - pair_starts
+    rev_lens = pair_ends - fwd_lens - pair_starts
+    fwd_shift = numpy.cumsum(rev_lens) - rev_lens
+    rev_shift = numpy.cumsum(fwd_lens)
+    fwd_nl = (nl[:, :n] - fwd_shift[:, None]).ravel()
+    rev_nl = (nl[:, n:] - rev_shift[:, None]).ravel()
+
+    return (offset, fwd_data, fwd_nl), (0, rev_data, rev_nl), \
+        pair_starts + offset
+
+
+def interleave_batches(fwd_batch, rev_batch, lines_per_record=4):
+    """
+    Interleave the records of two batches
+
+    :return: List of memoryviews, forward and reverse records alternating,
+             ready to be written out or joined.
+    """
+    fwd = records(fwd_batch, lines_per_record)
+    rev = records(rev_batch, lines_per_record)
+    if len(fwd) != len(rev):
+        raise ValueError('batches have different number of records')
+    ret = [None] * (2 * len(fwd))
+    ret[0::2] = fwd
+    ret[1::2] = rev
+    return ret
+
+
+class RecordCounter:
+    """
+    Count fasta or fastq records of data passed in pieces
+
+    This counts newlines of each piece as it goes by, e.g. while copying a
+    file, and keeps track of the number of bytes.
+    """
+    def __init__(self, lines_per_record=4, name=None):
+        """
+        :param int lines_per_record: Number of lines per record
+        :param str name: Name of the data's source, for error messages
+        """
+        self.lines_per_record = lines_per_record
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        """
+        Start over at zero
+        """
+        self.bytes = 0
+        self.lines = 0
+        self._last = b'\n'
+
+    def update(self, data):
+        """
+        Count the newlines in the next piece of data
+        """
+        if data:
+            self.bytes += len(data)
+            self.lines += data.count(b'\n')
+            self._last = data[-1:]
+
+    def count(self):
+        """
+        Get the number of records so far
+
+        A missing final newline is accounted for.  Raises RuntimeError if the
+        number of lines is not a multiple of the lines per record.
+        """
+        lines = self.lines
+        if self._last != b'\n':
+            lines += 1
+        if lines % self.lines_per_record:
+            raise RuntimeError(
+                'Line count is not a multiple of {}: {}, line count is {}'
+                ''.format(self.lines_per_record, self.name, lines)
+            )
+        return lines // self.lines_per_record
+
+
+def count_records(file, lines_per_record=None):
+    """
+    Count records in fasta or fastq file
+
+    :param file: Path, str, or binary file object
+    :param int lines_per_record: Number of lines per record.  By default the
+                                 format is detected and 2 or 4 lines are used.
+
+    Only newlines are counted, in large blocks, and a missing final newline is
+    accounted for.  Compressed files given by path are decompressed.
+    """
+    if isinstance(file, (str, Path)):
+        with open_input(file) as f:
+            return count_records(f, lines_per_record)
+
+    if lines_per_record is None:
+        lines_per_record = LINES_PER_RECORD[detect_format(file)]
+
+    counter = RecordCounter(lines_per_record, file.name)
+    while True:
+        block = file.read(BLOCK_SIZE)
+        if not block:
+            break
+        counter.update(block)
+    return counter.count()
@@ -20,24 +20,46 @@
 """
 Implementation of mothur shared file format
 """
-from array import array
 import argparse
 from collections import Counter
 from collections import namedtuple
-from concurrent.futures import (ProcessPoolExecutor as PoolExecutor,
-                                as_completed)
+from concurrent.futures import ProcessPoolExecutor as PoolExecutor
+from itertools import chain
+import json
 import math
 from mmap import mmap, ACCESS_READ
+from multiprocessing import resource_tracker, shared_memory
 import os.path
 from pathlib import Path
 import sys
+import tempfile
+import warnings
 
 import numpy
 import pandas
 
+try:
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
 DEFAULT_THREADS = 1
 DEFAULT_OTU_NUM_PREFIX = 'Otu'
 
+# count matrix backends, and the fraction of non-zero counts below which the
+# sparse backend gets auto-selected
+DENSE = 'dense'
+SPARSE = 'sparse'
+SPARSE_DENSITY = 0.1
+
+COUNT_DTYPE = numpy.dtype('int32')
+
+# cache files of parsed input, see write_cache()
+CACHE_SUFFIX = '.omics-cache'
+CACHE_MAGIC = b'OMICSSHC'
+CACHE_VERSION = 1
+CACHE_ALIGN = 64
+
 # file format id names
 AUTO_DETECT = 'autodetect'
 SHARED = 'mothur shared'
@@ -76,20 +98,26 @@ SPEC_DEFAULTS = (False, False, None, False)
 Spec = namedtuple('Spec', ['name'] + SPEC_FIELDS, defaults=SPEC_DEFAULTS)
 
 
-class MothurShared():
-    def __init__(self, file_arg, verbose=True, threads=DEFAULT_THREADS,
-                 file_format=AUTO_DETECT):
-        self.verbose = verbose
-        self.threads = threads
-        if isinstance(file_arg, str):
-            file = open(file_arg, 'r')
-        elif isinstance(file_arg, Path):
-            file = file_arg.open('r')
-        else:
-            # assume a file-like object
-            file = file_arg
+class _SharedBase():
+    """
+    Parsing of shared files and count tables common to MothurShared and
+    SharedReader
+    """
+    # row and column selection, see MothurShared, by default all are read
+    _row_select = None
+    _col_keep = None
+    _col_map = None
+
+    def _read_header(self, file, file_format):
+        """
+        Detect the file format and read the table header
 
-        file.seek(0)
+        Sets the format spec and returns the column labels of the input,
+        i.e. the OTUs of a shared file or the samples of a count table.  The
+        file is left positioned at the first row of data.
+        """
+        if file.seekable():
+            file.seek(0)
         head = file.readline().strip()
 
         if file_format == AUTO_DETECT:
@@ -120,30 +148,208 @@ class MothurShared():
             )
 
         input_cols = head.split('\t')[self.spec.num_index_cols:]
+        self._num_input_cols = len(input_cols)
+        return input_cols
+
+    def _check_label(self, row_meta):
+        """
+        Check that all rows of a shared file have the same label
+        """
+        if row_meta != self.label:
+            if self.label is None:
+                self.label = row_meta
+            else:
+                raise RuntimeError(
+                    'This shared file contained multiple label, '
+                    'handling this requires implementation: {} != {}'
+                    ''.format(row_meta, self.label))
+
+    def process_line(self, line):
+        """
+        Get the non-zero counts from line
+
+        Returns the row id, the row meta data, and numpy arrays of the column
+        indices and values of the non-zero counts.  For compressed count
+        tables all listed counts are returned.  With a column selection the
+        indices refer to the selected columns.  For rows not selected the
+        counts are not parsed and None is returned in place of the arrays.
+        """
+        num_index_cols = self.spec.num_index_cols
+        fields = line.strip().split('\t', num_index_cols)
+        if len(fields) < num_index_cols:
+            raise RuntimeError('Failed to parse input: offending line '
+                               'is:\n{}'.format(line[:200]))
+        if self.spec.name == SHARED:
+            # first field is label, return as row meta data
+            # second field is sample, return as row id
+            # third field is numOtus? -- ignore
+            row_meta, row_id = fields[:2]
+        else:
+            # count tables:
+            # first field is sequence id, return as row id
+            # second field is the total for the sequence, ignore
+            row_meta, row_id = None, fields[0]
+        if self._row_select is not None and not self._row_select(row_id):
+            return row_id, row_meta, None, None
+        data = fields[num_index_cols] if len(fields) > num_index_cols else ''
+        num_fields = data.count('\t') + 1 if data else 0
+
+        if self.spec.compressed:
+            # items are two whole numbers, an index for the sample and the
+            # count, separated by a comma
+            values = _parse_ints(data.replace(',', '\t'))
+            if len(values) != 2 * num_fields:
+                raise RuntimeError('Failed to parse counts in line:\n{}'
+                                   ''.format(line[:200]))
+            # the sample index is 1-based!
+            cols = values[0::2] - 1
+            if len(cols) and not 0 <= cols.min() <= cols.max() \
+                    < self._num_input_cols:
+                raise RuntimeError('Sample index out of range in line:\n{}'
+                                   ''.format(line[:200]))
+            values = values[1::2]
+            if self._col_map is not None:
+                cols = self._col_map[cols]
+                select = cols >= 0
+                cols, values = cols[select], values[select]
+            return row_id, row_meta, cols, values
+
+        if num_fields != self._num_input_cols:
+            raise RuntimeError('Expected {} counts but got {} in line:\n{}'
+                               ''.format(self._num_input_cols, num_fields,
+                                         line[:200]))
+        values = _parse_ints(data)
+        if len(values) != num_fields:
+            raise RuntimeError('Failed to parse counts in line:\n{}'
+                               ''.format(line[:200]))
+        if self._col_keep is not None:
+            values = values[self._col_keep]
+        cols = numpy.flatnonzero(values).astype(COUNT_DTYPE)
+        return row_id, row_meta, cols, values[cols]
+
+    def info(self, *args, inline=False, **kwargs):
+        if self.verbose:
+            if inline:
+                print(*args, file=sys.stderr, **kwargs)
+            else:
+                print('[{}]'.format(Path(sys.argv[0]).name), *args,
+                      file=sys.stderr, **kwargs)
+
+
+class MothurShared(_SharedBase):
+    """
+    Implements support for mothur shared files and count tables
+
+    The counts are kept either in a dense pandas.DataFrame or, for the sparse
+    backend, in a scipy.sparse CSR matrix, with samples as rows and OTUs as
+    columns.  With the default, AUTO_DETECT, the sparse backend is used if
+    less than SPARSE_DENSITY of the counts are non-zero and scipy is
+    available.
+
+    With cache=True the parsed data is saved to a cache file next to the
+    input file, see cache_path(), and later loaded from there, memory-mapped,
+    as long as the input file's size and modification time are unchanged.
+
+    With samples and otus a subset of the data can be selected at parse time,
+    each can be a collection of names or a function taking a name and
+    returning True for those to keep, functions must be picklable if threads
+    are used.  Names not in the input are ignored, the selected samples and
+    OTUs keep the order of the input file.  Counts of rows not selected are
+    not parsed.  A selection is also applied to data loaded from the cache,
+    but a cache is not written for selections.
+    """
+    def __init__(self, file_arg, verbose=True, threads=DEFAULT_THREADS,
+                 file_format=AUTO_DETECT, backend=AUTO_DETECT, cache=False,
+                 samples=None, otus=None):
+        self.verbose = verbose
+        self.threads = threads
+        if backend not in (AUTO_DETECT, DENSE, SPARSE):
+            raise ValueError('Invalid backend: {}'.format(backend))
+        if backend == SPARSE and scipy is None:
+            raise RuntimeError('The sparse backend requires the scipy python '
+                               'package to be installed')
+        if isinstance(file_arg, (str, Path)):
+            source = file_arg
+        else:
+            # caching needs a path, file objects may have one
+            source = getattr(file_arg, 'name', None)
+            if not isinstance(source, str) or not os.path.isfile(source):
+                cache = False
+        if cache and self._load_cache(source, file_format, backend,
+                                      samples=samples, otus=otus):
+            return
+        if samples is not None or otus is not None:
+            # do not write cache with partial data
+            cache = False
+
+        if isinstance(file_arg, str):
+            file = open(file_arg, 'r')
+        elif isinstance(file_arg, Path):
+            file = file_arg.open('r')
+        else:
+            # assume a file-like object
+            file = file_arg
+
+        input_cols = self._read_header(file, file_format)
+
+        if self.spec.transposed:
+            self._row_select = _selector(otus)
+            col_select = _selector(samples)
+            self.info('total samples:  ', len(input_cols))
+        else:
+            self._row_select = _selector(samples)
+            col_select = _selector(otus)
+            self.info('total OTUs:  ', len(input_cols))
+
+        if col_select is not None:
+            self._col_keep = numpy.array(
+                [i for i, name in enumerate(input_cols) if col_select(name)],
+                dtype=COUNT_DTYPE,
+            )
+            self._col_map = numpy.full(len(input_cols), -1, dtype=COUNT_DTYPE)
+            self._col_map[self._col_keep] = numpy.arange(len(self._col_keep))
+            input_cols = [input_cols[i] for i in self._col_keep]
+            self.info('selected {}:  '.format(
+                'samples' if self.spec.transposed else 'OTUs'),
+                len(input_cols))
 
         if self.spec.transposed:
             self.samples = input_cols
-            self.info('total samples:  ', len(self.samples))
         else:
             self.otus = input_cols
-            self.info('total OTUs:  ', len(self.otus))
 
         self.label = None
 
-        row_ids, counts = self.get_counts(file)
+        row_ids, (rows, cols, counts) = self.get_counts(file)
 
         if len(row_ids) != len(set(row_ids)):
             raise RuntimeError('Duplicate row ids in intput file')
 
+        shape = (len(row_ids), len(input_cols))
         if self.spec.transposed:
             self.otus = row_ids
-            counts = counts.T
+            rows, cols = cols, rows
+            shape = shape[::-1]
         else:
             self.samples = row_ids
 
-        self.info('Making data frame...', end='', flush=True)
-        self.counts = pandas.DataFrame(counts, index=self.samples,
-                                       columns=self.otus)
+        if backend == AUTO_DETECT:
+            backend = _select_backend(shape, len(counts))
+        self.backend = backend
+
+        self.info('Making {} count matrix...'.format(backend), end='',
+                  flush=True)
+        self.samples = pandas.Index(self.samples)
+        self.otus = pandas.Index(self.otus)
+        if backend == SPARSE:
+            self._counts = scipy.sparse.csr_matrix((counts, (rows, cols)),
+                                                   shape=shape)
+            self._counts.eliminate_zeros()
+        else:
+            dense = numpy.zeros(shape, dtype=COUNT_DTYPE)
+            dense[rows, cols] = counts
+            self._counts = pandas.DataFrame(dense, index=self.samples,
+                                            columns=self.otus)
         self.info('[ok]', inline=True)
         self._update_from_counts(trim=False)
         if self.spec.transposed:
@@ -154,11 +360,142 @@ class MothurShared():
 
         if isinstance(file_arg, (str, Path)):
             file.close()
+        if cache:
+            self._save_cache(source)
         # end init
 
+    def _load_cache(self, path, file_format, backend, samples=None,
+                    otus=None):
+        """
+        Load data from the cache of the given input file
+
+        A selection of samples and OTUs is applied to the memory-mapped
+        arrays, only the selected counts are read into memory.
+
+        Returns True on success, or False if there is no cache or it does not
+        match the input file, file format, or is otherwise unusable.
+        """
+        try:
+            header, arrays = read_cache(path)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError) as e:
+            self.info('Ignoring unusable cache: {}: {}'
+                      ''.format(cache_path(path), e))
+            return False
+        if header['source'] != _cache_key(path):
+            self.info('Cache is outdated:', cache_path(path))
+            return False
+        if file_format not in (AUTO_DETECT, header['format']):
+            return False
+        if header['layout'] == SPARSE and scipy is None:
+            return False
+        shape = (len(header['samples']), len(header['otus']))
+
+        if backend == AUTO_DETECT:
+            backend = _select_backend(shape, header['nnz'])
+
+        self.spec = Spec(name=header['format'], **SPEC[header['format']])
+        self.label = header['label']
+        self.samples = pandas.Index(header['samples'])
+        self.otus = pandas.Index(header['otus'])
+        rows = _selected_positions(self.samples, samples)
+        cols = _selected_positions(self.otus, otus)
+        if rows is not None:
+            self.samples = self.samples[rows]
+        if cols is not None:
+            self.otus = self.otus[cols]
+        if header['layout'] == SPARSE:
+            counts = scipy.sparse.csr_matrix(
+                (arrays['data'], arrays['indices'], arrays['indptr']),
+                shape=shape, copy=False,
+            )
+        else:
+            counts = arrays['counts']
+        if rows is not None:
+            counts = counts[rows]
+        if cols is not None:
+            counts = counts[:, cols]
+        if header['layout'] == SPARSE and backend == DENSE:
+            counts = counts.toarray()
+        elif header['layout'] == DENSE and backend == SPARSE:
+            counts = scipy.sparse.csr_matrix(counts)
+        if backend == SPARSE:
+            self._counts = counts
+        else:
+            self._counts = pandas.DataFrame(counts, copy=False,
+                                            index=self.samples,
+                                            columns=self.otus)
+        self.backend = backend
+        self._update_from_counts(trim=False)
+        self.info('loaded {} x {} counts from cache: {}'
+                  ''.format(self.nrows, self.ncols, cache_path(path)))
+        return True
+
+    def _save_cache(self, path):
+        """
+        Save the data to the cache of the given input file
+
+        Failing to write the cache is not an error.
+        """
+        if self.backend == SPARSE:
+            arrays = {
+                'indptr': self._counts.indptr,
+                'indices': self._counts.indices,
+                'data': self._counts.data,
+            }
+            nnz = self._counts.nnz
+        else:
+            arrays = {'counts': self._counts.to_numpy()}
+            nnz = numpy.count_nonzero(arrays['counts'])
+        header = {
+            'source': _cache_key(path),
+            'format': self.spec.name,
+            'label': self.label,
+            'samples': [str(i) for i in self.samples],
+            'otus': [str(i) for i in self.otus],
+            'layout': self.backend,
+            'nnz': int(nnz),
+        }
+        try:
+            write_cache(path, header, arrays)
+        except OSError as e:
+            self.info('Failed to write cache: {}: {}'
+                      ''.format(cache_path(path), e))
+        else:
+            self.info('saved cache:', cache_path(path))
+
+    @property
+    def counts(self):
+        """
+        The counts as pandas.DataFrame, samples x OTUs
+
+        With the sparse backend this is a new data frame with sparse columns
+        on each access, changing it does not change the data set.
+        """
+        if self.backend == SPARSE:
+            return pandas.DataFrame.sparse.from_spmatrix(
+                self._counts, index=self.samples, columns=self.otus,
+            )
+        return self._counts
+
+    @counts.setter
+    def counts(self, counts):
+        if self.backend == SPARSE:
+            if all(isinstance(i, pandas.SparseDtype) for i in counts.dtypes):
+                matrix = counts.sparse.to_coo()
+            else:
+                matrix = counts.to_numpy()
+            self._counts = scipy.sparse.csr_matrix(matrix)
+        else:
+            self._counts = counts
+        self.samples = counts.index
+        self.otus = counts.columns
+        self._update_from_counts(trim=False)
+
     def _counts_per_sample(self, file):
         """
-        Generates array of counts for one sample
+        Generates the non-zero counts for one sample
 
         This is called by __init__ to import the data.  As side effect it
         collects the sample names and sizes and checks label.
@@ -170,103 +507,129 @@ class MothurShared():
 
         for line in file:
 
-            row_id, row_meta, counts = self.process_line(line)
-            self._input_row_ids.append(row_id)
+            row_id, row_meta, cols, counts = self.process_line(line)
 
             if 'label' in self.spec.index_cols:
                 # row_meta is the label
-                if row_meta != self.label:
-                    if self.label is None:
-                        self.label = row_meta
-                    else:
-                        raise RuntimeError(
-                            'This shared file contained multiple label, '
-                            'handling this requires implementation: {} != {}'
-                            ''.format(row_meta, self.label))
+                self._check_label(row_meta)
 
-            yield numpy.array(counts)
+            if cols is None:
+                # row not selected
+                continue
+            self._input_row_ids.append(row_id)
+            yield cols, counts
 
     def get_counts(self, file):
         """
-        Make a numpy array, single-thread implementation
+        Read the counts, single-thread implementation
+
+        :return: Tuple of the list of row ids and a tuple of numpy arrays of
+                 row indices, column indices, and the counts, i.e. the
+                 non-zero counts in coordinate (COO) format.
         """
         if self.threads > 1:
             return self.get_counts_mp(file)
 
-        counts = numpy.ndarray([], numpy.int32)
-
-        self._input_row_ids = []
-        # stack over a generator is deprecated, numpy issues a warning
-        # TODO: research alternative
-        counts = numpy.stack(
-            self._counts_per_sample(file)
-        )
-        return self._input_row_ids, counts
+        rows, cols, counts = [], [], []
+        for i, (row_cols, row_counts) in \
+                enumerate(self._counts_per_sample(file)):
+            rows.append(numpy.full(len(row_cols), i, dtype=COUNT_DTYPE))
+            cols.append(row_cols)
+            counts.append(row_counts)
+        return self._input_row_ids, _concat_coo(rows, cols, counts)
 
     def get_counts_mp(self, file):
         """
-        Make numpy array, multi-processing+futures implementation
+        Read the counts, multi-processing+futures implementation
 
-        Using the pre-3.8 functionality, (it seems) it's not possible to use
-        shared memory to send the data back from the children.  So we use
-        Pool/starmap and receive arrays through pickling, assemble them and
-        wrap a ndarray around.
+        The file is split into one chunk per process, and the work is done in
+        two rounds.  First the workers count the rows and non-zero counts of
+        their chunk and collect the labels, which must agree across chunks.
+        Then a shared memory buffer for all counts, in coordinate format, is
+        allocated and each worker parses its chunk again, storing the counts
+        directly into its own slice of the buffer.  Only the row ids are sent
+        back, and the rows keep the order of the file.
 
-        TODO: for 3.8 explore the shared_memory submodule
+        Returns the same as get_counts().
         """
         fsize = os.path.getsize(file.name)
         self.info('filesize:', fsize)
         breaks = numpy.linspace(0, fsize, num=self.threads + 1, dtype=int)
         sargs = []
         for i in range(len(breaks) - 1):
-            sargs.append((file.name, breaks[i], breaks[i + 1]))
+            sargs.append((file.name, int(breaks[i]), int(breaks[i + 1])))
 
-        row_ids = []
-        counts = array('i')
+        # workers attaching to the shared memory need to report to the same
+        # resource tracker, start it before the workers
+        resource_tracker.ensure_running()
         with PoolExecutor(max_workers=self.threads) as pe:
-            futmap = {pe.submit(self.chunk2array, *i): i[1] for i in sargs}
-            for future in as_completed(futmap):
-                start = futmap[future]
-                try:
-                    chunk_row_ids, chunk_meta, a = future.result()
-                except Exception as e:
-                    raise RuntimeError(
-                        'Chunk starting at {} failed: {}: {}'
-                        ''.format(start, e.__class__.__name__, e)
-                    )
-                else:
-                    # TODO: preserve order of chunks in file
-                    if chunk_row_ids and 'label' in self.spec.index_cols:
-                        # if there was data in the chunk use label
-                        # FIXME: last worker wins, needs a check
-                        self.label = chunk_meta
-                    row_ids += chunk_row_ids
-                    counts.extend(a)
-
-        counts = numpy.frombuffer(counts, dtype=numpy.dtype('int32'))
-        counts = counts.reshape(len(row_ids), len(counts) // len(row_ids))
-        return row_ids, counts
-
-    def chunk2array(self, path, start, end):
-        """
-        Process one chunk of input file into an array
-
-        This should be run in multi-processing.  If 'start' falls between two
-        lines, the partial line is ignored and processing starts with the next
-        full line.  Likewise, a line extending beyond 'end' will be fully
-        processes.  If no newline falls between 'start' and 'end' then nothing
-        is done. The usual range-semantic is used for 'start' and 'end'.
+            sizes = self._run_chunks(pe, self.count_chunk, sargs)
+            labels = set().union(*[i[2] for i in sizes])
+            if len(labels) > 1:
+                raise RuntimeError(
+                    'This shared file contained multiple label, handling '
+                    'this requires implementation: {}'
+                    ''.format(' != '.join(sorted(labels)))
+                )
+            if labels:
+                self.label = labels.pop()
+
+            total = sum([i[1] for i in sizes])
+            self.info('non-zero counts:', total)
+            shm = shared_memory.SharedMemory(
+                create=True, size=max(1, 3 * total * COUNT_DTYPE.itemsize),
+            )
+            try:
+                args = []
+                row_offset = offset = 0
+                for (path, start, end), (num_rows, nnz, _) in \
+                        zip(sargs, sizes):
+                    args.append((path, start, end, shm.name, total,
+                                 row_offset, offset, nnz))
+                    row_offset += num_rows
+                    offset += nnz
+                row_ids = list(chain(*self._run_chunks(pe, self.chunk2array,
+                                                       args)))
+                coo = tuple(i.copy() for i in _coo_views(shm.buf, total))
+            finally:
+                shm.close()
+                shm.unlink()
+
+        return row_ids, coo
+
+    def _run_chunks(self, executor, fn, args):
+        """
+        Run a function on each chunk in the pool, get results in file order
+        """
+        futures = [executor.submit(fn, *i) for i in args]
+        results = []
+        for future, (_, start, *_) in zip(futures, args):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                for i in futures:
+                    i.cancel()
+                raise RuntimeError(
+                    'Chunk starting at {} failed: {}: {}'
+                    ''.format(start, e.__class__.__name__, e)
+                )
+        return results
+
+    def _chunk_lines(self, path, start, end):
+        """
+        Generate the lines of one chunk of the input file
+
+        If 'start' falls between two lines, the partial line is ignored and
+        processing starts with the next full line.  Likewise, a line extending
+        beyond 'end' will be fully processes.  If no newline falls between
+        'start' and 'end' then nothing is done. The usual range-semantic is
+        used for 'start' and 'end'.
 
         Using the mmap logic seems to be much faster then regular readline over
         the file object.
         """
-        a = array('i')
-        chunk_meta = None
-        if 'label' in self.spec.index_cols:
-            label = None
-        row_ids = []
-        with open(path, 'rb') as f:
-            mm = mmap(f.fileno(), 0, access=ACCESS_READ)
+        with open(path, 'rb') as f, \
+                mmap(f.fileno(), 0, access=ACCESS_READ) as mm:
             mm.seek(start)
             if start > 0 and mm[start - 1] != ord('\n'):
                 # consume partial line
@@ -281,73 +644,74 @@ class MothurShared():
                 mm.readline()
 
             while mm.tell() < end:
-                row_id, row_meta, counts = self.process_line(
-                    mm.readline().decode()
-                )
-                a.extend(counts)
-                row_ids.append(row_id)
-
-                if 'label' in self.spec.index_cols:
-                    # row_meta is the label
-                    # FIXME: setting the label is not coordinated among workers
-                    #        last worker process wins??
-                    if row_meta != label:
-                        if label is None:
-                            label = row_meta
-                        else:
-                            raise RuntimeError(
-                                'This shared file contained multiple label, '
-                                'handling this requires implementation:'
-                                '{} != {}'.format(label, row_meta))
-
-        if 'label' in self.spec.index_cols:
-            chunk_meta = label
-
-        if len(a) > 0.99 * (2 ** 29):
-            # max space for pickling is 2GB, 512x10^6 32bit ints
-            # see https://github.com/python/cpython/pull/10305
-            # fix is in 3.8
-            self.info('[WARNING] too much data in child process for pickling')
-            self.info('array size is', len(a))
+                yield mm.readline().decode()
 
-        return row_ids, chunk_meta, a
+    def count_chunk(self, path, start, end):
+        """
+        Count rows and non-zero counts of one chunk of input file
 
-    def process_line(self, line):
+        This should be run in multi-processing, see get_counts_mp().  Returns
+        the number of rows, the number of non-zero counts and the set of
+        labels found.
         """
-        Get count array from line
+        num_rows = nnz = 0
+        labels = set()
+        for line in self._chunk_lines(path, start, end):
+            _, row_meta, cols, _ = self.process_line(line)
+            if 'label' in self.spec.index_cols:
+                # row_meta is the label
+                labels.add(row_meta)
+            if cols is None:
+                # row not selected
+                continue
+            num_rows += 1
+            nnz += len(cols)
+        return num_rows, nnz, labels
+
+    def chunk2array(self, path, start, end, shm_name, total, row_offset,
+                    offset, nnz):
         """
-        row_meta = None
-        try:
-            if self.spec.name == SHARED:
-                # first field is label, return as row meta data
-                # second field is sample, return as row id
-                # third field is numOtus? -- ignore
-                row_meta, row_id, _, *counts = line.strip().split('\t')
-            else:
-                # count tables:
-                # first field is sequence id, return as row id
-                # second field is the total for the sequence, ignore
-                row_id, _, *counts = line.strip().split('\t')
-        except Exception:
-            raise RuntimeError('Failed to parse input: offending line '
-                               'is:\n'.format(line))
+        Process one chunk of input file into the shared count buffer
 
-        if self.spec.compressed:
-            a = array('i', [0]) * len(self.samples)
-            for item in counts:
-                # items are two whole numbers, an index for the sample and the
-                # count, separated by a comma
-                i, c = item.split(',')
-                # the sample index is 1-based!
-                a[int(i) - 1] = int(c)
-            counts = a
-        else:
-            counts = array('i', map(int, counts))
+        This should be run in multi-processing, see get_counts_mp().  The
+        chunk's counts are written to the shared memory buffer with the given
+        name, which holds arrays of row indices, column indices, and counts
+        of total length each, starting at offset.  Row indices start at
+        row_offset.  The chunk must have nnz non-zero counts as determined by
+        count_chunk().
 
-        return row_id, row_meta, counts
+        Returns the row ids.
+        """
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            rows, cols, counts = _coo_views(shm.buf, total)
+            row_ids = []
+            pos = offset
+            for line in self._chunk_lines(path, start, end):
+                row_id, _, row_cols, row_counts = self.process_line(line)
+                if row_cols is None:
+                    # row not selected
+                    continue
+                n = len(row_cols)
+                if pos + n > offset + nnz:
+                    raise RuntimeError('More counts than expected in chunk')
+                rows[pos:pos + n] = row_offset + len(row_ids)
+                cols[pos:pos + n] = row_cols
+                counts[pos:pos + n] = row_counts
+                pos += n
+                row_ids.append(row_id)
+            if pos != offset + nnz:
+                raise RuntimeError('Fewer counts than expected in chunk')
+            del rows, cols, counts
+        finally:
+            shm.close()
+        return row_ids
 
     def rows(self, counts_only=False, as_iter=False):
-        it = self.counts.iterrows()
+        if self.backend == SPARSE:
+            it = self._sparse_rows()
+        else:
+            it = self.counts.iterrows()
         if counts_only:
             it = (i[1] for i in it)
             if as_iter:
@@ -361,7 +725,10 @@ class MothurShared():
                 return [(i, list(row)) for i, row in it]
 
     def cols(self, counts_only=False, as_iter=False):
-        it = self.counts.iteritems()
+        if self.backend == SPARSE:
+            it = self._sparse_cols()
+        else:
+            it = self.counts.items()
         if counts_only:
             it = (i[1] for i in it)
             if as_iter:
@@ -374,43 +741,100 @@ class MothurShared():
             else:
                 return [(i, list(col)) for i, col in it]
 
-    def get_row(self, sample):
+    def _sparse_rows(self):
+        """
+        Generate (sample, pandas.Series) pairs from the sparse counts
+        """
+        for i, sample in enumerate(self.samples):
+            yield sample, self.get_row(sample, _pos=i)
+
+    def _sparse_cols(self):
+        """
+        Generate (otu, pandas.Series) pairs from the sparse counts
+        """
+        matrix = self._counts.tocsc()
+        for i, otu in enumerate(self.otus):
+            col = numpy.zeros(self.nrows, dtype=matrix.dtype)
+            part = slice(matrix.indptr[i], matrix.indptr[i + 1])
+            col[matrix.indices[part]] = matrix.data[part]
+            yield otu, pandas.Series(col, index=self.samples, name=otu)
+
+    def get_row(self, sample, _pos=None):
         """
         Return list of counts form single sample
         """
+        if self.backend == SPARSE:
+            i = self.samples.get_loc(sample) if _pos is None else _pos
+            matrix = self._counts
+            row = numpy.zeros(self.ncols, dtype=matrix.dtype)
+            part = slice(matrix.indptr[i], matrix.indptr[i + 1])
+            row[matrix.indices[part]] = matrix.data[part]
+            return pandas.Series(row, index=self.otus, name=sample)
         return self.counts.loc[sample]
 
     def pick_otus(self, otus):
         """
         Pick the given OTUs from the data set
         """
-        self.counts = self.counts.loc[:, otus]
+        if self.backend == SPARSE:
+            pos = _positions(self.otus, otus)
+            self._counts = self._counts[:, pos]
+            self.otus = self.otus[pos]
+        else:
+            self._counts = self._counts.loc[:, otus]
         self._update_from_counts(trim=False)
 
     def pick_samples(self, samples, trim=True):
         """
         Pick the given samples from the data set
         """
-        self.counts = self.counts.loc[samples]
+        if self.backend == SPARSE:
+            pos = _positions(self.samples, samples)
+            self._counts = self._counts[pos]
+            self.samples = self.samples[pos]
+        else:
+            self._counts = self._counts.loc[samples]
         self._update_from_counts(trim=trim)
 
     def _update_from_counts(self, trim=True):
         """
         updates self after changes to counts
 
+        This sets the sample_sizes and otu_sizes, the row and column totals.
+
         :param bool trim: Remove zero OTUs
         """
-        if trim:
-            old_ncols = len(self.counts.columns)
-            self.counts = self.counts.loc[:, self.counts.sum() > 0]
-            new_ncols = len(self.counts.columns)
-            if old_ncols != new_ncols:
-                self.info('Removed OTUs with all-zero count:',
-                          old_ncols - new_ncols)
-
-        self.sample_sizes = self.counts.sum(axis=1)
-        self.samples = self.counts.index
-        self.otus = self.counts.columns
+        if self.backend == SPARSE:
+            if trim:
+                keep = numpy.flatnonzero(self._counts.getnnz(axis=0))
+                if len(keep) != len(self.otus):
+                    self.info('Removed OTUs with all-zero count:',
+                              len(self.otus) - len(keep))
+                    self._counts = self._counts[:, keep]
+                    self.otus = self.otus[keep]
+            self.sample_sizes = pandas.Series(
+                numpy.asarray(self._counts.sum(axis=1, dtype=numpy.int64))
+                .ravel(),
+                index=self.samples,
+            )
+            self.otu_sizes = pandas.Series(
+                numpy.asarray(self._counts.sum(axis=0, dtype=numpy.int64))
+                .ravel(),
+                index=self.otus,
+            )
+        else:
+            if trim:
+                old_ncols = len(self._counts.columns)
+                self._counts = self._counts.loc[:, self._counts.sum() > 0]
+                new_ncols = len(self._counts.columns)
+                if old_ncols != new_ncols:
+                    self.info('Removed OTUs with all-zero count:',
+                              old_ncols - new_ncols)
+
+            self.sample_sizes = self._counts.sum(axis=1)
+            self.otu_sizes = self._counts.sum(axis=0)
+            self.samples = self._counts.index
+            self.otus = self._counts.columns
         self.nrows = len(self.samples)
         self.ncols = len(self.otus)
 
@@ -418,14 +842,26 @@ class MothurShared():
         """
         Remove the given OTUs from the data set
         """
-        self.counts.drop(otus, axis=1, inplace=True)
+        if self.backend == SPARSE:
+            drop = _positions(self.otus, otus)
+            keep = numpy.setdiff1d(numpy.arange(self.ncols), drop)
+            self._counts = self._counts[:, keep]
+            self.otus = self.otus[keep]
+        else:
+            self._counts.drop(otus, axis=1, inplace=True)
         self._update_from_counts(trim=False)
 
     def remove_samples(self, samples, trim=True):
         """
         Remove the given samples from the data set
         """
-        self.counts.drop(samples, axis=0, inplace=True)
+        if self.backend == SPARSE:
+            drop = _positions(self.samples, samples)
+            keep = numpy.setdiff1d(numpy.arange(self.nrows), drop)
+            self._counts = self._counts[keep]
+            self.samples = self.samples[keep]
+        else:
+            self._counts.drop(samples, axis=0, inplace=True)
         self._update_from_counts(trim=trim)
 
     def save(self, filename):
@@ -436,19 +872,11 @@ class MothurShared():
             row = ['label', 'Group', 'numOtus'] + list(self.otus)
             num_otus = str(len(self.otus))
             f.write('\t'.join(row) + '\n')
-            for sample, counts in self.rows():
+            for sample, counts in self.rows(as_iter=True):
                 row = [self.label, sample, num_otus]
                 row += list(map(str, counts))
                 f.write('\t'.join(row) + '\n')
 
-    def info(self, *args, inline=False, **kwargs):
-        if self.verbose:
-            if inline:
-                print(*args, file=sys.stderr, **kwargs)
-            else:
-                print('[{}]'.format(Path(sys.argv[0]).name), *args,
-                      file=sys.stderr, **kwargs)
-
     def set_accessions(self, prefix=DEFAULT_OTU_NUM_PREFIX, with_map=None,
                        sort=True, leading_zeros=True, first=1):
         """
@@ -459,10 +887,13 @@ class MothurShared():
         used to map old to new identifiers.
         """
         if sort:
-            orig_otus = self.counts.sum().sort_values(ascending=False).index
+            orig_otus = self.otu_sizes.sort_values(ascending=False).index
         else:
             orig_otus = self.otus
-        self.counts = self.counts[orig_otus]
+        if self.backend == SPARSE:
+            self._counts = self._counts[:, _positions(self.otus, orig_otus)]
+        else:
+            self._counts = self._counts[orig_otus]
 
         # make reservoir of well-formatted accessions:
         # TODO: num of leading zeros may differ from with_map
@@ -473,6 +904,8 @@ class MothurShared():
             accs = map(lambda x: x.zfill(magnitude), accs)
         accs = map(lambda x: prefix + x, accs)
 
+        if with_map is None:
+            with_map = {}
         new_otus = []
         for i in orig_otus:
             if i in with_map:
@@ -486,11 +919,359 @@ class MothurShared():
                 '<first> parameter or check with provided <with_map>'
             )
 
-        self.counts.columns = new_otus
+        if self.backend == SPARSE:
+            self.otus = pandas.Index(new_otus)
+        else:
+            self._counts.columns = new_otus
         self._update_from_counts(trim=False)
         return dict(zip(orig_otus, new_otus))
 
 
+class SharedReader(_SharedBase):
+    """
+    Read a shared file or count table row by row
+
+    For input too large to be held in memory.  Iterating over the reader
+    yields tuples of the row id, the row meta data, i.e. the label for shared
+    files, and the row's counts as numpy array.  Rows are samples for shared
+    files and sequences for count tables, the columns are in the order of
+    the columns attribute.  Along the way the totals and the prevalence, the
+    number of rows with non-zero count, of each column are accumulated.
+    """
+    def __init__(self, file_arg, verbose=True, file_format=AUTO_DETECT):
+        self.verbose = verbose
+        if isinstance(file_arg, str):
+            self.file = open(file_arg, 'r')
+        elif isinstance(file_arg, Path):
+            self.file = file_arg.open('r')
+        else:
+            # assume a file-like object
+            self.file = file_arg
+        self._close = self.file is not file_arg
+
+        self.columns = pandas.Index(self._read_header(self.file, file_format))
+        self.info('total {}:  '.format(
+            'samples' if self.spec.transposed else 'OTUs'),
+            len(self.columns))
+        self.label = None
+        self.num_rows = 0
+        self.totals = numpy.zeros(len(self.columns), dtype=numpy.int64)
+        self.prevalence = numpy.zeros(len(self.columns), dtype=numpy.int64)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the input file if it was opened by the reader
+        """
+        if self._close:
+            self.file.close()
+
+    def __iter__(self):
+        has_label = 'label' in self.spec.index_cols
+        for line in self.file:
+            row_id, row_meta, cols, values = self.process_line(line)
+            if has_label:
+                self._check_label(row_meta)
+            counts = numpy.zeros(len(self.columns), dtype=COUNT_DTYPE)
+            counts[cols] = values
+            self.totals += counts
+            self.prevalence += counts > 0
+            self.num_rows += 1
+            yield row_id, row_meta, counts
+
+    def filter(self, outfile, row_filter=None, col_filter=None):
+        """
+        Write the filtered data as mothur shared file in a single pass
+
+        Only available for shared file input.  The rows not yet read are
+        passed through row_filter and the columns, i.e. the OTUs, are
+        selected afterwards by col_filter.  The non-zero counts are spooled
+        to a temporary file next to the output file in the meantime.
+
+        :param outfile: Name of the output file.
+        :param row_filter: Function taking the sample and the counts and
+                           returning the counts to be written, or None to skip
+                           the sample.  By default all samples are written
+                           unchanged.
+        :param col_filter: Function taking the totals and the prevalence of
+                           the written counts and returning a boolean array
+                           selecting the OTUs to be written.  By default the
+                           OTUs with non-zero total are written.
+        :return: The boolean array of written OTUs.
+        """
+        if self.spec.name != SHARED:
+            raise ValueError('Filtering is only implemented for {} input, '
+                             'this is a {}'.format(SHARED, self.spec.name))
+        samples = []
+        sizes = []
+        totals = numpy.zeros(len(self.columns), dtype=numpy.int64)
+        prevalence = numpy.zeros(len(self.columns), dtype=numpy.int64)
+        outdir = Path(outfile).resolve().parent
+        with tempfile.TemporaryFile(dir=outdir) as spool:
+            for sample, _, counts in self:
+                if row_filter is not None:
+                    counts = row_filter(sample, counts)
+                    if counts is None:
+                        continue
+                cols = numpy.flatnonzero(counts).astype(COUNT_DTYPE)
+                cols.tofile(spool)
+                counts[cols].astype(COUNT_DTYPE).tofile(spool)
+                totals += counts
+                prevalence += counts > 0
+                samples.append(sample)
+                sizes.append(len(cols))
+
+            if col_filter is None:
+                keep = totals > 0
+            else:
+                keep = numpy.asarray(col_filter(totals, prevalence),
+                                     dtype=bool)
+            # positions of the kept columns in the output
+            new_pos = numpy.cumsum(keep) - 1
+            num_otus = int(keep.sum())
+            self.info('writing {} samples x {} OTUs to {}'
+                      ''.format(len(samples), num_otus, outfile))
+
+            spool.seek(0)
+            with open(outfile, 'w') as f:
+                row = ['label', 'Group', 'numOtus']
+                row += list(self.columns[keep])
+                f.write('\t'.join(row) + '\n')
+                for sample, size in zip(samples, sizes):
+                    cols = numpy.fromfile(spool, dtype=COUNT_DTYPE,
+                                          count=size)
+                    values = numpy.fromfile(spool, dtype=COUNT_DTYPE,
+                                            count=size)
+                    select = keep[cols]
+                    counts = numpy.zeros(num_otus, dtype=COUNT_DTYPE)
+                    counts[new_pos[cols[select]]] = values[select]
+                    row = [self.label, sample, str(num_otus)]
+                    row += map(str, counts.tolist())
+                    f.write('\t'.join(row) + '\n')
+        return keep
+
+
+def add_cache_argument(argp):
+    """
+    Add the --no-cache option to a script's argument parser
+
+    Pass cache=not args.no_cache to MothurShared.
+    """
+    argp.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Do not use or write the cache of the parsed input file.  By '
+             'default parsed data is saved next to the input file, with '
+             '{} suffix, and used for later runs.'.format(CACHE_SUFFIX),
+    )
+
+
+def _select_backend(shape, nnz):
+    """
+    Select the backend for a count matrix by the number of non-zero counts
+    """
+    size = shape[0] * shape[1]
+    if scipy is not None and size and nnz < SPARSE_DENSITY * size:
+        return SPARSE
+    return DENSE
+
+
+def cache_path(path):
+    """
+    Get path of the cache file for a shared file or count table
+
+    This is the input file's path with CACHE_SUFFIX appended.
+    """
+    return Path(str(path) + CACHE_SUFFIX)
+
+
+def _cache_key(path):
+    """
+    Get what identifies the input file of a cache
+    """
+    stat = os.stat(str(path))
+    return {
+        'path': str(Path(path).resolve()),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+
+
+def write_cache(path, header, arrays):
+    """
+    Write cache file for the given input file
+
+    :param dict header: JSON-serializable data, e.g. row and column labels
+    :param dict arrays: Dictionary of numpy arrays
+
+    The cache file consists of CACHE_MAGIC, the length of the JSON-encoded
+    header as 8-byte little-endian integer, and the header, followed by the
+    raw data of the arrays, each aligned to CACHE_ALIGN bytes.  The arrays'
+    names, data types, shapes and offsets are added to the header.  The file
+    is written under a temporary name and then moved into place.
+    """
+    header = dict(header, version=CACHE_VERSION, arrays={})
+    offset = 0
+    for name, a in arrays.items():
+        header['arrays'][name] = {
+            'dtype': a.dtype.str,
+            'shape': a.shape,
+            'offset': offset,
+        }
+        offset += -(-a.nbytes // CACHE_ALIGN) * CACHE_ALIGN
+    head = json.dumps(header).encode()
+    data_start = -(-(len(CACHE_MAGIC) + 8 + len(head)) // CACHE_ALIGN) \
+        * CACHE_ALIGN
+
+    cache = cache_path(path)
+    tmp = cache.with_name(cache.name + '.tmp')
+    try:
+        with tmp.open('wb') as f:
+            f.write(CACHE_MAGIC)
+            f.write(len(head).to_bytes(8, 'little'))
+            f.write(head)
+            for name, a in arrays.items():
+                f.seek(data_start + header['arrays'][name]['offset'])
+                f.write(numpy.ascontiguousarray(a).data)
+            f.truncate(data_start + offset)
+        os.replace(str(tmp), str(cache))
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def read_cache(path):
+    """
+    Read cache file for the given input file
+
+    :return: Tuple of the header and a dictionary of the arrays.  The arrays
+             are memory-mapped copy-on-write, i.e. changes are not written
+             back to the file.
+
+    Raises ValueError if the file is not a cache file of the current
+    version.
+    """
+    cache = cache_path(path)
+    with cache.open('rb') as f:
+        if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            raise ValueError('not a cache file')
+        size = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(size).decode())
+    if header.get('version') != CACHE_VERSION:
+        raise ValueError('unsupported cache version')
+    data_start = -(-(len(CACHE_MAGIC) + 8 + size) // CACHE_ALIGN) \
+        * CACHE_ALIGN
+    arrays = {}
+    for name, info in header['arrays'].items():
+        dtype = numpy.dtype(info['dtype'])
+        shape = tuple(info['shape'])
+        if 0 in shape:
+            arrays[name] = numpy.empty(shape, dtype=dtype)
+        else:
+            arrays[name] = numpy.memmap(
+                str(cache), dtype=dtype, mode='c', shape=shape,
+                offset=data_start + info['offset'],
+            )
+    return header, arrays
+
+
+def _selector(selection):
+    """
+    Get a function testing names against a selection
+
+    :param selection: None, a function, or a collection of names
+    :return: None if selection is None, otherwise a function returning True
+             for selected names.
+    """
+    if selection is None or callable(selection):
+        return selection
+    return set(selection).__contains__
+
+
+def _parse_ints(text):
+    """
+    Parse tab-separated whole numbers into a numpy array
+
+    Parsing stops at the first malformed number, so callers should check the
+    length of the result.
+
+    :raise RuntimeError: If a number does not fit into COUNT_DTYPE
+    """
+    if not text:
+        return numpy.empty(0, dtype=COUNT_DTYPE)
+    with warnings.catch_warnings():
+        # older numpy warns about malformed data, newer raises ValueError
+        warnings.simplefilter('ignore', DeprecationWarning)
+        try:
+            # parse wide to detect overflow, fromstring would silently wrap
+            values = numpy.fromstring(text, dtype=numpy.int64, sep='\t')
+        except ValueError:
+            return numpy.empty(0, dtype=COUNT_DTYPE)
+    if len(values):
+        limits = numpy.iinfo(COUNT_DTYPE)
+        if values.min() < limits.min or values.max() > limits.max:
+            raise RuntimeError('Count out of range for {}: {}'.format(
+                COUNT_DTYPE,
+                values[(values < limits.min) | (values > limits.max)][0],
+            ))
+    return values.astype(COUNT_DTYPE)
+
+
+def _coo_views(buf, total):
+    """
+    Get row, column, and count arrays of given length from a buffer
+    """
+    return tuple(
+        numpy.ndarray((total,), dtype=COUNT_DTYPE, buffer=buf,
+                      offset=i * total * COUNT_DTYPE.itemsize)
+        for i in range(3)
+    )
+
+
+def _concat_coo(rows, cols, counts):
+    """
+    Concatenate lists of arrays of counts in coordinate format
+    """
+    if not counts:
+        return tuple(numpy.empty(0, dtype=COUNT_DTYPE) for _ in range(3))
+    return (numpy.concatenate(rows), numpy.concatenate(cols),
+            numpy.concatenate(counts))
+
+
+def _selected_positions(index, selection):
+    """
+    Get positions of the labels in a pandas.Index picked by a selection
+
+    :param selection: None, a function, or a collection of names, see
+                      _selector()
+    :return: None if selection is None, otherwise the positions in index
+             order.
+    """
+    select = _selector(selection)
+    if select is None:
+        return None
+    return numpy.flatnonzero([select(i) for i in index])
+
+
+def _positions(index, labels):
+    """
+    Get positions of labels in a pandas.Index
+
+    Raises KeyError for missing labels, like pandas' label-based indexing.
+    """
+    labels = list(labels)
+    pos = index.get_indexer(labels)
+    if (pos == -1).any():
+        missing = [i for i, j in zip(labels, pos) if j == -1]
+        raise KeyError('{} not in index'.format(missing[:10]))
+    return pos
+
+
 class Groups():
     """
     Implements support for mothur groups files
@@ -528,12 +1309,20 @@ def __main__():
     )
     argp.add_argument('-t', type=int, default=DEFAULT_THREADS,
                       help='number of threads')
+    argp.add_argument(
+        '--backend',
+        choices=['auto', DENSE, SPARSE],
+        default='auto',
+        help='Count matrix backend, by default selected by density',
+    )
     args = argp.parse_args()
     try:
         file_format = fmt_args[args.format]
     except KeyError:
         argp.error('Invalid value for --format option')
-    MothurShared(args.shared_file, threads=args.t, file_format=file_format)
+    backend = AUTO_DETECT if args.backend == 'auto' else args.backend
+    MothurShared(args.shared_file, threads=args.t, file_format=file_format,
+                 backend=backend)
 
 
 if __name__ == '__main__':
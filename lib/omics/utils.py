@@ -20,10 +20,32 @@ Omics utilities collection
 """
 
 from collections import defaultdict
-from matplotlib.pyplot import subplots
 from pathlib import Path
 
 
+def parse_read_coordinates(header):
+    """
+    Get tile and x/y coordinates from an Illumina read header
+
+    :param header: The header line, str or bytes, with or without the leading
+                   @ or > character.
+
+    :return: Tuple of tile, x, and y as int.
+    """
+    sep = ':' if isinstance(header, str) else b':'
+    try:
+        point = header.split(sep)[4:7]
+    except Exception:
+        raise RuntimeError('Failed parsing sequence header '
+                           '(split by :): {}'.format(header))
+    try:
+        point[2] = point[2].split()[0]
+        return int(point[0]), int(point[1]), int(point[2])
+    except Exception:
+        raise RuntimeError('Failed parsing sequence header '
+                           '(int conversion): {}'.format(header))
+
+
 def load_read_coordinates(reads_file, file_format='fastq'):
     """
     Load read coordinates into dict of lists of points
@@ -52,18 +74,8 @@ def load_read_coordinates(reads_file, file_format='fastq'):
         data = defaultdict(list)
         for line in reads_file:
             if line.startswith(mark):
-                try:
-                    point = line.split(':')[4:7]
-                except Exception:
-                    raise RuntimeError('Failed parsing sequence header '
-                                       '(split by :): {}'.format(line))
-                point[2] = point[2].split()[0]
-
-                try:
-                    data[int(point[0])].append((int(point[1]), int(point[2])))
-                except Exception:
-                    raise RuntimeError('Failed parsing sequence header '
-                                       '(int conversion): {}'.format(line))
+                tile, x, y = parse_read_coordinates(line)
+                data[tile].append((x, y))
     except Exception:
         raise
     else:
@@ -77,6 +89,7 @@ def scatter(points):
     """
     Diplay scatterplot
     """
+    from matplotlib.pyplot import subplots
     fig, ax = subplots()
     ax.scatter(
         [i[0] for i in points],